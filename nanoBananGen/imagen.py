@@ -3,20 +3,96 @@
 # - Model: models/gemini-2.5-flash-image
 # - Forces 1:1 aspect ratio
 # - Upload references once per SKU (reused across 4 prompts)
+#   * Uploads are cached in upload_cache.jsonl by content hash until shortly before they
+#     expire (~48h), so reruns/resumes/retries reuse live Files API handles.
+#   * References are uploaded as derivatives: EXIF orientation applied, long edge capped at
+#     REF_MAX_EDGE_PX, re-encoded at REF_JPEG_QUALITY without metadata; built once per source
+#     hash into ref_cache/ (--ref-max-edge 0 uploads the originals).
+#   * --ref-strategy auto (default) sends a SKU's references as inline bytes in each
+#     generate_content call when they total at most REF_INLINE_MAX_BYTES, skipping the Files
+#     API round-trips; larger sets (and --batch) use uploaded Files. The strategy and the SKU's
+#     end-to-end latency are recorded in the metrics file.
+#   * A folder with more than MAX_REF_IMAGES JPGs no longer blocks the SKU: the most informative
+#     subset is picked automatically (blurry shots and dHash near-duplicates dropped, then the most
+#     distinct colour/edge-orientation profiles kept) and logged.
+#   * References go before the prompt text, so a SKU's four requests share a common prefix.
+#     --ref-context cache goes further: the references are put in a cached content once per SKU
+#     (REF_CONTEXT_TTL_S, deleted when the SKU ends) and the four prompts run against it, so they
+#     are billed as cached tokens. Per-SKU input/cached tokens and cost are reported for both modes.
 # - Saves RAW only (exact API output with correct extension) — no transcoding
-# - QC: checks for square images only
+# - Generated images that pass QC are kept in a content-addressed result cache (gen_cache/, keyed
+#   by model, prompt, aspect ratio and reference content hashes; LRU-evicted past
+#   RESULT_CACHE_MAX_BYTES), so a reset SKU or re-imported prompt is served from disk. --no-cache forces fresh calls.
+# - QC runs off the generation threads in a process pool (QC_WORKERS): squareness, pure-white
+#   border coverage, blank/near-uniform frames and product margin on a downsampled decode.
+#   Failing prompts are recorded in the run store and requeued (up to QC_MAX_REQUEUES) in-run.
+# - Errors go to an append-only, rotated JSONL journal (error_log.jsonl);
+#   query it with: python imagen.py errors --sku X --code Y --since 2h
+# - python imagen.py replay [--code not_square --since 2h] regenerates exactly the (SKU, prompt)
+#   pairs the journal shows failing and still without a verified output, SKUs in parallel with
+#   cached reference uploads reused, then prints what was fixed and what still fails.
+# - python imagen.py status [--watch] reports completed/pending/failed SKUs, images/hour over
+#   5m/15m/1h, ETA, the API error rate and top error codes from the run store, metrics and
+#   journal (no SDK import, no API key; safe to run alongside a live run).
 # - SMTP + ntfy alerts on warnings/errors (errors at highest priority)
 #   * Includes header sanitisation for ntfy (ASCII-only headers)
+#   * Sent from a background thread over persistent SMTP/HTTP connections; repeats of the
+#     same alert within NOTIFY_DIGEST_WINDOW_S are folded into one digest message
 # - Ctrl+C to pause safely; re-run to resume
-#   * Resume logic: state tracks COMPLETED SKUs only.
-#   * If interrupted mid-SKU, that SKU is NOT marked complete and will be fully re-run.
+#   * Resume logic: run_state.sqlite3 (SQLite, WAL) records every (SKU, prompt) outcome with
+#     its output path and hash; a resumed SKU only regenerates prompts without a verified output.
+#   * state.json is kept as a mirror of completed SKUs (written at the end of each run);
+#     external edits to it (e.g. folder_checker.py) are picked up on the next start.
 # - Retries with exponential backoff + jitter for uploads and image generation.
+# - Deadlines: every upload/generate call runs under a watchdog (GEN_TIMEOUT_S / UPLOAD_TIMEOUT_S)
+#   that abandons a stuck call and lets the retry policy take over; the SDK's HTTP timeout is set
+#   just above, so the abandoned socket is closed too. A SKU gets SKU_DEADLINE_S overall. On Ctrl+C,
+#   in-flight calls get SHUTDOWN_GRACE_S to land before they are abandoned.
+# - Every upload/generate call is recorded (latency, limiter wait, attempt, bytes, tokens,
+#   outcome) to metrics/<run_id>.jsonl and summarised in metrics/imagen.prom (Prometheus
+#   textfile); the run ends with p50/p95/p99 latency, retries per success, images/hour and
+#   estimated spend.
+# - --batch packages pending (SKU, prompt) requests into Gemini Batch API jobs for overnight
+#   runs; jobs are tracked in the run store so a later --batch run resumes polling them.
+#   --backend sim runs the same flow against the in-process simulated endpoint.
+# - A shared circuit breaker watches the rolling generate error rate (5xx/transport errors);
+#   past BREAKER_ERROR_RATE it opens, pausing every worker, then probes with a single canary
+#   request and resumes on success. Opening and recovery each send one notification.
+# - --hedge P (HEDGE_PERCENTILE) hedges slow generate calls: once a call has run longer than the
+#   P-th percentile of recent generate latencies, a duplicate is fired and the first success wins.
+#   Hedges are capped at HEDGE_MAX_SHARE of calls and HEDGE_MAX_USD of estimated extra spend; the
+#   run summary reports how many fired and won.
+# - Process-wide adaptive rate limiting (token bucket + AIMD concurrency) for uploads and
+#   generation; 429/RESOURCE_EXHAUSTED retry-after hints pause every worker together.
+# - --shared-dir DIR lets several processes/hosts drain one prompts_new.json: SKUs are claimed
+#   through O_EXCL lease files with heartbeats; leases of crashed workers expire (LEASE_TTL_S)
+#   and are reclaimed, and per-prompt records let the next holder skip prompts already saved.
+#   A failed SKU waits SHARED_RETRY_DELAY_S before any worker claims it again; one whose
+#   reference folder is missing is settled until a later run finds the folder.
+# - --preflight checks every pending SKU in parallel before any API call (prompt fields, reference
+#   folder match, JPG count, decodability, minimum resolution), writes preflight_report.json and
+#   drops failing SKUs from the run (exit status 1 if none pass).
+# - --workers N runs N SKUs concurrently and fans each SKU's 4 prompts out in parallel
+#   (references are uploaded once per SKU and shared by its prompt threads).
+# - --prefetch K (PREFETCH_SKUS, default 2) resolves folders and prepares/uploads references for
+#   the next K queued SKUs while the current ones generate; prefetched sets older than
+#   PREFETCH_MAX_AGE_S are prepared again rather than used.
+# - The model client sits behind a backend interface: --backend gemini (default; the SDK is
+#   imported and the API key checked only when a run needs it) or --backend sim, an offline
+#   simulator with configurable latency, error/429 rates and image size.
+# - GEMINI_API_KEYS=KEY1,KEY2@model,... pools several keys/projects: each key has its own client,
+#   limiters and counters; calls go to the key with the most headroom (uploaded references stay
+#   with the key that owns them) and keys returning quota or auth errors are benched for a while.
+#   python imagen.py benchmark --skus 200 --workers 8 runs a synthetic catalogue against the
+#   simulator and reports SKUs/hour, p50/p95 prompt latency and wasted calls.
 #
 # Requirements:
-#   pip install google-genai pillow python-dotenv requests
+#   pip install google-genai pillow numpy python-dotenv requests
 #
 # Environment (.env):
 #   GEMINI_API_KEY=...
+#   # or a pool (optional per-key model override after '@'):
+#   # GEMINI_API_KEYS=KEY1,KEY2,KEY3@models/gemini-2.5-flash-image
 #   SMTP_HOST=...
 #   SMTP_PORT=587
 #   SMTP_USER=...
@@ -35,19 +111,53 @@
 #
 # Optional:
 #   LOG_LEVEL=DEBUG  (default DEBUG)
+#   GEN_RPM=60, GEN_MAX_CONCURRENCY=8           (generation quota ceiling)
+#   UPLOAD_RPM=300, UPLOAD_MAX_CONCURRENCY=4    (Files API quota ceiling)
+#   RATE_HEADROOM=0.9                           (fraction of the ceiling to aim for)
+#   REF_MAX_EDGE_PX=1536, REF_JPEG_QUALITY=88   (reference derivatives; 0 uploads originals)
+#   REF_STRATEGY=auto|inline|files, REF_INLINE_MAX_BYTES=4000000   (how references reach the model)
+#   REF_CONTEXT=request|cache, REF_CONTEXT_TTL_S=900   (per-request references or one cached context per SKU)
+#   RESULT_CACHE_MAX_BYTES=10000000000           (result cache size before LRU eviction)
+#   PRICE_INPUT_PER_MTOK=0.30, PRICE_OUTPUT_PER_MTOK=30   (USD per 1M tokens, for the spend estimate)
+#   PRICE_CACHED_INPUT_PER_MTOK=0.03, PRICE_CACHE_STORAGE_PER_MTOK_HOUR=1.0   (context caching)
+#   IMAGEN_BACKEND=gemini|sim                   (default for --backend)
+#   SIM_LATENCY_S=12, SIM_LATENCY_SIGMA=0.35    (simulator: lognormal generate latency)
+#   SIM_ERROR_RATE=0, SIM_429_RATE=0, SIM_EMPTY_RATE=0, SIM_IMAGE_KB=1200, SIM_QUOTA_RPM=0, SIM_KEYS=1
+#   SIM_HANG_RATE=0, SIM_HANG_FACTOR=20         (simulator: share of calls that stall, and for how many medians)
+#   KEY_BENCH_DAILY_S=3600, KEY_BENCH_AUTH_S=900  (how long a pooled key sits out)
+#   BREAKER_WINDOW_S=120, BREAKER_MIN_CALLS=10, BREAKER_ERROR_RATE=0.5, BREAKER_OPEN_S=60, BREAKER_MAX_OPEN_S=900
+#   HEDGE_PERCENTILE=0 (off; e.g. 95), HEDGE_MIN_SAMPLES=20, HEDGE_MAX_SHARE=0.1, HEDGE_MAX_USD=5
+#   GEN_TIMEOUT_S=180, UPLOAD_TIMEOUT_S=120, SKU_DEADLINE_S=1800 (0 = none), SHUTDOWN_GRACE_S=5
+#   PREFETCH_SKUS=2 (0 = off), PREFETCH_WORKERS=2, PREFETCH_MAX_AGE_S=1800
 
 import os
 import sys
 import json
 import time
+import hashlib
+import base64
+import io
+import shutil
+import datetime
+import sqlite3
 import signal
 import smtplib
 import logging
 import argparse
+import queue
+import re
 import random
+import math
+import threading
 import traceback
 import unicodedata
-from io import BytesIO
+import tempfile
+import socket
+import urllib.request
+import itertools
+from bisect import bisect_left
+from contextlib import contextmanager
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor, as_completed, wait, FIRST_COMPLETED
 from typing import List, Dict, Tuple, Callable, Any
 
 from email.mime.multipart import MIMEMultipart
@@ -55,19 +165,23 @@ from email.mime.text import MIMEText
 from email.mime.application import MIMEApplication
 from email.utils import formatdate
 
-from PIL import Image
+import multiprocessing
+from collections import deque
+from types import SimpleNamespace
+
+import numpy as np
+from PIL import Image, ImageOps
 from dotenv import load_dotenv
 import requests
 from logging.handlers import RotatingFileHandler
 
-# pip install google-genai pillow python-dotenv requests
-from google import genai
-from google.genai import types
+# google-genai is imported by GeminiBackend on first use (see GENERATION BACKENDS)
 
 # -------------------- SETTINGS --------------------
 load_dotenv()
 
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
+GEMINI_API_KEYS = os.getenv("GEMINI_API_KEYS", "")   # key pool: "KEY1,KEY2@models/other-model,..."
 
 SMTP_HOST = os.getenv("SMTP_HOST")
 SMTP_PORT = int(os.getenv("SMTP_PORT", "587"))
@@ -83,30 +197,150 @@ NTFY_URL = os.getenv("NTFY_URL") or (f"{NTFY_BASE}/{NTFY_TOPIC}" if NTFY_TOPIC e
 NTFY_USERNAME = os.getenv("NTFY_USERNAME")
 NTFY_PASSWORD = os.getenv("NTFY_PASSWORD")
 
+# Notification dispatch (background thread; see NotificationDispatcher)
+NOTIFY_DIGEST_WINDOW_S = float(os.getenv("NOTIFY_DIGEST_WINDOW_S", "300"))    # coalesce repeats per key
+NOTIFY_ATTACH_MAX_BYTES = int(os.getenv("NOTIFY_ATTACH_MAX_BYTES", "262144"))  # error journal tail size
+NOTIFY_QUEUE_SIZE = int(os.getenv("NOTIFY_QUEUE_SIZE", "1000"))
+SMTP_IDLE_S = float(os.getenv("SMTP_IDLE_S", "120"))                           # drop idle SMTP connection
+NOTIFY_ENABLED = True                                                           # benchmark runs turn this off
+
 REFERENCE_ROOT = r"C:\Roshaan\OneDrive_1_18-11-2025\master"
 OUTPUT_ROOT = os.path.join(os.getcwd(), "output_images")
-STATE_FILE = "state.json"          # Tracks COMPLETED SKUs only
-ERROR_FILE = "error_log.json"      # Cumulative structured errors
+STATE_FILE = "state.json"          # Mirror of completed SKUs (for folder_checker.py etc.)
+RUN_DB_FILE = "run_state.sqlite3"  # Per-prompt run store (authoritative)
+UPLOAD_CACHE_FILE = "upload_cache.jsonl"  # Files API handles keyed by reference content hash
+REF_CACHE_DIR = "ref_cache"        # Downscaled reference derivatives keyed by source hash + params
+RESULT_CACHE_DIR = "gen_cache"     # Generated images keyed by request content hash
+RESULT_CACHE_MAX_BYTES = int(os.getenv("RESULT_CACHE_MAX_BYTES", str(10_000_000_000)))
+BATCH_DIR = "batch_jobs"           # Batch API request/result JSONL files
+ERROR_FILE = "error_log.jsonl"     # Append-only structured errors (one JSON object per line)
+METRICS_DIR = "metrics"            # Per-call metrics JSONL per run + Prometheus textfile
+METRICS_PROM_INTERVAL_S = float(os.getenv("METRICS_PROM_INTERVAL_S", "30"))
+ERROR_JOURNAL_MAX_BYTES = int(os.getenv("ERROR_JOURNAL_MAX_BYTES", str(10_000_000)))  # rotate at this size
+ERROR_JOURNAL_BACKUPS = int(os.getenv("ERROR_JOURNAL_BACKUPS", "10"))                # error_log.jsonl.1 .. .N
 PROMPTS_FILE = "prompts_new.json"
 LOG_FILE = "run.log"
 
 MAX_REF_IMAGES = 6
+REF_SELECT_PX = 256                # decode size for picking references when a folder has too many
+REF_DUP_BITS = int(os.getenv("REF_DUP_BITS", "6"))                  # dHash distance (of 64 bits) counted as a near-duplicate
+REF_MIN_SHARPNESS = float(os.getenv("REF_MIN_SHARPNESS", "0.25"))   # vs the folder's median sharpness; below = blurry
+REF_MAX_EDGE_PX = int(os.getenv("REF_MAX_EDGE_PX", "1536"))    # long edge of uploaded references; 0 = originals
+REF_JPEG_QUALITY = int(os.getenv("REF_JPEG_QUALITY", "88"))
+REF_STRATEGY = os.getenv("REF_STRATEGY", "auto")                # auto | inline | files
+REF_INLINE_MAX_BYTES = int(os.getenv("REF_INLINE_MAX_BYTES", "4000000"))  # auto: inline a SKU's refs up to this total
+REF_CONTEXT = os.getenv("REF_CONTEXT", "request")               # request | cache (one cached context per SKU)
+REF_CONTEXT_TTL_S = float(os.getenv("REF_CONTEXT_TTL_S", "900"))  # cached context lifetime if a SKU never ends
+
+# Preflight (--preflight): offline checks before the first API call
+PREFLIGHT_REPORT = "preflight_report.json"
+PREFLIGHT_WORKERS = int(os.getenv("PREFLIGHT_WORKERS", "16"))
+PREFLIGHT_MIN_REF_PX = int(os.getenv("PREFLIGHT_MIN_REF_PX", "256"))   # shortest side of each reference
+
+# Files API objects live ~48h; don't reuse one with less than the margin left.
+UPLOAD_TTL_S = float(os.getenv("UPLOAD_TTL_S", str(48 * 3600)))
+UPLOAD_EXPIRY_MARGIN_S = float(os.getenv("UPLOAD_EXPIRY_MARGIN_S", str(2 * 3600)))
+
+# Batch mode: jobs can take up to 24h, so referenced uploads must outlive that
+BATCH_MAX_REQUESTS = int(os.getenv("BATCH_MAX_REQUESTS", "400"))   # requests per job file
+BATCH_POLL_S = float(os.getenv("BATCH_POLL_S", "60"))
+BATCH_MIN_REF_TTL_S = float(os.getenv("BATCH_MIN_REF_TTL_S", str(26 * 3600)))
 
 # Default: process ALL SKUs (0 = no limit). Override with --stop-after if you want a cap.
 DEFAULT_STOP_AFTER = 0
 
+# Shared-dir mode (--shared-dir): lease expiry, heartbeat and attempts per SKU across all workers
+LEASE_TTL_S = float(os.getenv("LEASE_TTL_S", "300"))
+LEASE_HEARTBEAT_S = float(os.getenv("LEASE_HEARTBEAT_S", "30"))
+SHARED_MAX_ATTEMPTS = int(os.getenv("SHARED_MAX_ATTEMPTS", "3"))
+SHARED_RETRY_DELAY_S = float(os.getenv("SHARED_RETRY_DELAY_S", "600"))   # a failed SKU waits this long before it is claimed again
+
+# Concurrency: SKUs in flight at once (1 = original sequential behaviour). Override with --workers.
+DEFAULT_WORKERS = int(os.getenv("WORKERS", "1"))
+PROMPT_KEYS = ("top", "side", "front_45", "lifestyle")
+
+# Reference prefetch (--prefetch): look-ahead of queued SKUs whose references are prepared early
+PREFETCH_SKUS = int(os.getenv("PREFETCH_SKUS", "2"))                   # 0 = off
+PREFETCH_WORKERS = int(os.getenv("PREFETCH_WORKERS", "2"))
+PREFETCH_MAX_AGE_S = float(os.getenv("PREFETCH_MAX_AGE_S", "1800"))    # older prefetched sets are redone
+WHITE_BG_PROMPTS = ("top", "side", "front_45")   # e-comm shots on #FFFFFF; lifestyle is exempt
+
+# QC stage (process pool; 0 = run QC inline on the generation thread)
+QC_WORKERS = int(os.getenv("QC_WORKERS", "2"))
+QC_SAMPLE_PX = 256             # decode/downsample to at most this many px per side
+QC_BORDER_FRAC = 0.04          # border band checked for white, as a fraction of the side
+QC_WHITE_MIN = 250             # per-channel value counted as white after downsampling
+QC_MIN_BORDER_WHITE = float(os.getenv("QC_MIN_BORDER_WHITE", "0.97"))  # share of border px that must be white
+QC_MIN_STD = float(os.getenv("QC_MIN_STD", "4.0"))                     # luminance std below this = blank frame
+QC_MIN_MARGIN = float(os.getenv("QC_MIN_MARGIN", "0.02"))              # product bbox distance from each edge
+QC_MAX_REQUEUES = int(os.getenv("QC_MAX_REQUEUES", "1"))               # regenerations per SKU per run
+
 MODEL = "models/gemini-2.5-flash-image"
 RESP_MODALITIES = ["IMAGE"]
 ASPECT_RATIO = "1:1"
 
+# Spend estimate (USD per 1M tokens; an output image is ~1290 tokens). Batch jobs bill at half.
+PRICE_INPUT_PER_MTOK = float(os.getenv("PRICE_INPUT_PER_MTOK", "0.30"))
+PRICE_OUTPUT_PER_MTOK = float(os.getenv("PRICE_OUTPUT_PER_MTOK", "30.0"))
+PRICE_CACHED_INPUT_PER_MTOK = float(os.getenv("PRICE_CACHED_INPUT_PER_MTOK", "0.03"))            # input served from a cache
+PRICE_CACHE_STORAGE_PER_MTOK_HOUR = float(os.getenv("PRICE_CACHE_STORAGE_PER_MTOK_HOUR", "1.0"))  # cached context storage
+IMAGE_OUTPUT_TOKENS = 1290
+
 # Retry policy
 RETRY_MAX_ATTEMPTS = int(os.getenv("RETRY_MAX_ATTEMPTS", "4"))
 RETRY_BASE_DELAY_S = float(os.getenv("RETRY_BASE_DELAY_S", "2.0"))  # initial backoff
 RETRY_MAX_DELAY_S = float(os.getenv("RETRY_MAX_DELAY_S", "20.0"))   # cap backoff
 
+# Deadlines: a call past its timeout is abandoned by the watchdog and retried
+GEN_TIMEOUT_S = float(os.getenv("GEN_TIMEOUT_S", "180"))        # one generate_content call
+UPLOAD_TIMEOUT_S = float(os.getenv("UPLOAD_TIMEOUT_S", "120"))  # one upload / cache create
+SKU_DEADLINE_S = float(os.getenv("SKU_DEADLINE_S", "1800"))     # a whole SKU, retries included (0 = none)
+SHUTDOWN_GRACE_S = float(os.getenv("SHUTDOWN_GRACE_S", "5"))    # on Ctrl+C, wait this long for in-flight calls
+
+# Rate limiting (shared by all worker threads). RPM values are the quota ceiling;
+# we aim for RATE_HEADROOM of it and adapt down/up on 429s (AIMD).
+GEN_RPM = float(os.getenv("GEN_RPM", "60"))
+GEN_MAX_CONCURRENCY = int(os.getenv("GEN_MAX_CONCURRENCY", "8"))
+UPLOAD_RPM = float(os.getenv("UPLOAD_RPM", "300"))
+UPLOAD_MAX_CONCURRENCY = int(os.getenv("UPLOAD_MAX_CONCURRENCY", "4"))
+RATE_HEADROOM = float(os.getenv("RATE_HEADROOM", "0.9"))
+THROTTLE_COOLDOWN_S = float(os.getenv("THROTTLE_COOLDOWN_S", "10.0"))  # used when a 429 has no retry-after hint
+
+# Circuit breaker around generate calls: opens on a rolling server/network error rate
+BREAKER_WINDOW_S = float(os.getenv("BREAKER_WINDOW_S", "120"))       # rolling window for the error rate
+BREAKER_MIN_CALLS = int(os.getenv("BREAKER_MIN_CALLS", "10"))        # calls in the window before it can trip
+BREAKER_ERROR_RATE = float(os.getenv("BREAKER_ERROR_RATE", "0.5"))   # failing share that opens it
+BREAKER_OPEN_S = float(os.getenv("BREAKER_OPEN_S", "60"))            # wait before the canary probe
+BREAKER_MAX_OPEN_S = float(os.getenv("BREAKER_MAX_OPEN_S", "900"))   # cap as failed probes double the wait
+
+# Hedged generate calls (--hedge): duplicate a call still running past a latency percentile
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "0"))         # 0 = off; e.g. 95
+HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", "20"))        # recent latencies needed before hedging
+HEDGE_MAX_SHARE = float(os.getenv("HEDGE_MAX_SHARE", "0.1"))         # hedges per generate call, at most
+HEDGE_MAX_USD = float(os.getenv("HEDGE_MAX_USD", "5.0"))             # estimated extra spend per run (0 = no cap)
+
+# Key pool (GEMINI_API_KEYS): how long a key is taken out of rotation
+KEY_BENCH_QUOTA_S = float(os.getenv("KEY_BENCH_QUOTA_S", "60"))      # 429 without a retry-after hint
+KEY_BENCH_DAILY_S = float(os.getenv("KEY_BENCH_DAILY_S", "3600"))    # per-day quota exhausted
+KEY_BENCH_AUTH_S = float(os.getenv("KEY_BENCH_AUTH_S", "900"))       # key rejected (invalid, disabled, no access)
+
+# Generation backend: 'gemini' (google-genai) or 'sim' (offline simulator). Override with --backend.
+BACKEND = os.getenv("IMAGEN_BACKEND", "gemini")
+SIM_LATENCY_S = float(os.getenv("SIM_LATENCY_S", "12.0"))          # median generate latency
+SIM_LATENCY_SIGMA = float(os.getenv("SIM_LATENCY_SIGMA", "0.35"))  # lognormal shape (0 = constant)
+SIM_UPLOAD_LATENCY_S = float(os.getenv("SIM_UPLOAD_LATENCY_S", "0.8"))
+SIM_ERROR_RATE = float(os.getenv("SIM_ERROR_RATE", "0"))           # share of calls failing with a 500
+SIM_429_RATE = float(os.getenv("SIM_429_RATE", "0"))               # share of calls throttled at random
+SIM_EMPTY_RATE = float(os.getenv("SIM_EMPTY_RATE", "0"))           # share of responses with no image
+SIM_IMAGE_KB = int(os.getenv("SIM_IMAGE_KB", "1200"))              # approx size of returned PNGs
+SIM_QUOTA_RPM = float(os.getenv("SIM_QUOTA_RPM", "0"))             # server-side quota (0 = none)
+SIM_KEYS = int(os.getenv("SIM_KEYS", "1"))                         # simulated API keys, each with its own quota
+SIM_HANG_RATE = float(os.getenv("SIM_HANG_RATE", "0"))             # share of calls that stall
+SIM_HANG_FACTOR = float(os.getenv("SIM_HANG_FACTOR", "20"))        # a stalled call takes this many times its latency
+
 # -------------------- LOGGING --------------------
-def init_logging(force_debug: bool = False):
-    os.makedirs(OUTPUT_ROOT, exist_ok=True)
+def init_logging(force_debug: bool = False, log_file: str | None = LOG_FILE):
+    """Console handler plus, unless log_file is None, a rotating log file."""
     logger = logging.getLogger("imagen")
     logger.propagate = False
     for h in list(logger.handlers):
@@ -126,20 +360,26 @@ def init_logging(force_debug: bool = False):
     _console.setFormatter(fmt)
     logger.addHandler(_console)
 
-    _file = RotatingFileHandler(LOG_FILE, maxBytes=10_000_000, backupCount=5, encoding="utf-8")
-    _file.setLevel(level)
-    _file.setFormatter(fmt)
-    logger.addHandler(_file)
+    # QC pool workers re-import this module; only the parent process may rotate run.log
+    if log_file and multiprocessing.parent_process() is None:
+        _file = RotatingFileHandler(log_file, maxBytes=10_000_000, backupCount=5, encoding="utf-8")
+        _file.setLevel(level)
+        _file.setFormatter(fmt)
+        logger.addHandler(_file)
 
     logger.debug(f"Logging initialised at level {logging.getLevelName(level)}")
     return logger
 
-logger = init_logging()
+# Handlers (console + run.log) are attached by init_logging() once a command that generates
+# images starts; read-only commands such as `status` leave no log file or output folder behind
+logger = logging.getLogger("imagen")
 
 # -------------------- SDK CLIENT --------------------
 def log_env_summary():
     logger.debug("==== ENV SUMMARY ====")
     logger.debug(f"GEMINI_API_KEY set: {'yes' if bool(GEMINI_API_KEY) else 'NO'}")
+    if GEMINI_API_KEYS:
+        logger.debug(f"GEMINI_API_KEYS pool: {len(parse_key_pool(GEMINI_API_KEYS))} key(s)")
     logger.debug(f"SMTP configured: {all([SMTP_HOST, SMTP_USER, SMTP_PASS, NOTIFY_EMAIL])}")
     logger.debug(f"ntfy URL resolved: {NTFY_URL if NTFY_URL else 'None'}")
     if NTFY_URL:
@@ -149,12 +389,31 @@ def log_env_summary():
     logger.debug(f"PROMPTS_FILE: {PROMPTS_FILE}")
     logger.debug("=====================")
 
-if not GEMINI_API_KEY:
-    logger.error("GEMINI_API_KEY is missing in .env")
-    sys.exit(1)
+# Created by init_backend() when a run starts (GeminiBackend or SimulatedBackend)
+client = None
+FileHandle = Any   # an uploaded file: google.genai types.File, or the simulator's equivalent
 
-client = genai.Client(api_key=GEMINI_API_KEY)
-log_env_summary()
+# -------------------- CONCURRENCY --------------------
+# Set on Ctrl+C or a fatal error in parallel mode; worker threads check it before each prompt
+# so in-flight generations finish (and get saved) but nothing new starts.
+STOP_EVENT = threading.Event()
+
+# Serialises error journal appends/rotation across worker threads.
+_file_lock = threading.RLock()
+
+def check_stop():
+    if STOP_EVENT.is_set():
+        raise KeyboardInterrupt()
+
+def sleep_unless_stopped(seconds: float):
+    """time.sleep in short slices, so Ctrl+C and STOP_EVENT cut it short on any platform."""
+    end = time.monotonic() + seconds
+    while True:
+        left = end - time.monotonic()
+        if left <= 0:
+            return
+        if STOP_EVENT.wait(min(left, 0.5)):
+            raise KeyboardInterrupt()
 
 # -------------------- UTIL: TIME --------------------
 def now_str() -> str:
@@ -181,11 +440,102 @@ def save_json(path: str, obj):
     os.replace(tmp, path)
     logger.debug(f"Saved JSON OK: {path}")
 
+# -------------------- ERROR JOURNAL --------------------
+def _rotate_error_journal():
+    for i in range(ERROR_JOURNAL_BACKUPS - 1, 0, -1):
+        src = f"{ERROR_FILE}.{i}"
+        if os.path.exists(src):
+            os.replace(src, f"{ERROR_FILE}.{i + 1}")
+    os.replace(ERROR_FILE, f"{ERROR_FILE}.1")
+    logger.debug(f"Rotated error journal ({ERROR_JOURNAL_BACKUPS} backup(s) kept)")
+
 def append_error(entry: Dict):
+    """Appends one JSON line to the error journal; cost is independent of journal size."""
     logger.debug(f"Appending error entry: {entry.get('error_code','unknown')} for {entry.get('product_code','n/a')}:{entry.get('prompt','n/a')}")
-    data = load_json(ERROR_FILE, {"errors": []})
-    data["errors"].append(entry)
-    save_json(ERROR_FILE, data)
+    entry.setdefault("ts", time.time())
+    line = json.dumps(entry, ensure_ascii=False) + "\n"
+    with _file_lock:
+        try:
+            if os.path.getsize(ERROR_FILE) + len(line) > ERROR_JOURNAL_MAX_BYTES:
+                _rotate_error_journal()
+        except OSError:
+            pass  # no journal yet
+        with open(ERROR_FILE, "a", encoding="utf-8") as f:
+            f.write(line)
+
+def error_journal_files() -> List[str]:
+    """Journal segments oldest first (highest-numbered backup .. current file)."""
+    paths = [f"{ERROR_FILE}.{i}" for i in range(ERROR_JOURNAL_BACKUPS, 0, -1)] + [ERROR_FILE]
+    return [p for p in paths if os.path.exists(p)]
+
+def _entry_ts(entry: Dict) -> float:
+    if "ts" in entry:
+        return float(entry["ts"])
+    try:
+        return time.mktime(time.strptime(entry.get("timestamp", ""), "%Y-%m-%d %H:%M:%S"))
+    except ValueError:
+        return 0.0
+
+def iter_errors(sku: str | None = None, codes: set | None = None, prompt: str | None = None,
+                since: float | None = None, until: float | None = None):
+    """Streams matching journal entries oldest first without loading whole segments."""
+    for path in error_journal_files():
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    e = json.loads(line)
+                except ValueError:
+                    continue
+                if sku and e.get("product_code") != sku:
+                    continue
+                if codes and e.get("error_code") not in codes:
+                    continue
+                if prompt and e.get("prompt") != prompt:
+                    continue
+                if since is not None or until is not None:
+                    ts = _entry_ts(e)
+                    if (since is not None and ts < since) or (until is not None and ts > until):
+                        continue
+                yield e
+
+def parse_time_arg(value: str) -> float:
+    """Accepts 'YYYY-MM-DD[ HH:MM[:SS]]' (local time) or a relative age like '30m', '2h', '1d'."""
+    value = value.strip()
+    m = re.fullmatch(r"(\d+(?:\.\d+)?)([smhd])", value)
+    if m:
+        return time.time() - float(m.group(1)) * {"s": 1, "m": 60, "h": 3600, "d": 86400}[m.group(2)]
+    for fmt in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d"):
+        try:
+            return time.mktime(time.strptime(value, fmt))
+        except ValueError:
+            continue
+    raise argparse.ArgumentTypeError(f"Unrecognised time '{value}' (use YYYY-MM-DD[ HH:MM[:SS]] or 30m/2h/1d)")
+
+def cmd_errors(args):
+    """`imagen.py errors`: filter the journal; prints one line per entry, raw JSON, or a summary."""
+    codes = set(args.code) if args.code else None
+    matched = 0
+    by_code: Dict[str, int] = {}
+    by_sku: Dict[str, int] = {}
+    for e in iter_errors(sku=args.sku, codes=codes, prompt=args.prompt, since=args.since, until=args.until):
+        matched += 1
+        if args.summary:
+            by_code[e.get("error_code", "unknown")] = by_code.get(e.get("error_code", "unknown"), 0) + 1
+            by_sku[e.get("product_code", "n/a")] = by_sku.get(e.get("product_code", "n/a"), 0) + 1
+            continue
+        if args.json:
+            print(json.dumps(e, ensure_ascii=False))
+        else:
+            print(f"{e.get('timestamp','?')}  {e.get('product_code','n/a')}/{e.get('prompt','n/a')}  "
+                  f"[{e.get('error_code','unknown')}]  {str(e.get('error',''))[:200]}")
+        if args.limit and matched >= args.limit:
+            break
+    if args.summary:
+        print(f"{matched} matching error(s)")
+        for label, counts in (("error_code", by_code), ("product_code", by_sku)):
+            print(f"Top {label}:")
+            for k, n in sorted(counts.items(), key=lambda kv: -kv[1])[:15]:
+                print(f"  {n:6d}  {k}")
 
 # -------------------- NOTIFY (Email + ntfy) --------------------
 def _format_html(subject: str, heading: str, details: Dict[str, Any] | None = None, footer: str | None = None) -> str:
@@ -205,38 +555,6 @@ def _format_html(subject: str, heading: str, details: Dict[str, Any] | None = No
 </html>
 """
 
-def send_email(subject: str, html_body: str, attachments: list[tuple[str, bytes]] | None = None):
-    if not (SMTP_HOST and SMTP_USER and SMTP_PASS and NOTIFY_EMAIL):
-        logger.debug("SMTP not fully configured; skipping email send.")
-        return
-    try:
-        logger.debug(f"Preparing email: subject='{subject}' to='{NOTIFY_EMAIL}'")
-        msg = MIMEMultipart()
-        msg["From"] = SMTP_USER
-        msg["To"] = NOTIFY_EMAIL
-        msg["Date"] = formatdate(localtime=True)
-        msg["Subject"] = subject
-        msg.attach(MIMEText(html_body, "html"))
-
-        if attachments:
-            for filename, blob in attachments:
-                logger.debug(f"Attaching file to email: {filename} ({len(blob)} bytes)")
-                part = MIMEApplication(blob, Name=filename)
-                part["Content-Disposition"] = f'attachment; filename="{filename}"'
-                msg.attach(part)
-
-        with smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=20) as server:
-            if SMTP_STARTTLS:
-                logger.debug("Starting TLS for SMTP")
-                server.starttls()
-            logger.debug("Logging in to SMTP")
-            server.login(SMTP_USER, SMTP_PASS)
-            logger.debug("Sending email")
-            server.sendmail(SMTP_USER, NOTIFY_EMAIL, msg.as_string())
-        logger.info(f"Email sent: {subject}")
-    except Exception as e:
-        logger.error(f"Email failed: {e}")
-
 def _sanitize_http_header_value(s: str) -> str:
     """
     HTTP/1.1 headers must be ISO-8859-1. Replace common Unicode punctuation,
@@ -258,43 +576,235 @@ def _sanitize_http_header_value(s: str) -> str:
     s = s.encode("ascii", "ignore").decode("ascii", "strict")
     return s.strip()
 
-def send_ntfy(title: str, message: str, priority: int = 5, tags: list[str] | None = None):
-    if not NTFY_URL:
-        logger.error("ntfy is not configured (NTFY_URL or NTFY_TOPIC missing). Cannot send notification.")
-        return
+def _tail_bytes(path: str, max_bytes: int) -> bytes:
+    """Last max_bytes of a file, starting on a line boundary (bounded email attachments)."""
+    with open(path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        f.seek(max(0, size - max_bytes))
+        blob = f.read()
+    if size > max_bytes and b"\n" in blob:
+        blob = blob[blob.index(b"\n") + 1:]
+    return blob
 
-    # Sanitise header values to ASCII-safe strings
-    safe_title = _sanitize_http_header_value(title)
-    safe_priority = _sanitize_http_header_value(str(priority))
-    safe_tags = ",".join(tags) if tags else None
-    safe_tags = _sanitize_http_header_value(safe_tags) if safe_tags else None
+_DISPATCH_STOP = object()
+
+class NotificationDispatcher:
+    """
+    Sends notify() email/ntfy traffic from a background thread so an SMTP or ntfy
+    outage never stalls generation.
+    - One SMTP connection (STARTTLS + login once) and one HTTP session are reused;
+      the SMTP connection is dropped after SMTP_IDLE_S without traffic and redialled on demand.
+    - Per-key coalescing: the first notification for a key is sent at once; repeats within
+      NOTIFY_DIGEST_WINDOW_S are counted and sent as one digest ("N more … in last 5 min").
+    - The error journal attachment is capped to its last NOTIFY_ATTACH_MAX_BYTES.
+    - The queue is bounded; when full, notifications are dropped (they are already logged).
+    """
+    def __init__(self, window_s: float = None, queue_size: int = None):
+        self.window_s = NOTIFY_DIGEST_WINDOW_S if window_s is None else window_s
+        self._q = queue.Queue(maxsize=queue_size or NOTIFY_QUEUE_SIZE)
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._windows: Dict[str, Dict] = {}
+        self._smtp = None
+        self._smtp_used = 0.0
+        self._session = None
+        self.sent = 0
+        self.coalesced = 0
+        self.dropped = 0
 
-    headers = {"Title": safe_title, "Priority": safe_priority}
-    if safe_tags:
-        headers["Tags"] = safe_tags
+    # ---- producer side (any thread) ----
+    def submit(self, note: Dict):
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="notify", daemon=True)
+                self._thread.start()
+        try:
+            self._q.put_nowait(note)
+        except queue.Full:
+            self.dropped += 1
+            logger.warning(f"Notification queue full; dropped '{note.get('title')}' (still logged)")
 
-    auth = (NTFY_USERNAME, NTFY_PASSWORD) if (NTFY_USERNAME and NTFY_PASSWORD) else None
+    def close(self, timeout: float = 15.0):
+        """Sends anything queued plus pending digests, then closes connections."""
+        if self._thread is None or not self._thread.is_alive():
+            return
+        try:
+            self._q.put(_DISPATCH_STOP, timeout=timeout)
+        except queue.Full:
+            pass
+        self._thread.join(timeout)
+        logger.debug(f"Notifier closed: sent={self.sent}, coalesced={self.coalesced}, dropped={self.dropped}")
 
-    try:
-        hdr_preview = {"Title": headers.get("Title"), "Priority": headers.get("Priority"), "Tags": headers.get("Tags")}
-        logger.debug("Posting to ntfy: url=%s, headers=%s", NTFY_URL, hdr_preview)
-
-        # Body can be UTF-8; ntfy handles it
-        r = requests.post(NTFY_URL, data=message.encode("utf-8"), headers=headers, auth=auth, timeout=15)
-        logger.debug("ntfy response: status=%s, body_snippet='%s'", r.status_code, r.text[:300])
-        if r.status_code // 100 != 2:
-            logger.warning(f"ntfy responded with status {r.status_code}: {r.text[:500]}")
+    # ---- dispatcher thread ----
+    def _run(self):
+        while True:
+            try:
+                note = self._q.get(timeout=1.0)
+            except queue.Empty:
+                note = None
+            if note is _DISPATCH_STOP:
+                self._flush_windows(force=True)
+                self._close_smtp()
+                if self._session is not None:
+                    self._session.close()
+                    self._session = None
+                return
+            try:
+                if note is not None:
+                    self._handle(note)
+                self._flush_windows()
+                if self._smtp is not None and time.monotonic() - self._smtp_used > SMTP_IDLE_S:
+                    self._close_smtp()
+            except Exception as e:
+                logger.error(f"Notifier error: {e}")
+
+    def _handle(self, note: Dict):
+        w = self._windows.get(note["key"])
+        if w is None:
+            self._windows[note["key"]] = {"start": time.monotonic(), "count": 0, "last": None, "attach": False}
+            self._deliver(note)
         else:
-            logger.info(f"ntfy sent: {safe_title}")
-    except Exception as e:
-        logger.error(f"ntfy failed: {e}")
+            w["count"] += 1
+            w["last"] = note
+            w["attach"] = w["attach"] or note["attach_error_log"]
+            self.coalesced += 1
+
+    def _flush_windows(self, force: bool = False):
+        now = time.monotonic()
+        for key, w in list(self._windows.items()):
+            if not force and now - w["start"] < self.window_s:
+                continue
+            if w["count"]:
+                self._deliver(self._digest(key, w, now))
+            if w["count"] and not force:
+                # Keep coalescing while the burst continues
+                self._windows[key] = {"start": now, "count": 0, "last": None, "attach": False}
+            else:
+                del self._windows[key]
+
+    def _digest(self, key: str, w: Dict, now: float) -> Dict:
+        last = w["last"]
+        mins = max(1, round((now - w["start"]) / 60))
+        details = {"Occurrences": w["count"], "Window": f"{mins} min", "Latest": last["title"]}
+        details.update(last.get("details") or {})
+        return dict(last,
+                    title=f"{w['count']} more {last['level']}(s) [{key}] in last {mins} min",
+                    message=f"Latest: {last['title']} — {last['message']}",
+                    details=details,
+                    attach_error_log=w["attach"])
+
+    def _deliver(self, note: Dict):
+        html = _format_html(subject=note["message"], heading=note["title"], details=note.get("details"),
+                            footer=f"Timestamp: {note['timestamp']}")
+        attachments = []
+        if note["attach_error_log"] and os.path.exists(ERROR_FILE):
+            try:
+                attachments.append((f"{os.path.basename(ERROR_FILE)}.tail", _tail_bytes(ERROR_FILE, NOTIFY_ATTACH_MAX_BYTES)))
+            except Exception as e:
+                logger.debug(f"Could not attach {ERROR_FILE}: {e}")
+        tags = note.get("tags") or (["rotating_light"] if note["level"] == "error" else ["warning"])
+        self._send_email(subject=note["title"], html_body=html, attachments=attachments)
+        self._send_ntfy(title=note["title"], message=note["message"], priority=note["priority"], tags=tags)
+        self.sent += 1
+
+    def _close_smtp(self):
+        if self._smtp is not None:
+            try:
+                self._smtp.quit()
+            except Exception:
+                pass
+            self._smtp = None
+
+    def _smtp_conn(self) -> smtplib.SMTP:
+        if self._smtp is None:
+            server = smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=20)
+            if SMTP_STARTTLS:
+                logger.debug("Starting TLS for SMTP")
+                server.starttls()
+            logger.debug("Logging in to SMTP")
+            server.login(SMTP_USER, SMTP_PASS)
+            self._smtp = server
+        return self._smtp
+
+    def _send_email(self, subject: str, html_body: str, attachments: list[tuple[str, bytes]] | None = None):
+        if not (SMTP_HOST and SMTP_USER and SMTP_PASS and NOTIFY_EMAIL):
+            logger.debug("SMTP not fully configured; skipping email send.")
+            return
+        try:
+            logger.debug(f"Preparing email: subject='{subject}' to='{NOTIFY_EMAIL}'")
+            msg = MIMEMultipart()
+            msg["From"] = SMTP_USER
+            msg["To"] = NOTIFY_EMAIL
+            msg["Date"] = formatdate(localtime=True)
+            msg["Subject"] = subject
+            msg.attach(MIMEText(html_body, "html"))
+
+            if attachments:
+                for filename, blob in attachments:
+                    logger.debug(f"Attaching file to email: {filename} ({len(blob)} bytes)")
+                    part = MIMEApplication(blob, Name=filename)
+                    part["Content-Disposition"] = f'attachment; filename="{filename}"'
+                    msg.attach(part)
+
+            payload = msg.as_string()
+            try:
+                self._smtp_conn().sendmail(SMTP_USER, NOTIFY_EMAIL, payload)
+            except (smtplib.SMTPServerDisconnected, smtplib.SMTPSenderRefused, OSError):
+                # Server dropped our idle connection; redial once
+                logger.debug("SMTP connection lost; reconnecting")
+                self._close_smtp()
+                self._smtp_conn().sendmail(SMTP_USER, NOTIFY_EMAIL, payload)
+            self._smtp_used = time.monotonic()
+            logger.info(f"Email sent: {subject}")
+        except Exception as e:
+            self._close_smtp()
+            logger.error(f"Email failed: {e}")
+
+    def _send_ntfy(self, title: str, message: str, priority: int = 5, tags: list[str] | None = None):
+        if not NTFY_URL:
+            logger.error("ntfy is not configured (NTFY_URL or NTFY_TOPIC missing). Cannot send notification.")
+            return
+
+        # Sanitise header values to ASCII-safe strings
+        safe_title = _sanitize_http_header_value(title)
+        safe_priority = _sanitize_http_header_value(str(priority))
+        safe_tags = ",".join(tags) if tags else None
+        safe_tags = _sanitize_http_header_value(safe_tags) if safe_tags else None
+
+        headers = {"Title": safe_title, "Priority": safe_priority}
+        if safe_tags:
+            headers["Tags"] = safe_tags
+
+        auth = (NTFY_USERNAME, NTFY_PASSWORD) if (NTFY_USERNAME and NTFY_PASSWORD) else None
+
+        try:
+            hdr_preview = {"Title": headers.get("Title"), "Priority": headers.get("Priority"), "Tags": headers.get("Tags")}
+            logger.debug("Posting to ntfy: url=%s, headers=%s", NTFY_URL, hdr_preview)
+
+            if self._session is None:
+                self._session = requests.Session()
+            # Body can be UTF-8; ntfy handles it
+            r = self._session.post(NTFY_URL, data=message.encode("utf-8"), headers=headers, auth=auth, timeout=15)
+            logger.debug("ntfy response: status=%s, body_snippet='%s'", r.status_code, r.text[:300])
+            if r.status_code // 100 != 2:
+                logger.warning(f"ntfy responded with status {r.status_code}: {r.text[:500]}")
+            else:
+                logger.info(f"ntfy sent: {safe_title}")
+        except Exception as e:
+            logger.error(f"ntfy failed: {e}")
+
+NOTIFIER = NotificationDispatcher()
 
 def notify(level: str, title: str, message: str, details: Dict[str, Any] | None = None,
-           attach_error_log: bool = False, priority: int = 5, tags: list[str] | None = None):
+           attach_error_log: bool = False, priority: int = 5, tags: list[str] | None = None,
+           key: str | None = None):
     """
-    Unified notifier: logs, emails, and ntfy.
+    Unified notifier: logs now, then queues email + ntfy for the background dispatcher.
     - level: 'info' | 'warning' | 'error'
     - All errors are sent to ntfy with priority 5.
+    - key: coalescing key (default level + title); repeats within the digest window are
+      folded into one "N more …" message.
     """
     log_line = f"{title} — {message}"
     if level == "error":
@@ -305,24 +815,796 @@ def notify(level: str, title: str, message: str, details: Dict[str, Any] | None
     else:
         logger.info(log_line)
 
-    html = _format_html(subject=message, heading=title, details=details,
-                        footer=f"Timestamp: {now_str()}")
+    # Email + ntfy for errors/warnings only; info is chatty
+    if level not in ("warning", "error") or not NOTIFY_ENABLED:
+        return
+    NOTIFIER.submit({
+        "key": key or f"{level}:{title}",
+        "level": level,
+        "title": title,
+        "message": message,
+        "details": details,
+        "attach_error_log": attach_error_log,
+        "priority": priority,
+        "tags": tags,
+        "timestamp": now_str(),
+    })
+
+# -------------------- RATE LIMITER --------------------
+def is_quota_error(err: Exception) -> bool:
+    """True for 429 / RESOURCE_EXHAUSTED style errors from the API (or a fake client)."""
+    if getattr(err, "code", None) == 429:
+        return True
+    status = str(getattr(err, "status", "") or "")
+    return "RESOURCE_EXHAUSTED" in status or "RESOURCE_EXHAUSTED" in str(err) or str(err).startswith("429")
+
+_RETRY_IN_RE = re.compile(r"retry in ([0-9.]+)\s*(ms|s)\b", re.IGNORECASE)
+_RETRY_DELAY_RE = re.compile(r"^([0-9.]+)s$")
+
+def retry_after_hint(err: Exception) -> float | None:
+    """
+    Extracts a server-suggested wait (seconds) from an API error:
+    Retry-After header, google.rpc.RetryInfo.retryDelay in the error details, or
+    the "Please retry in 23.4s" text Gemini puts in quota messages.
+    """
+    resp = getattr(err, "response", None)
+    headers = getattr(resp, "headers", None)
+    if headers:
+        try:
+            val = headers.get("Retry-After") or headers.get("retry-after")
+            if val:
+                return max(0.0, float(val))
+        except (TypeError, ValueError):
+            pass
+
+    details = getattr(err, "details", None)
+    if isinstance(details, dict):
+        inner = details.get("error", details)
+        for d in (inner.get("details") or []) if isinstance(inner, dict) else []:
+            if isinstance(d, dict) and str(d.get("@type", "")).endswith("RetryInfo"):
+                m = _RETRY_DELAY_RE.match(str(d.get("retryDelay", "")).strip())
+                if m:
+                    return float(m.group(1))
+
+    m = _RETRY_IN_RE.search(str(err))
+    if m:
+        val = float(m.group(1))
+        return val / 1000.0 if m.group(2).lower() == "ms" else val
+    return None
+
+class AdaptiveLimiter:
+    """
+    Process-wide limiter for one class of API call (generation or upload).
+    - Token bucket caps the request rate at RATE_HEADROOM of the configured RPM.
+    - AIMD window caps concurrency: +1 per window's worth of successes, halved on a 429.
+    - A 429's retry-after hint becomes a shared cooldown, so all workers back off together
+      instead of each call discovering the quota on its own.
+    Only the first 429 from a burst shrinks the window; calls admitted before that
+    decrease just wait out the cooldown.
+    """
+    def __init__(self, name: str, rpm: float, max_concurrency: int, headroom: float = RATE_HEADROOM,
+                 clock: Callable[[], float] = time.monotonic):
+        self.name = name
+        self.rpm = rpm
+        self.headroom_share = headroom
+        self.max_rate = max(rpm, 1.0) / 60.0 * headroom   # tokens per second
+        self.rate = self.max_rate
+        self.burst = float(max(1, max_concurrency))
+        self.tokens = self.burst
+        self.max_limit = float(max(1, max_concurrency))
+        self.limit = self.max_limit
+        self.in_flight = 0
+        self.cooldown_until = 0.0
+        self.throttles = 0
+        self.successes = 0
+        self._clock = clock
+        self._last = clock()
+        self._last_decrease = float("-inf")
+        self._cond = threading.Condition()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def acquire(self) -> float:
+        """Blocks until the call may go out; returns the admission time (used as a ticket)."""
+        with self._cond:
+            while True:
+                check_stop()
+                now = self._clock()
+                self._refill(now)
+                if now < self.cooldown_until:
+                    wait_for = self.cooldown_until - now
+                elif self.in_flight >= int(self.limit):
+                    wait_for = 1.0   # woken by release()
+                elif self.tokens < 1.0:
+                    wait_for = (1.0 - self.tokens) / self.rate
+                else:
+                    self.tokens -= 1.0
+                    self.in_flight += 1
+                    return now
+                self._cond.wait(timeout=min(max(wait_for, 0.01), 1.0))
+
+    def release(self, ticket: float, outcome: str, hint: float | None = None):
+        """outcome: 'ok' | 'throttle' | 'error' (errors other than quota leave the window alone)."""
+        with self._cond:
+            self.in_flight = max(0, self.in_flight - 1)
+            now = self._clock()
+            if outcome == "ok":
+                self.successes += 1
+                self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+                self.rate = min(self.max_rate, self.rate + self.max_rate * 0.02)
+            elif outcome == "throttle":
+                self.throttles += 1
+                cooldown = hint if hint is not None else THROTTLE_COOLDOWN_S
+                self.cooldown_until = max(self.cooldown_until, now + cooldown)
+                if ticket > self._last_decrease:
+                    self._last_decrease = now
+                    self.limit = max(1.0, self.limit * 0.5)
+                    self.rate = max(self.max_rate * 0.1, self.rate * 0.5)
+                    self.tokens = min(self.tokens, 0.0)
+                    logger.warning(f"[{self.name} limiter] quota hit; window={self.limit:.1f}, "
+                                   f"rate={self.rate * 60:.1f}/min, cooldown={cooldown:.1f}s")
+            self._cond.notify_all()
+
+    @contextmanager
+    def slot(self):
+        ticket = self.acquire()
+        outcome, hint = "error", None
+        try:
+            yield
+            outcome = "ok"
+        except Exception as e:
+            if is_quota_error(e):
+                outcome, hint = "throttle", retry_after_hint(e)
+            raise
+        finally:
+            self.release(ticket, outcome, hint)
+
+    def spawn(self, name: str) -> "AdaptiveLimiter":
+        """A fresh limiter with the same ceilings (one per pooled API key)."""
+        return AdaptiveLimiter(name, self.rpm, int(self.max_limit), self.headroom_share, self._clock)
+
+    def headroom(self) -> float:
+        """Free share of the concurrency window plus the share of the bucket left; negative
+        (minus the seconds remaining) while a throttle cooldown is in force."""
+        with self._cond:
+            now = self._clock()
+            self._refill(now)
+            if now < self.cooldown_until:
+                return now - self.cooldown_until
+            return max(0.0, self.limit - self.in_flight) / self.max_limit + self.tokens / self.burst
+
+    def summary(self) -> str:
+        return (f"{self.name}: ok={self.successes}, throttled={self.throttles}, "
+                f"window={self.limit:.1f}/{self.max_limit:.0f}, rate={self.rate * 60:.1f}/{self.max_rate * 60:.1f} per min")
+
+GEN_LIMITER = AdaptiveLimiter("generate", GEN_RPM, GEN_MAX_CONCURRENCY)
+UPLOAD_LIMITER = AdaptiveLimiter("upload", UPLOAD_RPM, UPLOAD_MAX_CONCURRENCY)
+
+# -------------------- CIRCUIT BREAKER --------------------
+_TRANSPORT_ERRORS = (ConnectionError, TimeoutError, requests.exceptions.ConnectionError, requests.exceptions.Timeout)
+
+def is_outage_error(err: Exception) -> bool:
+    """
+    Server-side or transport failure: a 5xx, a call the watchdog gave up on (CallTimeoutError),
+    or a connection/timeout error from the HTTP stack. 429s belong to the limiters and other
+    4xx to the request or key; anything else (a benched key, a bug raising ValueError) says
+    nothing about the API, so none of those count against it.
+    """
+    code = getattr(err, "code", None)
+    if isinstance(code, int):
+        return 500 <= code < 600
+    if isinstance(err, _TRANSPORT_ERRORS):
+        return True
+    # google-genai talks through httpx, which is only importable via the SDK: match by class
+    return any(c.__module__.split(".")[0] in ("httpx", "httpcore")
+               and c.__name__ in ("TransportError", "NetworkError", "TimeoutException", "ProtocolError")
+               for c in type(err).__mro__)
+
+class CircuitBreaker:
+    """
+    Shared breaker for generate calls, so a degraded API costs one probe per interval instead
+    of every prompt's full retry budget.
+    - closed: calls flow; outcomes go into a rolling BREAKER_WINDOW_S window. At least
+      BREAKER_MIN_CALLS calls with BREAKER_ERROR_RATE of them outage errors opens it.
+    - open: every worker blocks in admit() (retries included, so no attempts are burnt).
+    - half_open: after open_s one caller is let through as the canary. Success closes the
+      breaker; failure reopens it with open_s doubled (up to BREAKER_MAX_OPEN_S).
+    Opening and closing each send one notification; per-prompt error alerts are held back
+    while it is not closed.
+    """
+    def __init__(self, window_s: float = BREAKER_WINDOW_S, min_calls: int = BREAKER_MIN_CALLS,
+                 error_rate: float = BREAKER_ERROR_RATE, open_s: float = BREAKER_OPEN_S,
+                 max_open_s: float = BREAKER_MAX_OPEN_S):
+        self.window_s = window_s
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.base_open_s = open_s
+        self.max_open_s = max_open_s
+        self.open_s = open_s
+        self.state = "closed"
+        self.opened_at = 0.0
+        self.tripped_at = 0.0
+        self.trips = 0
+        self.probes = 0
+        self._window = deque()   # (monotonic time, failed)
+        self._canary = False
+        self._cond = threading.Condition()
+
+    def _rate(self, now: float) -> Tuple[int, float]:
+        while self._window and now - self._window[0][0] > self.window_s:
+            self._window.popleft()
+        n = len(self._window)
+        return n, (sum(1 for _, failed in self._window if failed) / n if n else 0.0)
+
+    def admit(self) -> bool:
+        """Blocks while open; returns True if this call is the half-open canary."""
+        with self._cond:
+            while True:
+                check_stop()
+                now = time.monotonic()
+                if self.state == "closed":
+                    return False
+                if self.state == "open" and now - self.opened_at >= self.open_s:
+                    self.state = "half_open"
+                    logger.info("Circuit breaker half-open: probing the API with one canary request")
+                if self.state == "half_open" and not self._canary:
+                    self._canary = True
+                    self.probes += 1
+                    return True
+                wait_for = self.opened_at + self.open_s - now if self.state == "open" else 1.0
+                self._cond.wait(timeout=min(max(wait_for, 0.01), 1.0))
+
+    def record(self, canary: bool, err: Exception | None):
+        failed = err is not None and is_outage_error(err)
+        with self._cond:
+            now = time.monotonic()
+            if isinstance(err, SkuDeadlineError):
+                # Cut short by our own SKU deadline: says nothing about the API
+                if canary:
+                    self._canary = False
+                    self._cond.notify_all()
+                return
+            if canary:
+                self._canary = False
+                if failed:
+                    self.open_s = min(self.max_open_s, self.open_s * 2)
+                    self.state, self.opened_at = "open", now
+                    logger.warning(f"Circuit breaker canary failed ({err.__class__.__name__}: {err}); "
+                                   f"staying open for {self.open_s:.0f}s")
+                else:
+                    self._close(now)
+                self._cond.notify_all()
+                return
+            if self.state != "closed":
+                return   # in flight when it opened; the canary decides
+            self._window.append((now, failed))
+            n, rate = self._rate(now)
+            if failed and n >= self.min_calls and rate >= self.error_rate:
+                self._open(now, n, rate, err)
+
+    def _open(self, now: float, n: int, rate: float, err: Exception):
+        self.state, self.opened_at, self.tripped_at = "open", now, now
+        self.open_s = self.base_open_s
+        self.trips += 1
+        msg = (f"{rate:.0%} of the last {n} generate call(s) failed; all workers paused, "
+               f"probing again in {self.open_s:.0f}s")
+        logger.error(f"Circuit breaker OPEN: {msg} (last error: {err.__class__.__name__}: {err})")
+        append_error({"timestamp": now_str(), "product_code": "n/a", "prompt": "breaker",
+                      "error_code": "circuit_open", "error": f"{msg}; last error: {err}"})
+        notify(
+            level="error",
+            title="Gemini API degraded — workers paused",
+            message=msg,
+            details={"Error rate": f"{rate:.0%}", "Calls in window": n, "Last error": f"{err.__class__.__name__}: {err}"},
+            attach_error_log=True,
+            priority=5,
+            tags=["rotating_light", "electric_plug"],
+            key="error:circuit_open",
+        )
+
+    def _close(self, now: float):
+        paused = now - self.tripped_at
+        self.state = "closed"
+        self.open_s = self.base_open_s
+        self._window.clear()
+        logger.info(f"Circuit breaker closed: canary succeeded after {paused:.0f}s; workers resuming")
+        notify(
+            level="warning",
+            title="Gemini API recovered — workers resumed",
+            message=f"Canary request succeeded after {paused:.0f}s open ({self.probes} probe(s) so far)",
+            details={"Paused for": f"{paused:.0f}s", "Trips this run": self.trips},
+            attach_error_log=False,
+            priority=3,
+            tags=["white_check_mark"],
+            key="warning:circuit_closed",
+        )
+
+    @contextmanager
+    def guard(self):
+        canary = self.admit()
+        try:
+            yield
+        except Exception as e:
+            self.record(canary, e)
+            raise
+        except BaseException:
+            if canary:
+                with self._cond:
+                    self._canary = False
+                    self._cond.notify_all()
+            raise
+        self.record(canary, None)
+
+    def summary(self) -> str:
+        n, rate = self._rate(time.monotonic())
+        return f"breaker: {self.state}, trips={self.trips}, probes={self.probes}, window error rate={rate:.0%} of {n}"
+
+BREAKER = CircuitBreaker()
+
+# -------------------- METRICS --------------------
+# Per-thread tags (sku, prompt, attempt) attached to every API call the thread makes
+_call_ctx = threading.local()
+
+@contextmanager
+def call_context(**fields):
+    saved = {k: getattr(_call_ctx, k, None) for k in fields}
+    for k, v in fields.items():
+        setattr(_call_ctx, k, v)
+    try:
+        yield
+    finally:
+        for k, v in saved.items():
+            setattr(_call_ctx, k, v)
+
+def percentile(values: List[float], q: float) -> float:
+    """Nearest-rank percentile (q in 0..100); 0.0 for an empty list."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(q / 100.0 * len(ordered)) - 1))]
+
+def _parts_bytes(parts) -> int:
+    """Request payload carried inline: prompt text plus any inline image bytes (handles count 0)."""
+    n = 0
+    for p in parts:
+        if isinstance(p, str):
+            n += len(p.encode("utf-8"))
+        else:
+            data = getattr(getattr(p, "inline_data", None), "data", None)
+            n += len(data) if data else 0
+    return n
+
+class CallMetrics:
+    """
+    One JSON line per API call in metrics/<run_id>.jsonl:
+    kind (upload | generate | batch_upload | batch_create | batch_get | batch_download |
+    batch_result), sku, prompt, attempt, wait_s (time queued in the rate limiter), latency_s, outcome (ok | throttle | error | interrupted),
+    error_code, bytes_in/bytes_out, token counts from usage_metadata, est_cost_usd and the
+    pooled key id (key) that served it, and hedge (primary | hedge) for hedged calls. Plus one kind=sku line per generated SKU (record_sku): end-to-end latency,
+    input/cached tokens and estimated cost by ref_strategy (inline | files | cache).
+    In-memory aggregates feed the end-of-run summary and metrics/imagen.prom, a Prometheus
+    textfile rewritten at most every METRICS_PROM_INTERVAL_S (and at close).
+    """
+    def __init__(self, root: str):
+        self.root = root
+        self.run_id = time.strftime("%Y%m%d-%H%M%S") + f"-{os.getpid()}"
+        self.started = time.time()
+        self._f = None
+        self._lock = threading.Lock()
+        self._latencies: Dict[str, List[float]] = {}
+        self._sku_latencies: Dict[str, List[float]] = {}   # ref strategy -> SKU wall times
+        self._sku_usage: Dict[str, List[float]] = {}       # sku -> [prompt tokens, cached tokens, est cost] so far
+        self._sku_totals: Dict[str, List[float]] = {}      # ref strategy -> the same, summed over finished SKUs
+        self._counts: Dict[Tuple[str, str], int] = {}
+        self._tokens = {"prompt": 0, "output": 0, "cached": 0}
+        self.images = 0
+        self.spend = 0.0
+        self._prom_at = 0.0
+
+    @property
+    def path(self) -> str:
+        return os.path.join(self.root, f"{self.run_id}.jsonl")
 
-    attachments = []
-    if attach_error_log and os.path.exists(ERROR_FILE):
+    @staticmethod
+    def estimate_cost(prompt_tokens: int, output_tokens: int, batch: bool = False, cached_tokens: int = 0) -> float:
+        """prompt_tokens includes any cached_tokens, which bill at the cached rate."""
+        cost = ((prompt_tokens - cached_tokens) * PRICE_INPUT_PER_MTOK + cached_tokens * PRICE_CACHED_INPUT_PER_MTOK
+                + output_tokens * PRICE_OUTPUT_PER_MTOK) / 1e6
+        return cost * 0.5 if batch else cost
+
+    @contextmanager
+    def call(self, kind: str, wait_s: float = 0.0, bytes_in: int = 0, key: str | None = None):
+        """Times the body as one API call; the caller may add response fields to the yielded dict."""
+        rec = {
+            "ts": time.time(),
+            "run_id": self.run_id,
+            "kind": kind,
+            "sku": getattr(_call_ctx, "sku", None),
+            "prompt": getattr(_call_ctx, "prompt", None),
+            "attempt": getattr(_call_ctx, "attempt", None) or 1,
+            "wait_s": round(wait_s, 3),
+            "bytes_in": bytes_in,
+            "bytes_out": 0,
+            "outcome": "interrupted",
+        }
+        if key:
+            rec["key"] = key
+        if getattr(_call_ctx, "hedge", None):
+            rec["hedge"] = _call_ctx.hedge
+        t0 = time.monotonic()
         try:
-            with open(ERROR_FILE, "rb") as f:
-                attachments.append((ERROR_FILE, f.read()))
+            yield rec
+            rec["outcome"] = "ok"
         except Exception as e:
-            logger.debug(f"Could not attach {ERROR_FILE}: {e}")
+            rec["outcome"] = "throttle" if is_quota_error(e) else "error"
+            rec["error_code"] = str(getattr(e, "code", None) or e.__class__.__name__)
+            raise
+        finally:
+            rec["latency_s"] = round(time.monotonic() - t0, 3)
+            self.record(rec)
+
+    def note_response(self, rec: Dict, resp):
+        """Adds image bytes, usage_metadata token counts and a cost estimate from a generate response."""
+        for cand in getattr(resp, "candidates", None) or []:
+            for p in getattr(getattr(cand, "content", None), "parts", None) or []:
+                data = getattr(getattr(p, "inline_data", None), "data", None)
+                if data:
+                    rec["bytes_out"] += len(data)
+        usage = getattr(resp, "usage_metadata", None)
+        prompt_tokens = getattr(usage, "prompt_token_count", None) or 0
+        output_tokens = getattr(usage, "candidates_token_count", None) or 0
+        cached_tokens = getattr(usage, "cached_content_token_count", None) or 0
+        if usage is not None:
+            rec["prompt_tokens"] = prompt_tokens
+            rec["output_tokens"] = output_tokens
+            rec["cached_tokens"] = cached_tokens
+            rec["total_tokens"] = getattr(usage, "total_token_count", None) or 0
+        if rec["bytes_out"] and not output_tokens:
+            output_tokens = IMAGE_OUTPUT_TOKENS
+        rec["est_cost_usd"] = round(self.estimate_cost(prompt_tokens, output_tokens, cached_tokens=cached_tokens), 6)
+
+    def record_sku(self, code: str, strategy: str, latency_s: float, outcome: str, prompts: int, inline_bytes: int):
+        """One SKU from reference preparation to its last saved prompt (QC excluded), with the
+        input tokens, cached tokens and estimated cost of every call made for it meanwhile."""
+        with self._lock:
+            prompt_tokens, cached_tokens, cost = self._sku_usage.pop(code, (0, 0, 0.0))
+        self.record({"kind": "sku", "sku": code, "ref_strategy": strategy, "latency_s": round(latency_s, 3),
+                     "outcome": outcome, "prompts": prompts, "inline_bytes": inline_bytes,
+                     "prompt_tokens": prompt_tokens, "cached_tokens": cached_tokens, "est_cost_usd": round(cost, 6)})
+
+    def record(self, rec: Dict):
+        rec.setdefault("ts", time.time())
+        rec.setdefault("run_id", self.run_id)
+        line = json.dumps(rec, ensure_ascii=False) + "\n"
+        with self._lock:
+            if self._f is None:
+                os.makedirs(self.root, exist_ok=True)
+                self._f = open(self.path, "a", encoding="utf-8", buffering=1)
+            self._f.write(line)
+            kind, outcome = rec["kind"], rec.get("outcome", "ok")
+            if kind == "sku":
+                if outcome == "ok":
+                    self._sku_latencies.setdefault(rec["ref_strategy"], []).append(rec["latency_s"])
+                    totals = self._sku_totals.setdefault(rec["ref_strategy"], [0, 0, 0.0])
+                    for i, field in enumerate(("prompt_tokens", "cached_tokens", "est_cost_usd")):
+                        totals[i] += rec[field]
+                return
+            if rec.get("sku") and kind not in ("batch_upload", "batch_result"):
+                usage = self._sku_usage.setdefault(rec["sku"], [0, 0, 0.0])
+                usage[0] += rec.get("prompt_tokens", 0)
+                usage[1] += rec.get("cached_tokens", 0)
+                usage[2] += rec.get("est_cost_usd", 0.0)
+            self._counts[(kind, outcome)] = self._counts.get((kind, outcome), 0) + 1
+            if "latency_s" in rec:
+                self._latencies.setdefault(kind, []).append(rec["latency_s"])
+            self._tokens["prompt"] += rec.get("prompt_tokens", 0)
+            self._tokens["output"] += rec.get("output_tokens", 0)
+            self._tokens["cached"] += rec.get("cached_tokens", 0)
+            self.spend += rec.get("est_cost_usd", 0.0)
+            if rec.get("bytes_out") and outcome == "ok" and kind in ("generate", "batch_result"):
+                self.images += 1
+            if time.monotonic() - self._prom_at >= METRICS_PROM_INTERVAL_S:
+                self._write_prom()
+
+    def _count(self, kind: str, outcome: str | None = None) -> int:
+        return sum(n for (k, o), n in self._counts.items() if k == kind and (outcome is None or o == outcome))
+
+    def _write_prom(self):
+        self._prom_at = time.monotonic()
+        label = f'run_id="{self.run_id}"'
+        lines = ["# HELP imagen_calls_total API calls by kind and outcome.", "# TYPE imagen_calls_total counter"]
+        for (kind, outcome), n in sorted(self._counts.items()):
+            lines.append(f'imagen_calls_total{{{label},kind="{kind}",outcome="{outcome}"}} {n}')
+        lines += ["# HELP imagen_call_latency_seconds API call latency.", "# TYPE imagen_call_latency_seconds summary"]
+        for kind, vals in sorted(self._latencies.items()):
+            for q in (0.5, 0.95, 0.99):
+                lines.append(f'imagen_call_latency_seconds{{{label},kind="{kind}",quantile="{q}"}} {percentile(vals, q * 100):.3f}')
+            lines.append(f'imagen_call_latency_seconds_sum{{{label},kind="{kind}"}} {sum(vals):.3f}')
+            lines.append(f'imagen_call_latency_seconds_count{{{label},kind="{kind}"}} {len(vals)}')
+        lines += ["# HELP imagen_sku_latency_seconds SKU wall time by reference strategy.",
+                  "# TYPE imagen_sku_latency_seconds summary"]
+        for strategy, vals in sorted(self._sku_latencies.items()):
+            for q in (0.5, 0.95):
+                lines.append(f'imagen_sku_latency_seconds{{{label},ref_strategy="{strategy}",quantile="{q}"}} {percentile(vals, q * 100):.3f}')
+            lines.append(f'imagen_sku_latency_seconds_count{{{label},ref_strategy="{strategy}"}} {len(vals)}')
+        lines += ["# HELP imagen_tokens_total Tokens reported by usage_metadata.", "# TYPE imagen_tokens_total counter"]
+        for kind, n in self._tokens.items():
+            lines.append(f'imagen_tokens_total{{{label},type="{kind}"}} {n}')
+        lines += ["# HELP imagen_images_total Images returned by the API.", "# TYPE imagen_images_total counter",
+                  f"imagen_images_total{{{label}}} {self.images}",
+                  "# HELP imagen_estimated_spend_usd Estimated spend this run.", "# TYPE imagen_estimated_spend_usd gauge",
+                  f"imagen_estimated_spend_usd{{{label}}} {self.spend:.4f}"]
+        os.makedirs(self.root, exist_ok=True)
+        tmp = os.path.join(self.root, "imagen.prom.tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp, os.path.join(self.root, "imagen.prom"))
+
+    def summary_lines(self) -> List[str]:
+        with self._lock:
+            hours = max(time.time() - self.started, 1e-9) / 3600.0
+            out = []
+            for kind, vals in sorted(self._latencies.items()):
+                calls, ok = self._count(kind), self._count(kind, "ok")
+                retries = (calls - ok) / ok if ok else 0.0
+                out.append(f"{kind}: {calls} call(s), ok={ok}, throttled={self._count(kind, 'throttle')}, "
+                           f"errors={self._count(kind, 'error')}; latency p50/p95/p99 = "
+                           f"{percentile(vals, 50):.1f}/{percentile(vals, 95):.1f}/{percentile(vals, 99):.1f}s; "
+                           f"retries per success {retries:.2f}")
+            for strategy, vals in sorted(self._sku_latencies.items()):
+                prompt_tokens, cached_tokens, cost = self._sku_totals[strategy]
+                out.append(f"SKUs with {strategy} references: {len(vals)}; wall time p50/p95 = "
+                           f"{percentile(vals, 50):.1f}/{percentile(vals, 95):.1f}s; input tokens per SKU "
+                           f"{prompt_tokens / len(vals):.0f} ({cached_tokens / len(vals):.0f} cached), "
+                           f"estimated ${cost / len(vals):.4f} per SKU")
+            out.append(f"images: {self.images} ({self.images / hours:.0f}/hour); tokens in={self._tokens['prompt']}, "
+                       f"out={self._tokens['output']}, cached={self._tokens['cached']}; estimated spend ${self.spend:.2f}")
+            return out
+
+    def close(self):
+        with self._lock:
+            if self._counts:
+                self._write_prom()
+            if self._f is not None:
+                self._f.close()
+                self._f = None
+
+METRICS = CallMetrics(METRICS_DIR)
+
+# -------------------- DEADLINES --------------------
+class CallTimeoutError(TimeoutError):
+    """An API call overran its timeout and was abandoned by the watchdog (retried like any failure)."""
+
+class SkuDeadlineError(TimeoutError):
+    """The SKU used up SKU_DEADLINE_S; nothing more is attempted for it this run."""
+
+def sku_time_left() -> float | None:
+    deadline = getattr(_call_ctx, "sku_deadline", None)
+    return None if deadline is None else deadline - time.monotonic()
 
-    # Email always for errors/warnings; info is chatty
-    if level in ("warning", "error"):
-        send_email(subject=title, html_body=html, attachments=attachments)
+def check_sku_deadline():
+    left = sku_time_left()
+    if left is not None and left <= 0:
+        raise SkuDeadlineError(f"{getattr(_call_ctx, 'sku', None)} exceeded its {SKU_DEADLINE_S:.0f}s deadline")
 
-    # Always send ntfy for errors; for warnings too for visibility
-    if level in ("warning", "error"):
-        send_ntfy(title=title, message=message, priority=priority, tags=tags or (["rotating_light"] if level == "error" else ["warning"]))
+def run_detached(func: Callable[..., Any], *args) -> Future:
+    """Runs func on a daemon thread with a copy of the caller's call context. Nothing waits for
+    the thread at exit, so an abandoned call can never hold the process open."""
+    ctx = dict(vars(_call_ctx))
+    fut = Future()
+    def run():
+        if not fut.set_running_or_notify_cancel():
+            return
+        with call_context(**ctx):
+            try:
+                fut.set_result(func(*args))
+            except BaseException as e:
+                fut.set_exception(e)
+    threading.Thread(target=run, name=f"call-{ctx.get('sku') or 'run'}", daemon=True).start()
+    return fut
+
+class Watchdog:
+    """
+    Bounds SDK calls, which have no deadline of their own: call() runs the function on a daemon
+    thread and waits in short slices until it returns, its timeout (or the SKU's remaining time)
+    passes, or Ctrl+C has left it SHUTDOWN_GRACE_S to finish. A call past its deadline is
+    abandoned (its thread ends when the SDK's HTTP timeout closes the socket) and surfaces as
+    CallTimeoutError, which retry_call retries; past the SKU deadline it is SkuDeadlineError.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.abandoned: Dict[str, int] = {}
+        self.sku_deadlines = 0
+
+    def _abandon(self, kind: str):
+        with self._lock:
+            self.abandoned[kind] = self.abandoned.get(kind, 0) + 1
+
+    def call(self, kind: str, timeout_s: float, func: Callable[..., Any], *args):
+        check_sku_deadline()
+        left = sku_time_left()
+        sku_bound = left is not None and left < timeout_s
+        if sku_bound:
+            timeout_s = left
+        fut = run_detached(func, *args)
+        end = time.monotonic() + timeout_s
+        stop_at = None
+        while True:
+            wait([fut], timeout=max(0.0, min(0.5, end - time.monotonic())))
+            if fut.done():
+                return fut.result()
+            now = time.monotonic()
+            if STOP_EVENT.is_set():
+                stop_at = stop_at or now
+                if now - stop_at >= SHUTDOWN_GRACE_S:
+                    self._abandon(kind)
+                    logger.info(f"Abandoning an in-flight {kind} call on shutdown")
+                    raise KeyboardInterrupt()
+            if now >= end:
+                self._abandon(kind)
+                if sku_bound:
+                    raise SkuDeadlineError(f"{getattr(_call_ctx, 'sku', None)} exceeded its {SKU_DEADLINE_S:.0f}s "
+                                           f"deadline during a {kind} call")
+                raise CallTimeoutError(f"{kind} call exceeded its {timeout_s:.0f}s timeout and was abandoned")
+
+    def note_sku_deadline(self):
+        with self._lock:
+            self.sku_deadlines += 1
+
+    def summary(self) -> str:
+        calls = ", ".join(f"{n} {kind}" for kind, n in sorted(self.abandoned.items())) or "none"
+        return f"abandoned calls: {calls}; SKUs past their deadline: {self.sku_deadlines}"
+
+WATCHDOG = Watchdog()
+
+# -------------------- HEDGED REQUESTS --------------------
+class Hedger:
+    """
+    Tail-latency hedging for generate calls (--hedge P). Once HEDGE_MIN_SAMPLES latencies have
+    been seen, a call runs on a helper thread; if it hasn't returned the P-th percentile of recent
+    latencies after it went on the wire (limiter waits don't count), a duplicate is fired and the
+    first success is returned.
+    The loser is not cancelled: a call already on the wire can't be aborted through the SDK, so it
+    runs to completion (bounded by the watchdog), still bills, and its response is discarded. Each
+    hedge is charged against the caps when it fires, for the one duplicate call it creates whichever
+    side loses; the loser is tracked until it finishes (counted in `losing`, then in `lost`), and
+    drain() waits for it at the end of a run so its metrics land before they are reported.
+    Hedges stop once they exceed max_share of calls or max_usd of estimated extra spend.
+    """
+    def __init__(self, pct: float = HEDGE_PERCENTILE, min_samples: int = HEDGE_MIN_SAMPLES,
+                 max_share: float = HEDGE_MAX_SHARE, max_usd: float = HEDGE_MAX_USD):
+        self.pct = pct
+        self.min_samples = min_samples
+        self.max_share = max_share
+        self.max_usd = max_usd
+        self._recent = deque(maxlen=200)      # latencies of successful first calls
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.fired = 0
+        self.won = 0
+        self.skipped = 0     # wanted to hedge but a cap said no
+        self.lost = 0        # losing calls that have finished (discarded, but billed)
+        self._losers: set = set()
+
+    def threshold(self) -> float | None:
+        with self._lock:
+            if self.pct <= 0 or len(self._recent) < self.min_samples:
+                return None
+            return percentile(list(self._recent), self.pct)
+
+    def _observe(self, fut, sent: Dict):
+        if sent["at"] is not None and not fut.cancelled() and fut.exception() is None:
+            with self._lock:
+                self._recent.append(time.monotonic() - sent["at"])
+
+    @staticmethod
+    def hedge_cost() -> float:
+        """Estimated cost of one duplicate call (its image output dominates)."""
+        return CallMetrics.estimate_cost(0, IMAGE_OUTPUT_TOKENS)
+
+    def _allow(self) -> bool:
+        with self._lock:
+            over_share = self.fired + 1 > self.max_share * self.calls
+            over_usd = self.max_usd > 0 and (self.fired + 1) * self.hedge_cost() > self.max_usd
+            if over_share or over_usd:
+                self.skipped += 1
+                return False
+            self.fired += 1
+            return True
+
+    @staticmethod
+    def _submit(role: str, func: Callable[..., Any], *args, on_wire: Callable[[], None] | None = None) -> Future:
+        def run():
+            with call_context(hedge=role, on_wire=on_wire):
+                return func(*args), getattr(_call_ctx, "model", None)
+        return run_detached(run)
+
+    def call(self, func: Callable[..., Any], *args):
+        with self._lock:
+            self.calls += 1
+        delay = self.threshold()
+        sent = {"at": None}
+        def on_wire():
+            sent["at"] = time.monotonic()
+        if delay is None:
+            with call_context(on_wire=on_wire):
+                result = func(*args)
+            if sent["at"] is not None:
+                with self._lock:
+                    self._recent.append(time.monotonic() - sent["at"])
+            return result
+        on_air = threading.Event()
+        def primary_on_wire():
+            on_wire()
+            on_air.set()
+        first = self._submit("primary", func, *args, on_wire=primary_on_wire)
+        first.add_done_callback(lambda f: (self._observe(f, sent), on_air.set()))
+        while not on_air.wait(0.5):
+            check_stop()
+        futures = [first]
+        fire_at = time.monotonic() + delay
+        while not first.done() and time.monotonic() < fire_at:
+            wait(futures, timeout=max(0.0, min(0.5, fire_at - time.monotonic())))
+        if not first.done():
+            check_stop()
+            if self._allow():
+                logger.debug(f"Hedging {getattr(_call_ctx, 'sku', None)}/{getattr(_call_ctx, 'prompt', None)} "
+                             f"after {delay:.1f}s (p{self.pct:g} of recent calls)")
+                futures.append(self._submit("hedge", func, *args))
+        last_exc = None
+        while futures:
+            # Short timeout keeps Ctrl+C responsive; each call is bounded by the watchdog
+            done, pending = wait(futures, timeout=0.5, return_when=FIRST_COMPLETED)
+            for fut in done:
+                if fut.exception() is None:
+                    for other in pending:
+                        self._track_loser(other)
+                    if fut is not first:
+                        with self._lock:
+                            self.won += 1
+                    result, model = fut.result()
+                    _call_ctx.model = model
+                    return result
+                last_exc = fut.exception()
+            futures = list(pending)
+        raise last_exc
+
+    def _track_loser(self, fut: Future):
+        if fut.cancel():
+            return   # never started, so never billed
+        with self._lock:
+            self._losers.add(fut)
+        def finished(f):
+            with self._lock:
+                self._losers.discard(f)
+                self.lost += 1
+        fut.add_done_callback(finished)
+
+    @property
+    def losing(self) -> int:
+        """Losing calls still running."""
+        with self._lock:
+            return len(self._losers)
+
+    def drain(self, timeout: float | None = None):
+        """Waits for losing calls still on the wire (end of a run), so their metrics are recorded."""
+        with self._lock:
+            pending = list(self._losers)
+        if pending:
+            logger.info(f"Waiting for {len(pending)} losing hedge call(s) to finish …")
+            wait(pending, timeout=timeout)
+
+    def summary(self) -> str:
+        delay = self.threshold()
+        at = f"p{self.pct:g} of recent calls = {delay:.1f}s" if delay is not None else f"p{self.pct:g}, warming up"
+        still = f" ({self.losing} still running)" if self.losing else ""
+        return (f"fired {self.fired} of {self.calls} call(s) ({at}), won {self.won}, capped {self.skipped}; "
+                f"{self.lost} losing call(s) discarded{still}; estimated extra spend up to "
+                f"${self.fired * self.hedge_cost():.2f}")
+
+HEDGER = Hedger()
 
 # -------------------- RETRY HELPER --------------------
 def retry_call(func: Callable[..., Any], *args, **kwargs):
@@ -338,18 +1620,33 @@ def retry_call(func: Callable[..., Any], *args, **kwargs):
     for attempt in range(1, attempts + 1):
         try:
             logger.debug(f"Attempt {attempt}/{attempts} for {getattr(func,'__name__',str(func))}")
+            check_sku_deadline()
+            _call_ctx.attempt = attempt
             return func(*args, **kwargs)
         except KeyboardInterrupt:
             logger.debug("KeyboardInterrupt caught inside retry_call; re-raising immediately")
             raise
         except Exception as e:
             last_exc = e
+            if isinstance(e, SkuDeadlineError):
+                raise
+            if is_stale_file_error(e):
+                logger.debug("Referenced file rejected by API; not retrying with the same handles")
+                raise
             if attempt == attempts:
                 break
+            if is_quota_error(e):
+                # The shared limiter already holds every worker for the retry-after window
+                logger.warning(f"{getattr(func,'__name__',str(func))} throttled (attempt {attempt}/{attempts}): {e}. Waiting on shared limiter …")
+                continue
             jitter = random.uniform(0.7, 1.3)
             sleep_for = min(delay * jitter, RETRY_MAX_DELAY_S)
+            left = sku_time_left()
+            if left is not None and left < sleep_for:
+                raise SkuDeadlineError(f"{getattr(_call_ctx, 'sku', None)} has {max(left, 0):.0f}s of its "
+                                       f"{SKU_DEADLINE_S:.0f}s deadline left; not retrying after: {e}") from e
             logger.warning(f"{getattr(func,'__name__',str(func))} failed (attempt {attempt}/{attempts}): {e.__class__.__name__}: {e}. Retrying in {sleep_for:.1f}s …")
-            time.sleep(sleep_for)
+            sleep_unless_stopped(sleep_for)
             delay = min(delay * 2, RETRY_MAX_DELAY_S)
 
     logger.debug("All retry attempts exhausted; re-raising last exception")
@@ -360,6 +1657,54 @@ def is_square(img: Image.Image) -> bool:
     w, h = img.size
     return w == h
 
+def qc_image(path: str, white_background: bool) -> Dict:
+    """
+    Vectorised QC on a downsampled decode (runs in a QC worker process).
+    Checks: square, blank/near-uniform frame, and for white-background shots the share of
+    pure-white border pixels and the product's margin to the frame edges.
+    """
+    with Image.open(path) as img:
+        w, h = img.size
+        square = is_square(img)
+        img.draft("RGB", (QC_SAMPLE_PX, QC_SAMPLE_PX))   # JPEG: DCT-domain downscale
+        factor = max(1, min(img.size) // QC_SAMPLE_PX)
+        small = img.convert("RGB")
+        if factor > 1:
+            small = small.reduce(factor)
+        a = np.asarray(small, dtype=np.uint8)
+
+    failures = []
+    if not square:
+        failures.append("not_square")
+    lum = a @ np.array([0.299, 0.587, 0.114], dtype=np.float32)
+    std = float(lum.std())
+    if std < QC_MIN_STD:
+        failures.append("blank_frame")
+
+    result = {"path": path, "size": [w, h], "lum_std": round(std, 2)}
+    if white_background and "blank_frame" not in failures:
+        white = (a >= QC_WHITE_MIN).all(axis=2)
+        H, W = white.shape
+        b = max(1, int(round(min(H, W) * QC_BORDER_FRAC)))
+        border = np.concatenate([white[:b].ravel(), white[-b:].ravel(),
+                                 white[b:-b, :b].ravel(), white[b:-b, -b:].ravel()])
+        border_white = float(border.mean())
+        rows = np.flatnonzero(~white.all(axis=1))
+        cols = np.flatnonzero(~white.all(axis=0))
+        if rows.size:
+            margin = min(rows[0] / H, (H - 1 - rows[-1]) / H, cols[0] / W, (W - 1 - cols[-1]) / W)
+        else:
+            margin = 0.5
+        result.update(border_white=round(border_white, 4), margin=round(float(margin), 4))
+        if border_white < QC_MIN_BORDER_WHITE:
+            failures.append("background_not_white")
+        if margin < QC_MIN_MARGIN:
+            failures.append("product_margin")
+
+    result["failures"] = failures
+    result["ok"] = not failures
+    return result
+
 def mime_to_ext(mime: str) -> str:
     if not mime:
         return ".png"
@@ -372,127 +1717,1156 @@ def mime_to_ext(mime: str) -> str:
         return ".png"
     return ".png"
 
-# -------------------- GEMINI INTEGRATION --------------------
-def _upload_single_file(path: str):
-    logger.debug(f"Uploading single reference file: {path}")
-    return client.files.upload(file=path)
+def ext_to_mime(ext: str) -> str:
+    return {".jpg": "image/jpeg", ".jpeg": "image/jpeg", ".webp": "image/webp"}.get(ext.lower(), "image/png")
 
-def upload_references(folder_path: str) -> List[types.File]:
-    logger.debug(f"Uploading references from: {folder_path}")
-    files = sorted([f for f in os.listdir(folder_path) if f.lower().endswith((".jpg", ".jpeg"))])
-    logger.debug(f"Found {len(files)} JPG/JPEG references: {files}")
-    if len(files) == 0:
-        raise ValueError(f"No JPG references found in {folder_path}")
-    if len(files) > MAX_REF_IMAGES:
-        msg = f"Folder '{folder_path}' has {len(files)} images; max allowed is {MAX_REF_IMAGES}"
-        logger.warning(msg)
-        notify(
-            level="warning",
-            title="Too many reference images",
-            message=msg,
-            details={"Folder": folder_path, "Max allowed": MAX_REF_IMAGES, "Found": len(files)},
-            attach_error_log=False,
-            priority=4,
-            tags=["warning"]
-        )
-        raise ValueError(msg)
+# -------------------- REFERENCE UPLOAD CACHE --------------------
+_sha_memo: Dict[str, Tuple[int, int, str]] = {}   # path -> (size, mtime_ns, sha256)
 
-    uploaded = []
-    for fname in files:
-        path = os.path.join(folder_path, fname)
-        # Retry each upload individually
-        fobj = retry_call(_upload_single_file, path)
-        uploaded.append(fobj)
-        logger.debug(f"Uploaded: {fname} -> id={getattr(fobj,'name',None) or getattr(fobj,'uri',None)}")
-        time.sleep(0.2)
-    logger.info(f"Uploaded {len(uploaded)} references from {folder_path}")
-    return uploaded
+def file_sha256(path: str) -> str:
+    """Content hash, memoised per (path, size, mtime) so repeated lookups cost one stat."""
+    st = os.stat(path)
+    memo = _sha_memo.get(path)
+    if memo and memo[0] == st.st_size and memo[1] == st.st_mtime_ns:
+        return memo[2]
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    _sha_memo[path] = (st.st_size, st.st_mtime_ns, h.hexdigest())
+    return h.hexdigest()
 
-def _generate(model: str, parts, cfg):
-    logger.debug(f"Calling models.generate_content(model={model}, parts_len={len(parts)})")
-    return client.models.generate_content(
-        model=model,
-        contents=parts,
-        config=cfg,
-    )
+def _expiry_epoch(fobj) -> float:
+    exp = getattr(fobj, "expiration_time", None)
+    if exp is not None:
+        try:
+            return exp.timestamp()
+        except Exception:
+            pass
+    return time.time() + UPLOAD_TTL_S
 
-def generate_one_image(prompt: str, refs: List[types.File]) -> Tuple[bytes, str]:
-    logger.debug(f"Generating image with {len(refs)} reference(s); aspect={ASPECT_RATIO}; modalities={RESP_MODALITIES}")
-    parts = [prompt]
-    parts.extend(refs)
+def api_key_id(api_key: str) -> str:
+    """Short, loggable id for an API key (uploaded files belong to the key's project)."""
+    return "key-" + hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:8]
 
-    cfg = types.GenerateContentConfig(
-        response_modalities=RESP_MODALITIES,
-        image_config=types.ImageConfig(aspect_ratio=ASPECT_RATIO)
-    )
+class UploadCache:
+    """
+    Append-only JSONL index: (key_id, sha256) -> {name, uri, mime_type, expires_at}.
+    Files are only visible to the project of the key that uploaded them, so each pooled key
+    has its own entries; lines written before the key pool existed belong to GEMINI_API_KEY.
+    Last line for a (key_id, hash) wins; {"sha256": ..., "key_id": ..., "invalid": true} drops
+    an entry. Expired entries are dropped (and the file compacted) when the index is loaded.
+    Several processes may share the file, so appends and the compacting rewrite both hold
+    <path>.lock (O_CREAT|O_EXCL): a line appended while another process compacts is either
+    in the rewrite or lands after it, never in the replaced file. Compaction is skipped when
+    the lock is busy; a lock older than LOCK_STALE_S was left by a crashed process.
+    """
+    LOCK_STALE_S = 30.0
 
-    resp = retry_call(_generate, MODEL, parts, cfg)
+    def __init__(self, path: str):
+        self.path = path
+        self.lock_path = path + ".lock"
+        self._entries: Dict[str, Dict] = {}
+        self._by_name: Dict[str, str] = {}
+        self._loaded = False
+        self._lock = threading.Lock()
 
-    # Log some response metadata if present
-    cand_count = len(getattr(resp, "candidates", []) or [])
-    logger.debug(f"Generation response candidates: {cand_count}")
+    @contextmanager
+    def _file_lock(self, wait: bool = True):
+        """Holds <path>.lock; yields False (without the lock) when wait=False and it is busy."""
+        while True:
+            try:
+                fd = os.open(self.lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                break
+            except FileExistsError:
+                try:
+                    if time.time() - os.stat(self.lock_path).st_mtime > self.LOCK_STALE_S:
+                        logger.warning(f"Removing stale upload cache lock {self.lock_path}")
+                        os.remove(self.lock_path)
+                        continue
+                except FileNotFoundError:
+                    continue
+                if not wait:
+                    yield False
+                    return
+                time.sleep(0.01)
+        try:
+            os.close(fd)
+            yield True
+        finally:
+            try:
+                os.remove(self.lock_path)
+            except FileNotFoundError:
+                pass
 
-    for cand_idx, cand in enumerate(getattr(resp, "candidates", [])):
-        if not getattr(cand, "content", None):
-            logger.debug(f"Candidate {cand_idx} has no content")
-            continue
-        for part_idx, p in enumerate(getattr(cand.content, "parts", [])):
-            if getattr(p, "inline_data", None) and getattr(p.inline_data, "data", None):
-                mime = getattr(p.inline_data, "mime_type", "image/png")
-                logger.debug(f"Found inline_data in candidate {cand_idx}, part {part_idx}, mime={mime}")
-                return p.inline_data.data, mime
+    def _read(self) -> Tuple[int, Dict[str, Dict]]:
+        """(line count, live entries) as the file stands now."""
+        entries: Dict[str, Dict] = {}
+        lines = 0
+        legacy_id = api_key_id(GEMINI_API_KEY or "")
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                lines += 1
+                try:
+                    e = json.loads(line)
+                except ValueError:
+                    continue
+                e.setdefault("key_id", legacy_id)
+                if e.get("invalid"):
+                    entries.pop(f"{e['key_id']}:{e.get('sha256')}", None)
+                else:
+                    entries[f"{e['key_id']}:{e['sha256']}"] = e
+        now = time.time()
+        return lines, {k: v for k, v in entries.items() if v.get("expires_at", 0) > now}
 
-    # If we got here, treat as a retryable failure from our caller
-    raise RuntimeError("No image bytes returned from API")
+    def _load(self):
+        if self._loaded:
+            return
+        self._loaded = True
+        if not os.path.exists(self.path):
+            return
+        lines, self._entries = self._read()
+        if lines > len(self._entries):
+            with self._file_lock(wait=False) as locked:
+                if locked:
+                    # Re-read under the lock: other processes may have appended since
+                    lines, self._entries = self._read()
+                    tmp = f"{self.path}.tmp-{os.getpid()}"
+                    with open(tmp, "w", encoding="utf-8") as f:
+                        for e in self._entries.values():
+                            f.write(json.dumps(e) + "\n")
+                    os.replace(tmp, self.path)
+        self._by_name = {v["name"]: k for k, v in self._entries.items()}
+        logger.debug(f"Upload cache loaded: {len(self._entries)} live entr(ies) from {lines} line(s)")
 
-# -------------------- STATE (COMPLETED SKUs ONLY) --------------------
-def load_completed_skus() -> set:
-    state = load_json(STATE_FILE, {"completed_skus": []})
-    comps = set(state.get("completed_skus", []))
-    logger.debug(f"Loaded completed SKUs: {sorted(list(comps))}")
-    return comps
+    def _append(self, entry: Dict):
+        with self._file_lock():
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry) + "\n")
 
-def mark_sku_complete(product_code: str):
-    logger.debug(f"Marking SKU complete: {product_code}")
-    state = load_json(STATE_FILE, {"completed_skus": []})
-    comps = set(state.get("completed_skus", []))
-    comps.add(product_code)
-    state["completed_skus"] = sorted(comps)
-    save_json(STATE_FILE, state)
+    def get(self, sha: str, key_id: str, min_ttl_s: float = UPLOAD_EXPIRY_MARGIN_S):
+        with self._lock:
+            self._load()
+            e = self._entries.get(f"{key_id}:{sha}")
+            if not e or e["expires_at"] - time.time() < min_ttl_s:
+                return None
+            return get_client().file_handle(e["name"], e["uri"], e["mime_type"])
 
-# -------------------- UTILS --------------------
-def find_folder_for_code(code: str) -> str | None:
-    logger.debug(f"Searching reference folder for code prefix: {code}")
-    for name in os.listdir(REFERENCE_ROOT):
-        if name.startswith(code):
-            full = os.path.join(REFERENCE_ROOT, name)
-            if os.path.isdir(full):
-                logger.debug(f"Matched folder '{name}' for code '{code}' -> {full}")
-                return full
-    logger.debug(f"No reference folder found for code '{code}'")
-    return None
+    def put(self, sha: str, key_id: str, fobj, source: str):
+        entry = {
+            "sha256": sha,
+            "key_id": key_id,
+            "name": getattr(fobj, "name", None),
+            "uri": getattr(fobj, "uri", None),
+            "mime_type": getattr(fobj, "mime_type", None) or "image/jpeg",
+            "expires_at": _expiry_epoch(fobj),
+            "uploaded_at": time.time(),
+            "source": source,
+        }
+        with self._lock:
+            self._load()
+            self._entries[f"{key_id}:{sha}"] = entry
+            self._by_name[entry["name"]] = f"{key_id}:{sha}"
+            self._append(entry)
 
-def capture_trace() -> str:
-    return "".join(traceback.format_exc())
+    def invalidate_name(self, name: str):
+        with self._lock:
+            self._load()
+            ck = self._by_name.pop(name, None)
+            e = self._entries.pop(ck, None) if ck else None
+            if e:
+                self._append({"sha256": e["sha256"], "key_id": e["key_id"], "invalid": True})
+                logger.debug(f"Upload cache: invalidated {name}")
 
-def record_and_notify_error(product_code: str, prompt_key: str, error_code: str, err: Exception, extra: Dict[str, Any] | None = None, pause_on_error: bool = False):
-    tb = capture_trace()
-    entry = {
-        "timestamp": now_str(),
-        "product_code": product_code,
-        "prompt": prompt_key,
-        "error_code": error_code,
-        "error_type": err.__class__.__name__,
-        "error": str(err),
-        "traceback": tb,
-    }
-    if extra:
-        entry["meta"] = extra
-    append_error(entry)
+UPLOAD_CACHE = UploadCache(UPLOAD_CACHE_FILE)
+_refresh_lock = threading.Lock()
 
-    title = f"CRITICAL ERROR — {product_code} / {prompt_key} [{error_code}]"
-    message = f"{err.__class__.__name__}: {err}"
-    details = {
+def is_stale_file_error(err: Exception) -> bool:
+    """A generate call rejected because a referenced File or cached context is gone, expired
+    or not ours (or belongs to a benched pooled key while another key is live)."""
+    if isinstance(err, KeyBenchedError):
+        return True
+    if getattr(err, "code", None) not in (400, 403, 404):
+        return False
+    text = str(err).lower()
+    return (("file" in text or "cachedcontent" in text.replace(" ", "").replace("_", ""))
+            and any(w in text for w in ("not exist", "not found", "expired", "permission")))
+
+def refresh_references(folder_path: str, refs: List[FileHandle], seen: List[FileHandle] | None = None,
+                       invalidate: bool = True):
+    """
+    Drops the cached handles in `refs` and re-uploads the folder, replacing the list
+    contents in place so every prompt thread sharing it picks up the new handles.
+    `seen`: the handles the failed call used; if another thread has already replaced them
+    there is nothing to do. invalidate=False keeps the old handles in the upload cache (they
+    are fine, just pinned to a benched key).
+    """
+    with _refresh_lock:
+        if seen is not None and refs != seen:
+            return
+        for fobj in list(refs):
+            if isinstance(fobj, ReferenceContext):
+                fobj.close()
+                if invalidate:
+                    for part in fobj.parts:
+                        UPLOAD_CACHE.invalidate_name(getattr(part, "name", None))
+            elif invalidate:
+                UPLOAD_CACHE.invalidate_name(getattr(fobj, "name", None))
+        refs[:] = sku_references(folder_path)
+
+# -------------------- REFERENCE DERIVATIVES --------------------
+def reference_transform_tag() -> str:
+    """Parameters of the pre-upload transform ('' when originals are uploaded)."""
+    return f"edge{REF_MAX_EDGE_PX}-q{REF_JPEG_QUALITY}" if REF_MAX_EDGE_PX > 0 else ""
+
+def prepare_reference(path: str) -> str:
+    """
+    Path of the file to upload for reference `path`. With REF_MAX_EDGE_PX set this is a copy with
+    EXIF orientation applied, the long edge capped at REF_MAX_EDGE_PX and everything but the ICC
+    profile dropped, re-encoded at REF_JPEG_QUALITY. Derivatives are stored as
+    REF_CACHE_DIR/<key[:2]>/<key>.jpg, keyed by source hash and parameters, so each is built once.
+    A source already within the edge cap and upright is returned as-is rather than re-encoded
+    (a second lossy pass for nothing), as is one that fails to decode (its upload reports it).
+    """
+    tag = reference_transform_tag()
+    if not tag:
+        return path
+    key = hashlib.sha256(f"{file_sha256(path)}\0{tag}".encode("utf-8")).hexdigest()
+    out = os.path.join(REF_CACHE_DIR, key[:2], key + ".jpg")
+    if os.path.exists(out):
+        return out
+    try:
+        with Image.open(path) as img:
+            scale = min(1.0, REF_MAX_EDGE_PX / max(img.size))
+            if scale == 1.0 and img.getexif().get(0x0112, 1) == 1:   # EXIF Orientation: normal
+                return path
+            # JPEG draft mode decodes straight at 1/2, 1/4 or 1/8 scale while staying >= the target
+            img.draft("RGB", (math.ceil(img.width * scale), math.ceil(img.height * scale)))
+            icc = img.info.get("icc_profile")
+            derived = ImageOps.exif_transpose(img).convert("RGB")
+        derived.thumbnail((REF_MAX_EDGE_PX, REF_MAX_EDGE_PX), Image.LANCZOS)
+        buf = io.BytesIO()
+        derived.save(buf, "JPEG", quality=REF_JPEG_QUALITY, optimize=True, icc_profile=icc)
+    except Exception as e:
+        logger.warning(f"Could not downscale {path} ({e.__class__.__name__}: {e}); uploading the original")
+        return path
+    os.makedirs(os.path.dirname(out), exist_ok=True)
+    tmp = f"{out}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(buf.getvalue())
+    os.replace(tmp, out)
+    logger.debug(f"Reference derivative for {os.path.basename(path)}: {os.path.getsize(path) / 1e6:.2f} MB -> "
+                 f"{buf.tell() / 1e6:.2f} MB ({derived.width}x{derived.height})")
+    return out
+
+# -------------------- REFERENCE SELECTION --------------------
+_selection_memo: Dict[str, Tuple[Tuple, List[str]]] = {}   # folder -> (listing signature, chosen paths)
+
+def reference_features(path: str) -> Dict | None:
+    """
+    Selection features from a REF_SELECT_PX decode: a 64-bit dHash, sharpness (variance of the
+    Laplacian of the grayscale image scaled to unit contrast, so a dim shot isn't taken for a soft
+    one), a 4x4x4 colour histogram and an 8-bin gradient-orientation histogram weighted by edge
+    strength. None if the file doesn't decode.
+    """
+    n = REF_SELECT_PX
+    try:
+        with Image.open(path) as img:
+            img.draft("RGB", (n, n))   # JPEG: DCT-domain downscale
+            small = ImageOps.exif_transpose(img).convert("RGB").resize((n, n), Image.BILINEAR)
+        a = np.asarray(small, dtype=np.float32)
+    except Exception as e:
+        logger.debug(f"Could not read {path} for reference selection: {e}")
+        return None
+    gray = a @ np.array([0.299, 0.587, 0.114], dtype=np.float32)
+    # dHash: 8x9 block means, each compared with its right-hand neighbour
+    cells = gray[: n // 8 * 8, : n // 9 * 9].reshape(8, n // 8, 9, n // 9).mean(axis=(1, 3))
+    dhash = (cells[:, 1:] > cells[:, :-1]).ravel()
+    norm = (gray - gray.mean()) / max(float(gray.std()), 1e-6)
+    lap = 4 * norm[1:-1, 1:-1] - norm[:-2, 1:-1] - norm[2:, 1:-1] - norm[1:-1, :-2] - norm[1:-1, 2:]
+    gy, gx = np.gradient(gray)
+    mag = np.hypot(gx, gy)
+    angle = np.arctan2(gy, gx) % np.pi
+    edges = np.bincount(np.minimum((angle * (8 / np.pi)).astype(int), 7).ravel(),
+                        weights=mag.ravel(), minlength=8)
+    q = (a // 64).astype(int)
+    colour = np.bincount((q[..., 0] * 16 + q[..., 1] * 4 + q[..., 2]).ravel(), minlength=64)
+    return {"dhash": dhash, "sharpness": float(lap.var()),
+            "colour": colour / colour.sum(), "edges": edges / max(float(edges.sum()), 1e-9)}
+
+def select_references(paths: List[str], k: int = MAX_REF_IMAGES) -> Tuple[List[str], Dict[str, str]]:
+    """
+    Picks at most k of `paths`. Unreadable and blurry shots (sharpness under REF_MIN_SHARPNESS of
+    the folder's median) and near-duplicates (dHash within REF_DUP_BITS of a sharper shot) are dropped;
+    the rest are chosen farthest-point first on colour + edge-orientation histograms, starting
+    from the sharpest, so the set spans as many distinct views as it can. Each candidate's distance
+    is scaled by its sharpness relative to the median (capped at 1): blur also makes a shot look
+    "distinct", and must not let a soft near-copy win over its sharp twin.
+    Returns the chosen paths in upload (name) order and {path: reason} for those left out.
+    """
+    with ThreadPoolExecutor(max_workers=min(8, len(paths)), thread_name_prefix="ref-select") as pool:
+        feats = list(pool.map(reference_features, paths))
+    ok = [i for i, f in enumerate(feats) if f is not None]
+    if not ok:
+        # Nothing decodes; the upload reports the actual problem
+        return paths[:k], {p: "over the limit" for p in paths[k:]}
+    dropped = {p: "unreadable" for p, f in zip(paths, feats) if f is None}
+    sharp = np.array([feats[i]["sharpness"] for i in ok])
+    hashes = np.stack([feats[i]["dhash"] for i in ok])
+    vecs = np.stack([np.concatenate([feats[i]["colour"], feats[i]["edges"]]) for i in ok])
+    hamming = (hashes[:, None, :] != hashes[None, :, :]).sum(axis=2)
+
+    order = np.argsort(-sharp, kind="stable")
+    typical = float(np.median(sharp))
+    keep: List[int] = []
+    for j in order:
+        if keep and sharp[j] < REF_MIN_SHARPNESS * typical:
+            dropped[paths[ok[j]]] = f"blurry ({sharp[j] / typical:.0%} of the folder's median sharpness)"
+        elif keep and hamming[j, keep].min() <= REF_DUP_BITS:
+            twin = keep[int(np.argmin(hamming[j, keep]))]
+            dropped[paths[ok[j]]] = f"near-duplicate of {os.path.basename(paths[ok[twin]])}"
+        else:
+            keep.append(int(j))
+
+    # Farthest-point: each pick is the sharpness-weighted candidate furthest (L1) from its
+    # nearest chosen reference
+    dist = np.abs(vecs[keep][:, None, :] - vecs[keep][None, :, :]).sum(axis=2)
+    quality = np.minimum(1.0, sharp[keep] / max(typical, 1e-12))
+    chosen = [0]
+    nearest = dist[0].copy()
+    while len(chosen) < min(k, len(keep)):
+        score = nearest * quality
+        score[chosen] = -np.inf
+        nxt = int(np.argmax(score))
+        chosen.append(nxt)
+        nearest = np.minimum(nearest, dist[nxt])
+    picked = {paths[ok[keep[c]]] for c in chosen}
+    for c in range(len(keep)):
+        if c not in chosen:
+            dropped[paths[ok[keep[c]]]] = "less distinct than the chosen set"
+    return [p for p in paths if p in picked], dropped
+
+def sku_reference_paths(folder_path: str) -> List[str]:
+    """
+    The references a SKU is generated against: the folder's JPGs, or when there are more than
+    MAX_REF_IMAGES the subset select_references() picks. The choice is memoised per folder
+    listing (names, sizes, mtimes), so it is computed and logged once.
+    """
+    paths = reference_paths(folder_path)
+    if len(paths) <= MAX_REF_IMAGES:
+        return paths
+    sig = tuple((p, st.st_size, st.st_mtime_ns) for p, st in ((p, os.stat(p)) for p in paths))
+    memo = _selection_memo.get(folder_path)
+    if memo and memo[0] == sig:
+        return list(memo[1])
+    t0 = time.monotonic()
+    chosen, dropped = select_references(paths)
+    _selection_memo[folder_path] = (sig, chosen)
+    logger.info(f"{folder_path} has {len(paths)} JPGs (max {MAX_REF_IMAGES}); selected {len(chosen)} in "
+                f"{time.monotonic() - t0:.2f}s: {', '.join(os.path.basename(p) for p in chosen)}")
+    for p, why in dropped.items():
+        logger.info(f"  left out {os.path.basename(p)}: {why}")
+    return chosen
+
+# -------------------- RESULT CACHE --------------------
+def result_cache_key(prompt: str, folder: str, model: str = MODEL) -> str:
+    """Hash of everything that determines the output: model, aspect ratio, prompt text, the
+    content (not names) of the folder's reference images in upload order, and the reference
+    transform when derivatives are uploaded."""
+    h = hashlib.sha256()
+    parts = [model, ASPECT_RATIO, prompt] + [file_sha256(p) for p in sku_reference_paths(folder)]
+    if reference_transform_tag():
+        parts.append(reference_transform_tag())
+    for part in parts:
+        h.update(part.encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+class ResultCache:
+    """
+    Content-addressed store of generated images: <root>/<key[:2]>/<key><ext>.
+    - get() touches the file's mtime; once the cache grows past max_bytes the least recently
+      used files are evicted down to 90% of it.
+    - lookups=False (--no-cache) skips reads but still stores fresh results.
+    - Images enter through QC: admit() once it accepts one, discard() if it rejects a served one.
+    The directory is scanned once, on first use.
+    """
+    def __init__(self, root: str, max_bytes: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.lookups = True
+        self._entries: Dict[str, List] | None = None   # key -> [path, size, mtime]
+        self._total = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+
+    def _load(self):
+        if self._entries is not None:
+            return
+        self._entries = {}
+        if not os.path.isdir(self.root):
+            return
+        for sub in os.scandir(self.root):
+            if not sub.is_dir():
+                continue
+            for e in os.scandir(sub.path):
+                key, ext = os.path.splitext(e.name)
+                if ext == ".tmp":
+                    continue
+                st = e.stat()
+                self._entries[key] = [e.path, st.st_size, st.st_mtime]
+                self._total += st.st_size
+        logger.debug(f"Result cache loaded: {len(self._entries)} image(s), {self._total / 1e6:.1f} MB")
+
+    def _drop(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry:
+            self._total -= entry[1]
+            try:
+                os.remove(entry[0])
+            except OSError:
+                pass
+
+    def _evict(self):
+        target = self.max_bytes * 0.9
+        for key, _ in sorted(self._entries.items(), key=lambda kv: kv[1][2]):
+            if self._total <= target:
+                break
+            self._drop(key)
+            self.evicted += 1
+
+    def has(self, key: str) -> bool:
+        """Whether get() would hit (no read, no hit/miss counted)."""
+        if not self.lookups:
+            return False
+        with self._lock:
+            self._load()
+            return key in self._entries
+
+    def get(self, key: str) -> Tuple[bytes, str] | None:
+        if not self.lookups:
+            return None
+        with self._lock:
+            self._load()
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            try:
+                with open(entry[0], "rb") as f:
+                    data = f.read()
+                now = time.time()
+                os.utime(entry[0], (now, now))
+                entry[2] = now
+            except OSError:
+                self._entries.pop(key, None)
+                self._total -= entry[1]
+                self.misses += 1
+                return None
+            self.hits += 1
+            return data, ext_to_mime(os.path.splitext(entry[0])[1])
+
+    def put(self, key: str, data: bytes, mime: str):
+        if self.max_bytes <= 0:
+            return
+        path = os.path.join(self.root, key[:2], key + mime_to_ext(mime))
+        with self._lock:
+            self._load()
+            if key in self._entries:
+                self._drop(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = path + ".tmp"
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+            self._entries[key] = [path, len(data), time.time()]
+            self._total += len(data)
+            if self._total > self.max_bytes:
+                self._evict()
+
+    def admit(self, key: str, path: str, mime: str):
+        """Stores the image at `path` under `key` unless it is already there (QC accepted it)."""
+        with self._lock:
+            self._load()
+            if key in self._entries:
+                return
+        with open(path, "rb") as f:
+            self.put(key, f.read(), mime)
+
+    def discard(self, key: str):
+        """Drops `key` (QC rejected the image it holds), so it is never served again."""
+        with self._lock:
+            self._load()
+            self._drop(key)
+
+    def summary(self) -> str:
+        size = self._total / 1e6 if self._entries is not None else 0.0
+        return f"hits={self.hits}, misses={self.misses}, evicted={self.evicted}, size={size:.0f} MB"
+
+RESULT_CACHE = ResultCache(RESULT_CACHE_DIR, RESULT_CACHE_MAX_BYTES)
+
+# -------------------- GEMINI INTEGRATION --------------------
+def _upload_single_file(path: str, key: "PoolKey"):
+    logger.debug(f"Uploading single reference file: {path} ({key.id})")
+    KEYS.wait_for(key, "Uploading with")
+    t0 = time.monotonic()
+    with key.slot("upload"):
+        with METRICS.call("upload", wait_s=time.monotonic() - t0, bytes_in=os.path.getsize(path), key=key.id):
+            return WATCHDOG.call("upload", UPLOAD_TIMEOUT_S, lambda: key.backend.files.upload(file=path))
+
+def reference_paths(folder_path: str) -> List[str]:
+    """The folder's JPG references in upload order (sorted by name)."""
+    return [os.path.join(folder_path, f) for f in sorted(os.listdir(folder_path)) if f.lower().endswith((".jpg", ".jpeg"))]
+
+def choose_ref_strategy(paths: List[str], strategy: str | None = None) -> str:
+    """'inline' or 'files' for these (prepared) reference files; auto inlines small sets."""
+    strategy = strategy or REF_STRATEGY
+    if strategy != "auto":
+        return strategy
+    return "inline" if sum(os.path.getsize(p) for p in paths) <= REF_INLINE_MAX_BYTES else "files"
+
+def ref_strategy_of(refs: List[FileHandle]) -> str:
+    if refs and isinstance(refs[0], ReferenceContext):
+        return "cache"
+    return "inline" if refs and getattr(refs[0], "inline_data", None) is not None else "files"
+
+def upload_references(folder_path: str, min_ttl_s: float = UPLOAD_EXPIRY_MARGIN_S,
+                      strategy: str | None = None, key: "PoolKey | None" = None) -> List[FileHandle]:
+    """
+    The folder's references as generate_content parts: Files API handles (uploaded or reused
+    from the upload cache) or, per choose_ref_strategy, inline image bytes with no upload.
+    Files go to one pooled key (`key`, or the one with most upload headroom; another is tried
+    if it gets benched midway) and the handles are bound to it for generation.
+    A folder with more than MAX_REF_IMAGES JPGs contributes the subset sku_reference_paths() picks.
+    """
+    logger.debug(f"Uploading references from: {folder_path}")
+    sources = sku_reference_paths(folder_path)
+    files = [os.path.basename(p) for p in sources]
+    logger.debug(f"Using {len(files)} JPG/JPEG references: {files}")
+    if len(files) == 0:
+        raise ValueError(f"No JPG references found in {folder_path}")
+
+    prepared = [prepare_reference(p) for p in sources]
+    if choose_ref_strategy(prepared, strategy) == "inline":
+        parts = []
+        for path in prepared:
+            with open(path, "rb") as f:
+                parts.append(get_client().inline_part(f.read(), ext_to_mime(os.path.splitext(path)[1])))
+        total = sum(len(p.inline_data.data) for p in parts)
+        logger.info(f"Prepared {len(parts)} references from {folder_path} inline ({total / 1e6:.2f} MB per request)")
+        return parts
+
+    for _ in range(len(KEYS.keys)):
+        pool_key = key or KEYS.pick("upload")
+        try:
+            return _upload_with_key(folder_path, list(zip(files, sources, prepared)), min_ttl_s, pool_key)
+        except Exception:
+            if key is not None or not pool_key.benched() or not KEYS.others_live(pool_key):
+                raise
+            logger.warning(f"{pool_key.id} was benched while uploading references from {folder_path}; switching keys")
+    raise RuntimeError(f"No API key could take the references from {folder_path}")
+
+def _upload_with_key(folder_path: str, refs: List[Tuple[str, str, str]], min_ttl_s: float, key: "PoolKey") -> List[FileHandle]:
+    uploaded = []
+    reused = 0
+    src_bytes = sent_bytes = 0
+    for fname, source, path in refs:
+        sha = file_sha256(path)
+        fobj = UPLOAD_CACHE.get(sha, key.id, min_ttl_s)
+        if fobj is not None:
+            reused += 1
+            logger.debug(f"Reusing cached upload: {fname} -> id={fobj.name}")
+        else:
+            # Retry each upload individually
+            fobj = retry_call(_upload_single_file, path, key)
+            UPLOAD_CACHE.put(sha, key.id, fobj, source)
+            src_bytes += os.path.getsize(source)
+            sent_bytes += os.path.getsize(path)
+            logger.debug(f"Uploaded: {fname} -> id={getattr(fobj,'name',None) or getattr(fobj,'uri',None)}")
+        KEYS.bind(fobj, key)
+        uploaded.append(fobj)
+    shrunk = f"; {src_bytes / 1e6:.1f} MB of originals sent as {sent_bytes / 1e6:.1f} MB" if sent_bytes != src_bytes else ""
+    via = f" via {key.id}" if len(KEYS.keys) > 1 else ""
+    logger.info(f"Prepared {len(uploaded)} references from {folder_path}{via} (uploaded {len(uploaded) - reused}, "
+                f"reused {reused} cached{shrunk})")
+    return uploaded
+
+class ReferenceContext:
+    """
+    A SKU's references held server-side as a cached content (--ref-context cache). It stands in
+    for the reference parts: generate_one_image sends just the prompt and names the cache, so the
+    images are ingested once per SKU and billed as cached tokens on each prompt after that.
+    """
+    def __init__(self, name: str, model: str, key: "PoolKey", parts: List[FileHandle], tokens: int):
+        self.name = name
+        self.model = model
+        self.key = key
+        self.parts = parts
+        self.tokens = tokens
+        self.created = time.monotonic()
+        self._closed = False
+
+    def close(self):
+        """Deletes the cache now rather than letting it live out REF_CONTEXT_TTL_S (best effort)."""
+        if self._closed:
+            return
+        self._closed = True
+        hours = (time.monotonic() - self.created) / 3600.0
+        try:
+            with METRICS.call("cache_delete", key=self.key.id) as rec:
+                rec["est_cost_usd"] = round(self.tokens * hours * PRICE_CACHE_STORAGE_PER_MTOK_HOUR / 1e6, 6)
+                self.key.backend.caches.delete(name=self.name)
+        except Exception as e:
+            logger.debug(f"Could not delete cached context {self.name}: {e}")
+
+def open_reference_context(refs: List[FileHandle], folder_path: str) -> List[FileHandle]:
+    """
+    Puts `refs` in a cached content on the key that owns them and returns [ReferenceContext].
+    Falls back to the plain references (sent with every request) if the cache can't be created,
+    e.g. the model doesn't support caching or the set is under its minimum token count.
+    """
+    key = KEYS.route(refs)
+    model = key.model or MODEL
+    t0 = time.monotonic()
+    try:
+        with key.slot("upload"):
+            with METRICS.call("cache_create", wait_s=time.monotonic() - t0, bytes_in=_parts_bytes(refs), key=key.id) as rec:
+                cache = WATCHDOG.call("cache_create", UPLOAD_TIMEOUT_S, lambda: key.backend.caches.create(model=model, config={
+                    "contents": list(refs),
+                    "ttl": f"{REF_CONTEXT_TTL_S:.0f}s",
+                    "display_name": f"refs {os.path.basename(folder_path)}"[:120],
+                }))
+                tokens = getattr(getattr(cache, "usage_metadata", None), "total_token_count", None) or 0
+                # Writing the cache bills its tokens once as ordinary input
+                rec["prompt_tokens"] = tokens
+                rec["est_cost_usd"] = round(METRICS.estimate_cost(tokens, 0), 6)
+    except SkuDeadlineError:
+        raise
+    except Exception as e:
+        logger.warning(f"Could not cache the references from {folder_path} ({e}); sending them with each request")
+        return refs
+    ctx = ReferenceContext(cache.name, model, key, list(refs), tokens)
+    KEYS.bind(ctx, key)
+    logger.info(f"Cached {len(refs)} references from {folder_path} as {cache.name} ({tokens} tokens)")
+    return [ctx]
+
+def sku_references(folder_path: str, refs: List[FileHandle] | None = None) -> List[FileHandle]:
+    """What a SKU's prompts are generated against: the references (uploaded here unless `refs`
+    were prefetched), or with --ref-context cache a cached context holding them."""
+    if refs is None:
+        refs = upload_references(folder_path)
+    if REF_CONTEXT == "cache":
+        return open_reference_context(refs, folder_path)
+    return refs
+
+def close_reference_context(refs: List[FileHandle]):
+    for ref in refs:
+        if isinstance(ref, ReferenceContext):
+            ref.close()
+
+def _generate(model: str, parts, cfg):
+    # Uploaded references and cached contexts pin the call to the key that owns them;
+    # inline references can go anywhere
+    key = KEYS.route(parts, cfg.get("cached_content"))
+    model = key.model or model
+    _call_ctx.model = model
+    logger.debug(f"Calling models.generate_content(model={model}, parts_len={len(parts)}, key={key.id})")
+    t0 = time.monotonic()
+    with BREAKER.guard(), key.slot("generate"):
+        if getattr(_call_ctx, "on_wire", None):
+            _call_ctx.on_wire()   # lets HEDGER time the call from here, not from the limiter queue
+        with METRICS.call("generate", wait_s=time.monotonic() - t0, bytes_in=_parts_bytes(parts), key=key.id) as rec:
+            resp = WATCHDOG.call("generate", GEN_TIMEOUT_S, lambda: key.backend.models.generate_content(
+                model=model,
+                contents=parts,
+                config=cfg,
+            ))
+            METRICS.note_response(rec, resp)
+            return resp
+
+def generate_one_image(prompt: str, refs: List[FileHandle]) -> Tuple[bytes, str]:
+    logger.debug(f"Generating image with {len(refs)} reference(s); aspect={ASPECT_RATIO}; modalities={RESP_MODALITIES}")
+    # Plain dict (the SDK accepts GenerateContentConfigDict) so backends need no SDK types
+    cfg = {
+        "response_modalities": RESP_MODALITIES,
+        "image_config": {"aspect_ratio": ASPECT_RATIO},
+    }
+    if refs and isinstance(refs[0], ReferenceContext):
+        cfg["cached_content"] = refs[0].name
+        parts = [prompt]
+    else:
+        # References first: a SKU's four requests then share the same prefix
+        parts = list(refs)
+        parts.append(prompt)
+
+    resp = retry_call(HEDGER.call, _generate, MODEL, parts, cfg)
+
+    # Log some response metadata if present
+    cand_count = len(getattr(resp, "candidates", []) or [])
+    logger.debug(f"Generation response candidates: {cand_count}")
+
+    for cand_idx, cand in enumerate(getattr(resp, "candidates", [])):
+        if not getattr(cand, "content", None):
+            logger.debug(f"Candidate {cand_idx} has no content")
+            continue
+        for part_idx, p in enumerate(getattr(cand.content, "parts", [])):
+            if getattr(p, "inline_data", None) and getattr(p.inline_data, "data", None):
+                mime = getattr(p.inline_data, "mime_type", "image/png")
+                logger.debug(f"Found inline_data in candidate {cand_idx}, part {part_idx}, mime={mime}")
+                return p.inline_data.data, mime
+
+    # If we got here, treat as a retryable failure from our caller
+    raise RuntimeError("No image bytes returned from API")
+
+# -------------------- RUN STATE (SQLite) --------------------
+class RunStore:
+    """
+    Per-prompt run state in SQLite (WAL mode):
+    - prompts: one row per (SKU, prompt) with status ('done' | 'failed'), output path, sha256, attempts
+    - skus: SKUs whose prompts are all done
+    - meta: bookkeeping (e.g. the state.json mtime we last synced with)
+    - batch_jobs / batch_items: Batch API jobs and the (SKU, prompt) pairs they carry
+    Every update is a single-row upsert, so bookkeeping cost is constant per prompt.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS prompts (
+            product_code TEXT NOT NULL,
+            prompt_key   TEXT NOT NULL,
+            status       TEXT NOT NULL,
+            output_path  TEXT,
+            sha256       TEXT,
+            mime         TEXT,
+            error_code   TEXT,
+            attempts     INTEGER NOT NULL DEFAULT 0,
+            updated_at   REAL NOT NULL,
+            PRIMARY KEY (product_code, prompt_key)
+        );
+        CREATE TABLE IF NOT EXISTS skus (
+            product_code TEXT PRIMARY KEY,
+            completed_at REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS meta (
+            key   TEXT PRIMARY KEY,
+            value TEXT
+        );
+        CREATE TABLE IF NOT EXISTS batch_jobs (
+            name        TEXT PRIMARY KEY,
+            state       TEXT NOT NULL,
+            input_path  TEXT,
+            result_path TEXT,
+            requests    INTEGER NOT NULL DEFAULT 0,
+            created_at  REAL NOT NULL,
+            updated_at  REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS batch_items (
+            job_name     TEXT NOT NULL,
+            product_code TEXT NOT NULL,
+            prompt_key   TEXT NOT NULL,
+            PRIMARY KEY (job_name, product_code, prompt_key)
+        );
+    """
+
+    def __init__(self, path: str, readonly: bool = False):
+        self.path = path
+        self.readonly = readonly
+        self._db = None
+        self._lock = threading.RLock()
+
+    def _conn(self) -> sqlite3.Connection:
+        if self._db is None and self.readonly:
+            # `status`: no journal-mode switch, no DDL, no writes
+            if not os.path.exists(self.path):
+                # Nothing recorded yet: read as an empty store rather than creating the file
+                self._db = sqlite3.connect(":memory:", isolation_level=None, check_same_thread=False)
+                self._db.executescript(self.SCHEMA)
+                return self._db
+            # A WAL database opened even read-only gets -wal/-shm files next to it. With no -wal
+            # there is no writer and everything is in the main file, so open it immutable; with
+            # one, a run is live and the files we'd need already exist.
+            uri = "file:" + urllib.request.pathname2url(os.path.abspath(self.path)) + "?mode=ro"
+            if not os.path.exists(self.path + "-wal"):
+                uri += "&immutable=1"
+            self._db = sqlite3.connect(uri, uri=True, timeout=30, isolation_level=None, check_same_thread=False)
+        if self._db is None:
+            logger.debug(f"Opening run store: {self.path}")
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.executescript(self.SCHEMA)
+            self._db = db
+        return self._db
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    def get_meta(self, key: str) -> str | None:
+        with self._lock:
+            row = self._conn().execute("SELECT value FROM meta WHERE key=?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key: str, value: str):
+        with self._lock:
+            self._conn().execute("INSERT OR REPLACE INTO meta(key, value) VALUES(?, ?)", (key, value))
+
+    def record_prompt(self, code: str, key: str, status: str, output_path: str | None = None,
+                      sha256: str | None = None, mime: str | None = None, error_code: str | None = None):
+        with self._lock:
+            self._conn().execute(
+                """INSERT INTO prompts(product_code, prompt_key, status, output_path, sha256, mime, error_code, attempts, updated_at)
+                   VALUES(?, ?, ?, ?, ?, ?, ?, 1, ?)
+                   ON CONFLICT(product_code, prompt_key) DO UPDATE SET
+                       status=excluded.status,
+                       output_path=COALESCE(excluded.output_path, output_path),
+                       sha256=COALESCE(excluded.sha256, sha256),
+                       mime=COALESCE(excluded.mime, mime),
+                       error_code=excluded.error_code,
+                       attempts=attempts + 1,
+                       updated_at=excluded.updated_at""",
+                (code, key, status, output_path, sha256, mime, error_code, time.time()),
+            )
+
+    def prompt_rows(self, code: str) -> Dict[str, Dict]:
+        with self._lock:
+            cur = self._conn().execute(
+                "SELECT prompt_key, status, output_path, sha256, mime, error_code, attempts FROM prompts WHERE product_code=?",
+                (code,))
+            cols = [c[0] for c in cur.description]
+            return {r[0]: dict(zip(cols, r)) for r in cur.fetchall()}
+
+    def mark_sku_complete(self, code: str, keys=PROMPT_KEYS) -> bool:
+        """Marks the SKU complete only if every prompt is 'done' (QC results can land concurrently)."""
+        with self._lock:
+            db = self._conn()
+            marks = ",".join("?" * len(keys))
+            done = db.execute(f"SELECT COUNT(*) FROM prompts WHERE product_code=? AND status='done' AND prompt_key IN ({marks})",
+                              (code, *keys)).fetchone()[0]
+            if done < len(keys):
+                return False
+            db.execute("INSERT OR REPLACE INTO skus(product_code, completed_at) VALUES(?, ?)", (code, time.time()))
+            return True
+
+    def mark_qc_failed(self, code: str, key: str, error_code: str):
+        with self._lock:
+            db = self._conn()
+            db.execute("BEGIN")
+            db.execute("UPDATE prompts SET status='qc_failed', error_code=?, updated_at=? WHERE product_code=? AND prompt_key=?",
+                       (error_code, time.time(), code, key))
+            db.execute("DELETE FROM skus WHERE product_code=?", (code,))
+            db.execute("COMMIT")
+
+    def completed_skus(self) -> set:
+        with self._lock:
+            return {r[0] for r in self._conn().execute("SELECT product_code FROM skus")}
+
+    def prompt_states(self) -> List[Tuple[str, str, str, float]]:
+        """(product_code, prompt_key, status, updated_at) for every prompt row."""
+        with self._lock:
+            return self._conn().execute("SELECT product_code, prompt_key, status, updated_at FROM prompts").fetchall()
+
+    def reset_sku(self, code: str):
+        with self._lock:
+            db = self._conn()
+            db.execute("BEGIN")
+            db.execute("DELETE FROM prompts WHERE product_code=?", (code,))
+            db.execute("DELETE FROM skus WHERE product_code=?", (code,))
+            db.execute("COMMIT")
+
+    def sync_from_state_json(self, path: str):
+        """
+        Picks up state.json if it changed since we last wrote it: SKUs listed there are
+        imported as complete; SKUs we completed that were removed from it are reset.
+        The very first import only adds (migration from the old SKU-only state).
+        """
+        if not os.path.exists(path):
+            return
+        mtime = str(os.path.getmtime(path))
+        last = self.get_meta("state_json_mtime")
+        if last == mtime:
+            return
+        listed = set(load_json(path, {"completed_skus": []}).get("completed_skus", []))
+        have = self.completed_skus()
+        with self._lock:
+            db = self._conn()
+            db.execute("BEGIN")
+            for code in listed - have:
+                db.execute("INSERT OR REPLACE INTO skus(product_code, completed_at) VALUES(?, ?)", (code, time.time()))
+            removed = (have - listed) if last is not None else set()
+            for code in removed:
+                db.execute("DELETE FROM prompts WHERE product_code=?", (code,))
+                db.execute("DELETE FROM skus WHERE product_code=?", (code,))
+            db.execute("INSERT OR REPLACE INTO meta(key, value) VALUES('state_json_mtime', ?)", (mtime,))
+            db.execute("COMMIT")
+        logger.info(f"Synced {path}: imported {len(listed - have)} completed SKU(s), reset {len(removed)}")
+
+    def add_batch_job(self, name: str, input_path: str, pairs: List[Tuple[str, str]]):
+        with self._lock:
+            db = self._conn()
+            db.execute("BEGIN")
+            db.execute("INSERT OR REPLACE INTO batch_jobs(name, state, input_path, requests, created_at, updated_at) VALUES(?, 'SUBMITTED', ?, ?, ?, ?)",
+                       (name, input_path, len(pairs), time.time(), time.time()))
+            db.executemany("INSERT OR IGNORE INTO batch_items(job_name, product_code, prompt_key) VALUES(?, ?, ?)",
+                           [(name, c, k) for c, k in pairs])
+            db.execute("COMMIT")
+
+    def update_batch_job(self, name: str, state: str, result_path: str | None = None):
+        with self._lock:
+            self._conn().execute("UPDATE batch_jobs SET state=?, result_path=COALESCE(?, result_path), updated_at=? WHERE name=?",
+                                 (state, result_path, time.time(), name))
+
+    def open_batch_jobs(self) -> List[Dict]:
+        """Jobs whose results have not been collected yet."""
+        with self._lock:
+            cur = self._conn().execute("SELECT name, state, input_path, requests FROM batch_jobs WHERE state != 'collected' ORDER BY created_at")
+            cols = [c[0] for c in cur.description]
+            return [dict(zip(cols, r)) for r in cur.fetchall()]
+
+    def batch_pairs_in_flight(self) -> set:
+        with self._lock:
+            return {(r[0], r[1]) for r in self._conn().execute(
+                "SELECT i.product_code, i.prompt_key FROM batch_items i JOIN batch_jobs j ON j.name = i.job_name WHERE j.state != 'collected'")}
+
+    def export_state_json(self, path: str):
+        save_json(path, {"completed_skus": sorted(self.completed_skus())})
+        self.set_meta("state_json_mtime", str(os.path.getmtime(path)))
+
+STORE = RunStore(RUN_DB_FILE)
+
+def load_completed_skus() -> set:
+    STORE.sync_from_state_json(STATE_FILE)
+    comps = STORE.completed_skus()
+    logger.debug(f"Loaded {len(comps)} completed SKU(s) from {RUN_DB_FILE}")
+    return comps
+
+def mark_sku_complete(product_code: str) -> bool:
+    logger.debug(f"Marking SKU complete: {product_code}")
+    return STORE.mark_sku_complete(product_code)
+
+def verified_output(row: Dict | None) -> bool:
+    """True if a recorded 'done' prompt still has its output on disk with the recorded hash."""
+    if not row or row.get("status") != "done" or not row.get("output_path"):
+        return False
+    path = row["output_path"]
+    if not os.path.exists(path):
+        return False
+    return not row.get("sha256") or file_sha256(path) == row["sha256"]
+
+# -------------------- QC STAGE --------------------
+class QCStage:
+    """
+    Off-thread QC for saved outputs. Generation threads submit (SKU, prompt, path) and
+    carry on; qc_image runs in a process pool and results come back via a callback that
+    records failures in the run store (prompt -> 'qc_failed', SKU un-completed), journals
+    and notifies them, and queues the SKU for regeneration.
+    """
+    def __init__(self, workers: int = None):
+        self.workers = QC_WORKERS if workers is None else workers
+        self._pool = None
+        self._lock = threading.Lock()
+        self._pending = set()
+        self._requeue: set = set()
+        self._requeued: Dict[str, int] = {}
+        self.checked = 0
+        self.failed = 0
+        self.pause_on_error = False
+
+    def _executor(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            # spawn: never fork a process that is running generation threads
+            self._pool = ProcessPoolExecutor(max_workers=self.workers,
+                                             mp_context=multiprocessing.get_context("spawn"))
+        return self._pool
+
+    def submit(self, code: str, key: str, path: str, mime: str | None = None, cache_key: str | None = None):
+        white_bg = key in WHITE_BG_PROMPTS
+        cached = (cache_key, mime) if cache_key else None
+        if self.workers <= 0:
+            try:
+                res = qc_image(path, white_bg)
+            except Exception as e:
+                res = {"path": path, "ok": True, "failures": [], "qc_error": str(e)}
+            self._on_result(code, key, res, cached)
+            return
+        with self._lock:
+            fut = self._executor().submit(qc_image, path, white_bg)
+            self._pending.add(fut)
+        fut.add_done_callback(lambda f: self._done(code, key, path, f, cached))
+
+    def _done(self, code: str, key: str, path: str, fut, cached: Tuple[str, str] | None = None):
+        with self._lock:
+            self._pending.discard(fut)
+        try:
+            res = fut.result()
+        except Exception as e:
+            # QC infrastructure problems must not fail a paid generation
+            logger.warning(f"[{code}] QC could not check '{key}' ({path}): {e}")
+            res = {"path": path, "ok": True, "failures": [], "qc_error": str(e)}
+        self._on_result(code, key, res, cached)
+
+    def _on_result(self, code: str, key: str, res: Dict, cached: Tuple[str, str] | None = None):
+        """`cached`: (result cache key, mime) of the image; it is cached on a pass and evicted on a failure."""
+        self.checked += 1
+        if res["ok"]:
+            logger.debug(f"[{code}] QC ok for '{key}': {res}")
+            if cached:
+                try:
+                    RESULT_CACHE.admit(cached[0], res["path"], cached[1])
+                except OSError as e:
+                    logger.debug(f"[{code}] Could not cache '{key}': {e}")
+            return
+        self.failed += 1
+        if cached:
+            RESULT_CACHE.discard(cached[0])
+        failures = res["failures"]
+        msg = f"{code} {key}: QC failed ({', '.join(failures)}) — {os.path.basename(res['path'])}"
+        logger.warning(msg)
+        STORE.mark_qc_failed(code, key, ",".join(failures))
+        if LEASES is not None:
+            LEASES.reopen(code, key)
+        for fc in failures:
+            append_error({
+                "timestamp": now_str(),
+                "product_code": code,
+                "prompt": key,
+                "error_code": fc,
+                "error": msg,
+                "meta": {k: v for k, v in res.items() if k not in ("ok", "failures")},
+            })
+        with self._lock:
+            if self._requeued.get(code, 0) < QC_MAX_REQUEUES:
+                self._requeue.add(code)
+        notify(
+            level="warning",
+            title=f"QC warning — {code} / {key} ({', '.join(failures)})",
+            message=msg,
+            details={"Product": code, "Prompt": key, "Size": " x ".join(map(str, res.get("size", []))),
+                     "Border white": res.get("border_white", "n/a"), "Margin": res.get("margin", "n/a"),
+                     "Luminance std": res.get("lum_std", "n/a")},
+            attach_error_log=True,
+            priority=4,
+            tags=["warning", "ruler"],
+            key=f"warning:qc_{failures[0]}",
+        )
+        if self.pause_on_error:
+            STOP_EVENT.set()
+
+    def take_requeues(self, skip=()) -> List[str]:
+        """SKUs with QC failures that may be regenerated now (not currently in flight)."""
+        with self._lock:
+            ready = [c for c in self._requeue if c not in skip]
+            for c in ready:
+                self._requeue.discard(c)
+                self._requeued[c] = self._requeued.get(c, 0) + 1
+        return ready
+
+    def drain(self, timeout: float | None = None):
+        """Waits for outstanding QC jobs (end of a pass)."""
+        with self._lock:
+            pending = list(self._pending)
+        if pending:
+            logger.info(f"Waiting for {len(pending)} QC job(s) …")
+            wait(pending, timeout=timeout)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=True, cancel_futures=True)
+            self._pool = None
+        if self.checked:
+            logger.info(f"QC: checked {self.checked} image(s), {self.failed} failed")
+
+QC_STAGE = QCStage()
+
+# -------------------- UTILS --------------------
+class ReferenceIndex:
+    """
+    Sorted list of REFERENCE_ROOT subfolder names, listed once and rebuilt only when the
+    root (or its mtime) changes, so each lookup is a stat plus an O(log n) bisect.
+    A code matches a folder at a word boundary ("COOBA001 - 50123…"); folders that merely
+    extend the code ("COOBA0012 - …") or several boundary matches are reported as ambiguous.
+    """
+    def __init__(self):
+        self._root = None
+        self._mtime = None
+        self._names: List[str] = []
+        self._lock = threading.Lock()
+
+    def _refresh(self, root: str):
+        mtime = os.stat(root).st_mtime
+        if root == self._root and mtime == self._mtime:
+            return
+        with os.scandir(root) as it:
+            names = sorted(e.name for e in it if e.is_dir())
+        self._root, self._mtime, self._names = root, mtime, names
+        logger.debug(f"Reference index built: {len(names)} folder(s) under {root}")
+
+    @staticmethod
+    def _at_boundary(name: str, code: str) -> bool:
+        return len(name) == len(code) or not (name[len(code)].isalnum() or name[len(code)] == "_")
+
+    def resolve(self, code: str, root: str | None = None) -> Tuple[str | None, List[str]]:
+        """Returns (folder path or None, all folder names starting with the code)."""
+        root = root or REFERENCE_ROOT
+        with self._lock:
+            self._refresh(root)
+            names = self._names
+            i = bisect_left(names, code)
+            candidates = []
+            while i < len(names) and names[i].startswith(code):
+                candidates.append(names[i])
+                i += 1
+        exact = [n for n in candidates if self._at_boundary(n, code)]
+        if len(exact) == 1:
+            return os.path.join(root, exact[0]), candidates
+        return None, candidates
+
+REF_INDEX = ReferenceIndex()
+
+def find_folder_for_code(code: str) -> str | None:
+    logger.debug(f"Searching reference folder for code prefix: {code}")
+    full, candidates = REF_INDEX.resolve(code)
+    if full:
+        if len(candidates) > 1:
+            logger.debug(f"Matched '{os.path.basename(full)}' for code '{code}'; ignored longer codes {candidates}")
+        logger.debug(f"Matched folder '{os.path.basename(full)}' for code '{code}' -> {full}")
+        return full
+    if candidates:
+        logger.warning(f"Ambiguous reference folders for code '{code}': {candidates}")
+    else:
+        logger.debug(f"No reference folder found for code '{code}'")
+    return None
+
+def capture_trace() -> str:
+    return "".join(traceback.format_exc())
+
+def record_and_notify_error(product_code: str, prompt_key: str, error_code: str, err: Exception, extra: Dict[str, Any] | None = None, pause_on_error: bool = False):
+    tb = capture_trace()
+    entry = {
+        "timestamp": now_str(),
+        "product_code": product_code,
+        "prompt": prompt_key,
+        "error_code": error_code,
+        "error_type": err.__class__.__name__,
+        "error": str(err),
+        "traceback": tb,
+    }
+    if extra:
+        entry["meta"] = extra
+    append_error(entry)
+
+    if BREAKER.state != "closed":
+        # The breaker's own alert covers failures during an outage
+        logger.debug(f"[{product_code}] {error_code} not notified: circuit breaker is {BREAKER.state}")
+        if pause_on_error:
+            raise err
+        return
+
+    title = f"CRITICAL ERROR — {product_code} / {prompt_key} [{error_code}]"
+    message = f"{err.__class__.__name__}: {err}"
+    details = {
         "Product": product_code,
         "Prompt": prompt_key,
         "Error code": error_code,
@@ -509,57 +2883,762 @@ def record_and_notify_error(product_code: str, prompt_key: str, error_code: str,
         details=details,
         attach_error_log=True,
         priority=5,
-        tags=["rotating_light"]
+        tags=["rotating_light"],
+        key=f"error:{error_code}",
+    )
+
+    if pause_on_error:
+        raise err
+
+# -------------------- SHARED-DIR COORDINATION --------------------
+def _safe_name(code: str) -> str:
+    return re.sub(r"[^A-Za-z0-9._-]", "_", code)
+
+class WorkLeases:
+    """
+    SKU claiming through a directory shared by several processes or hosts (--shared-dir):
+      leases/<code>.lease         held while one worker processes the SKU (O_CREAT|O_EXCL)
+      done/<code>                 SKU complete; never claimed again
+      failed/<code>               {attempts, retry_after, reason}: not claimed before retry_after,
+                                  settled at SHARED_MAX_ATTEMPTS or on missing input
+      prompts/<code>/<key>.json   saved outputs (path + sha256), so whoever holds the SKU
+                                  next only regenerates prompts that are missing
+    A heartbeat thread touches held leases every LEASE_HEARTBEAT_S. A lease not touched for
+    LEASE_TTL_S (measured on the shared filesystem's clock) belongs to a dead worker and is
+    reclaimed by renaming it away first; rename is atomic, so exactly one reclaimer wins.
+    """
+    def __init__(self, root: str):
+        self.root = root
+        for sub in ("leases", "done", "failed", "prompts"):
+            os.makedirs(os.path.join(root, sub), exist_ok=True)
+        self.worker_id = f"{socket.gethostname()}-{os.getpid()}-{random.randrange(16 ** 6):06x}"
+        self._held: Dict[str, str] = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._clock = (0.0, 0.0)   # (monotonic, fs time) of the last probe
+        self.claimed = 0
+        self.reclaimed = 0
+        self.lost = 0
+
+    def _path(self, sub: str, code: str) -> str:
+        return os.path.join(self.root, sub, _safe_name(code) + (".lease" if sub == "leases" else ""))
+
+    def _fs_now(self) -> float:
+        """Current time as the shared filesystem stamps it (hosts' clocks may disagree)."""
+        mono, fs = self._clock
+        if time.monotonic() - mono > 1.0:
+            probe = os.path.join(self.root, f".clock-{self.worker_id}")
+            with open(probe, "w"):
+                pass
+            self._clock = (time.monotonic(), os.stat(probe).st_mtime)
+            mono, fs = self._clock
+        return fs + (time.monotonic() - mono)
+
+    def _expired(self, path: str) -> bool:
+        try:
+            return self._fs_now() - os.stat(path).st_mtime > LEASE_TTL_S
+        except FileNotFoundError:
+            return True
+
+    def _owner(self, path: str) -> str | None:
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f).get("owner")
+        except (OSError, ValueError):
+            return None
+
+    def _create(self, code: str) -> bool:
+        path = self._path("leases", code)
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump({"owner": self.worker_id, "code": code, "claimed_at": time.time()}, f)
+        with self._lock:
+            self._held[code] = path
+        return True
+
+    def _reclaim(self, code: str) -> bool:
+        """Moves an expired lease aside; False if it was renewed or someone else got there first."""
+        path = self._path("leases", code)
+        if not self._expired(path):
+            return False
+        grave = f"{path}.expired-{self.worker_id}"
+        try:
+            os.rename(path, grave)
+        except (FileNotFoundError, FileExistsError, PermissionError):
+            return False
+        if not self._expired(grave):
+            # Raced with another reclaimer that had already re-created the lease: put it back
+            try:
+                os.link(grave, path)
+            except OSError:
+                logger.warning(f"Lease for {code} changed hands during reclaim; leaving it with its new owner")
+            os.remove(grave)
+            return False
+        logger.info(f"Reclaiming expired lease for {code} (previous owner {self._owner(grave) or 'unknown'})")
+        os.remove(grave)
+        self.reclaimed += 1
+        return True
+
+    def _closed(self, code: str) -> bool:
+        """Done, out of attempts, or still backing off after a failure."""
+        if os.path.exists(self._path("done", code)):
+            return True
+        failure = self.failure(code)
+        return failure["attempts"] >= SHARED_MAX_ATTEMPTS or failure["retry_after"] > self._fs_now()
+
+    def claim(self, code: str) -> bool:
+        with self._lock:
+            if code in self._held:
+                return True
+        if self._closed(code):
+            return False
+        if not (self._create(code) or (self._reclaim(code) and self._create(code))):
+            return False
+        # The last holder may have finished between the check and our create; finish() writes
+        # its marker before dropping the lease, so checking again now sees it
+        if self._closed(code):
+            self.release(code)
+            return False
+        self.claimed += 1
+        return True
+
+    def release(self, code: str):
+        with self._lock:
+            path = self._held.pop(code, None)
+        if path and self._owner(path) == self.worker_id:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def failure(self, code: str) -> Dict:
+        """The SKU's failed/ record; retry_after is in shared-filesystem time."""
+        try:
+            with open(self._path("failed", code), "r", encoding="utf-8") as f:
+                rec = json.loads(f.read().strip() or "0")
+        except (OSError, ValueError):
+            rec = 0
+        if not isinstance(rec, dict):
+            rec = {"attempts": int(rec)}   # a bare count, as older workers wrote it
+        return {"attempts": int(rec.get("attempts", 0)), "retry_after": float(rec.get("retry_after", 0.0)),
+                "reason": rec.get("reason")}
+
+    def attempts(self, code: str) -> int:
+        return self.failure(code)["attempts"]
+
+    def _bump_attempts(self, code: str, reason: str, delay_s: float = 0.0, settle: bool = False):
+        attempts = SHARED_MAX_ATTEMPTS if settle else self.attempts(code) + 1
+        _write_atomic(self._path("failed", code), json.dumps({
+            "attempts": attempts, "retry_after": self._fs_now() + delay_s, "reason": reason, "owner": self.worker_id}))
+
+    def finish(self, code: str, ok: bool, missing_input: bool = False):
+        """Done marker on success; otherwise one more failed attempt, which no worker retries for
+        SHARED_RETRY_DELAY_S (missing input settles the SKU instead). Then drops the lease."""
+        if ok:
+            _write_atomic(self._path("done", code), json.dumps({"owner": self.worker_id, "completed_at": time.time()}))
+        elif missing_input:
+            self._bump_attempts(code, "missing_input", settle=True)
+        else:
+            self._bump_attempts(code, "failed", SHARED_RETRY_DELAY_S)
+        self.release(code)
+
+    def revive(self, code: str):
+        """Forgets a SKU's failures (its missing input has turned up)."""
+        try:
+            os.remove(self._path("failed", code))
+        except FileNotFoundError:
+            pass
+
+    def reopen(self, code: str, key: str):
+        """QC rejected an output: forget the prompt's record, and if the SKU was finished take the
+        lease back and clear its done marker."""
+        try:
+            os.remove(os.path.join(self.root, "prompts", _safe_name(code), f"{key}.json"))
+        except FileNotFoundError:
+            pass
+        with self._lock:
+            if code in self._held:
+                return   # still in process_sku, which will finish it as failed
+        if not self._create(code):
+            logger.warning(f"[{code}] QC failed but another worker holds its lease; leaving it to them")
+            return
+        self.claimed += 1
+        self._bump_attempts(code, "qc_failed")
+        try:
+            os.remove(self._path("done", code))
+        except FileNotFoundError:
+            pass
+
+    def settled(self, codes) -> set:
+        """Codes that are done or out of attempts (one listdir, plus a read per failed SKU)."""
+        done = set(os.listdir(os.path.join(self.root, "done")))
+        failed = set(os.listdir(os.path.join(self.root, "failed")))
+        return {c for c in codes if _safe_name(c) in done
+                or (_safe_name(c) in failed and self.attempts(c) >= SHARED_MAX_ATTEMPTS)}
+
+    def backing_off(self, codes) -> set:
+        """Codes that failed recently and may not be claimed yet."""
+        failed = set(os.listdir(os.path.join(self.root, "failed")))
+        now = self._fs_now()
+        return {c for c in codes if _safe_name(c) in failed and self.failure(c)["retry_after"] > now}
+
+    def claimable(self, codes) -> set:
+        """Codes that are unleased, leased by us, or whose lease has expired, and not backing off."""
+        leased = {n[:-len(".lease")] for n in os.listdir(os.path.join(self.root, "leases")) if n.endswith(".lease")}
+        with self._lock:
+            held = set(self._held)
+        waiting = self.backing_off(set(codes) - held)
+        return {c for c in codes if c in held or (c not in waiting and (
+            _safe_name(c) not in leased or self._expired(self._path("leases", c))))}
+
+    def record_prompt(self, code: str, key: str, output_path: str, sha256: str, mime: str):
+        path = os.path.join(self.root, "prompts", _safe_name(code), f"{key}.json")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        _write_atomic(path, json.dumps({"status": "done", "output_path": os.path.abspath(output_path),
+                                        "sha256": sha256, "mime": mime, "owner": self.worker_id}))
+
+    def prompt_record(self, code: str, key: str) -> Dict | None:
+        try:
+            with open(os.path.join(self.root, "prompts", _safe_name(code), f"{key}.json"), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def publish_done(self, codes):
+        """Done markers for SKUs this host already completed outside shared mode."""
+        done = set(os.listdir(os.path.join(self.root, "done")))
+        for code in codes:
+            if _safe_name(code) not in done:
+                _write_atomic(self._path("done", code), json.dumps({"owner": self.worker_id, "completed_at": time.time()}))
+
+    def _heartbeat(self):
+        while not self._stop.wait(LEASE_HEARTBEAT_S):
+            with self._lock:
+                held = dict(self._held)
+            for code, path in held.items():
+                try:
+                    if self._owner(path) != self.worker_id:
+                        raise FileNotFoundError(path)
+                    os.utime(path, None)
+                except OSError:
+                    # Expired and reclaimed (e.g. this host was suspended); the new owner carries on
+                    with self._lock:
+                        self._held.pop(code, None)
+                    self.lost += 1
+                    logger.warning(f"Lost lease for {code}; another worker has reclaimed it")
+
+    def start(self):
+        self._thread = threading.Thread(target=self._heartbeat, name="lease-heartbeat", daemon=True)
+        self._thread.start()
+        logger.info(f"Shared-dir mode: worker {self.worker_id} coordinating through {self.root} "
+                    f"(lease TTL {LEASE_TTL_S:.0f}s, heartbeat {LEASE_HEARTBEAT_S:.0f}s)")
+
+    def close(self):
+        self._stop.set()
+        with self._lock:
+            held = list(self._held)
+        for code in held:
+            self.release(code)
+        try:
+            os.remove(os.path.join(self.root, f".clock-{self.worker_id}"))
+        except OSError:
+            pass
+        logger.info(f"Leases: claimed {self.claimed}, reclaimed {self.reclaimed} expired, lost {self.lost}")
+
+def _write_atomic(path: str, text: str):
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+# Set by --shared-dir
+LEASES: WorkLeases | None = None
+
+def run_shared(pending_items: List[Dict], run_pass: Callable[[List[Dict]], int]) -> int:
+    """
+    --shared-dir: runs passes over SKUs that are neither done nor out of attempts until none
+    are left. SKUs leased by live workers elsewhere are waited for, so a worker that dies
+    mid-SKU has its lease expire and the SKU picked up here. A SKU that just failed is not
+    claimed again for SHARED_RETRY_DELAY_S; once only those are left the run ends and a later
+    run retries them. SKUs settled for missing references are revived if their folder now
+    resolves. Returns SKUs completed here.
+    """
+    codes = [item["product_code"] for item in pending_items]
+    for code in LEASES.settled(codes):
+        if LEASES.failure(code)["reason"] == "missing_input" and REF_INDEX.resolve(code)[0]:
+            logger.info(f"[{code}] Reference folder found; clearing its earlier failures")
+            LEASES.revive(code)
+    completed = 0
+    while not STOP_EVENT.is_set():
+        left = set(codes) - LEASES.settled(codes)
+        if not left:
+            break
+        claimable = LEASES.claimable(left)
+        if claimable:
+            logger.info(f"Shared pass: {len(claimable)} claimable of {len(left)} unfinished SKU(s)")
+            completed += run_pass([item for item in pending_items if item["product_code"] in claimable])
+            continue
+        waiting = LEASES.backing_off(left)
+        if waiting == left:
+            logger.info(f"{len(left)} SKU(s) failed recently; leaving them for a later run "
+                        f"(retried {SHARED_RETRY_DELAY_S:.0f}s after their last attempt)")
+            break
+        logger.info(f"{len(left)} SKU(s) leased by other workers; checking again in {LEASE_HEARTBEAT_S:.0f}s")
+        STOP_EVENT.wait(LEASE_HEARTBEAT_S)
+    return completed
+
+# -------------------- PREFLIGHT --------------------
+PREFLIGHT_FIXES = {
+    "prompt_missing": "Fill in the listed prompt fields for this SKU in the prompts file.",
+    "folder_missing": "Create a reference folder named '<code> - …' under REFERENCE_ROOT (or fix the code).",
+    "folder_ambiguous": "Rename folders so exactly one starts with the code at a word boundary.",
+    "no_references": "Add JPG reference images to the folder.",
+    "unreadable_reference": "Re-export or remove the listed JPG(s); they fail to decode.",
+    "reference_too_small": f"Replace the listed JPG(s) with images at least {PREFLIGHT_MIN_REF_PX}px on the short side.",
+}
+
+def preflight_sku(item: Dict) -> Dict:
+    """
+    Offline checks for one SKU (no network): prompt fields, reference folder match, JPG count,
+    and that every JPG decodes at a usable resolution. Returns the SKU's report entry; a folder
+    over MAX_REF_IMAGES is not a problem, the entry lists the references that will be used.
+    """
+    code = item.get("product_code") or "n/a"
+    problems = []
+    ecomm = item.get("ecomm_prompts") if isinstance(item.get("ecomm_prompts"), dict) else {}
+    fields = {k: ecomm.get(k) for k in ("top", "side", "front_45")}
+    fields["lifestyle"] = item.get("lifestyle_prompt")
+    missing = [k for k, v in fields.items() if not isinstance(v, str) or not v.strip()]
+    if missing:
+        problems.append({"check": "prompt_missing", "detail": ", ".join(missing)})
+
+    try:
+        folder, candidates = REF_INDEX.resolve(code) if code != "n/a" else (None, [])
+    except OSError:
+        folder, candidates = None, []   # REFERENCE_ROOT itself is unreachable
+    entry = {"product_code": code, "folder": folder, "references": 0, "problems": problems}
+    if not folder:
+        check = "folder_ambiguous" if candidates else "folder_missing"
+        problems.append({"check": check, "detail": ", ".join(candidates) or REFERENCE_ROOT})
+        return entry
+
+    paths = reference_paths(folder)
+    entry["references"] = len(paths)
+    if not paths:
+        problems.append({"check": "no_references", "detail": folder})
+    elif len(paths) > MAX_REF_IMAGES:
+        entry["selected"] = [os.path.basename(p) for p in sku_reference_paths(folder)]
+    unreadable, small = [], []
+    for p in paths:
+        try:
+            with Image.open(p) as img:
+                w, h = img.size
+                img.draft("RGB", (64, 64))
+                img.load()
+        except Exception as e:
+            unreadable.append(f"{os.path.basename(p)} ({e.__class__.__name__})")
+            continue
+        if min(w, h) < PREFLIGHT_MIN_REF_PX:
+            small.append(f"{os.path.basename(p)} ({w}x{h})")
+    if unreadable:
+        problems.append({"check": "unreadable_reference", "detail": ", ".join(unreadable)})
+    if small:
+        problems.append({"check": "reference_too_small", "detail": ", ".join(small)})
+    return entry
+
+def run_preflight(pending_items: List[Dict], workers: int = None) -> List[Dict]:
+    """
+    --preflight: checks every pending SKU in parallel before any network call, writes one
+    report (PREFLIGHT_REPORT) and returns the items that passed. Bad SKUs are journaled and
+    summarised in a single notification instead of failing one by one mid-run.
+    """
+    t0 = time.monotonic()
+    with ThreadPoolExecutor(max_workers=workers or PREFLIGHT_WORKERS, thread_name_prefix="preflight") as pool:
+        entries = list(pool.map(preflight_sku, pending_items))
+
+    bad = [e for e in entries if e["problems"]]
+    by_check: Dict[str, List[str]] = {}
+    for e in bad:
+        for pr in e["problems"]:
+            by_check.setdefault(pr["check"], []).append(e["product_code"])
+    report = {
+        "generated_at": now_str(),
+        "reference_root": REFERENCE_ROOT,
+        "checked": len(entries),
+        "passed": len(entries) - len(bad),
+        "failed": len(bad),
+        "by_check": {k: {"count": len(v), "fix": PREFLIGHT_FIXES.get(k, ""), "skus": sorted(v)}
+                     for k, v in sorted(by_check.items(), key=lambda kv: -len(kv[1]))},
+        "skus": sorted(bad, key=lambda e: e["product_code"]),
+    }
+    save_json(PREFLIGHT_REPORT, report)
+
+    logger.info(f"Preflight: {len(entries)} SKU(s) checked in {time.monotonic() - t0:.1f}s; "
+                f"{report['passed']} passed, {len(bad)} dropped from this run")
+    for check, info in report["by_check"].items():
+        logger.warning(f"Preflight {check}: {info['count']} SKU(s), e.g. {', '.join(info['skus'][:5])} — {info['fix']}")
+    for e in bad:
+        append_error({
+            "timestamp": now_str(),
+            "product_code": e["product_code"],
+            "prompt": "preflight",
+            "error_code": "preflight_" + e["problems"][0]["check"],
+            "error": "; ".join(f"{pr['check']}: {pr['detail']}" for pr in e["problems"]),
+        })
+    if bad:
+        notify(
+            level="warning",
+            title=f"Preflight — {len(bad)} SKU(s) dropped",
+            message=f"{len(bad)} of {len(entries)} pending SKU(s) failed preflight; see {os.path.abspath(PREFLIGHT_REPORT)}",
+            details={k: info["count"] for k, info in report["by_check"].items()},
+            attach_error_log=False,
+            priority=4,
+            tags=["warning", "clipboard"],
+            key="warning:preflight",
+        )
+    # By position, not product_code: a code listed twice may have one good and one bad entry
+    return [item for item, e in zip(pending_items, entries) if not e["problems"]]
+
+# -------------------- REFERENCE PREFETCH --------------------
+class ReferencePrefetcher:
+    """
+    Overlaps reference preparation with generation: ahead() is handed the queue after each SKU
+    starts and prepares (derivatives, uploads or inline bytes) the first queued SKUs it doesn't
+    hold yet, up to `depth` at a time, on PREFETCH_WORKERS threads. take() hands a SKU its set,
+    or None if there is none, it failed (the SKU then uploads and reports errors itself) or it
+    is older than PREFETCH_MAX_AGE_S. Cached contexts are still created when the SKU starts, so
+    their TTL isn't spent waiting in the queue.
+    """
+    def __init__(self, depth: int = PREFETCH_SKUS):
+        self.depth = depth
+        self._slots: Dict[str, Tuple[Future, float]] = {}   # code -> (future, submitted at)
+        self._lock = threading.Lock()
+        self._pool = None
+        self.hits = 0
+        self.misses = 0
+        self.failed = 0
+        self.skipped = 0      # every prompt already answered by the result cache
+
+    def ahead(self, items):
+        if self.depth <= 0:
+            return
+        with self._lock:
+            # Sets nobody took (the SKU was skipped or claimed elsewhere) are stale by now
+            now = time.monotonic()
+            for code in [c for c, (_, at) in self._slots.items() if now - at > PREFETCH_MAX_AGE_S]:
+                self._slots.pop(code)[0].cancel()
+            for item in items:
+                if len(self._slots) >= self.depth:
+                    break
+                code = item.get("product_code")
+                if not code or code in self._slots:
+                    continue
+                if self._pool is None:
+                    self._pool = ThreadPoolExecutor(max_workers=PREFETCH_WORKERS, thread_name_prefix="prefetch")
+                self._slots[code] = (self._pool.submit(self._prefetch, item), time.monotonic())
+
+    def _prefetch(self, item: Dict) -> Tuple[str, List[FileHandle]] | None:
+        check_stop()
+        code = item["product_code"]
+        folder = find_folder_for_code(code)
+        if not folder:
+            return None
+        try:
+            prompts = sku_prompts(item).values()
+        except (KeyError, TypeError):
+            return None
+        if all(any(RESULT_CACHE.has(result_cache_key(p, folder, m)) for m in KEYS.models()) for p in prompts):
+            self.skipped += 1
+            return None
+        with call_context(sku=code, prompt="prefetch"):
+            return folder, upload_references(folder)
+
+    def take(self, code: str, folder: str) -> List[FileHandle] | None:
+        with self._lock:
+            slot = self._slots.pop(code, None)
+        if slot is None:
+            self.misses += 1
+            return None
+        fut, submitted = slot
+        try:
+            # Usually done by now; otherwise it has a head start on uploading here
+            while True:
+                done, _ = wait([fut], timeout=0.5)
+                if done:
+                    break
+                check_stop()
+            fetched = fut.result()
+        except KeyboardInterrupt:
+            raise
+        except Exception as e:
+            logger.debug(f"[{code}] Prefetch failed ({e.__class__.__name__}: {e}); preparing references now")
+            self.failed += 1
+            return None
+        if not fetched or fetched[0] != folder or time.monotonic() - submitted > PREFETCH_MAX_AGE_S:
+            self.misses += 1
+            return None
+        self.hits += 1
+        logger.debug(f"[{code}] Using prefetched references")
+        return fetched[1]
+
+    def discard(self, code: str):
+        with self._lock:
+            slot = self._slots.pop(code, None)
+        if slot is not None:
+            slot[0].cancel()
+
+    def close(self):
+        with self._lock:
+            self._slots.clear()
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+    def summary(self) -> str:
+        return (f"look-ahead {self.depth}; used {self.hits}, missed {self.misses}, failed {self.failed}, "
+                f"skipped {self.skipped} (result cache)")
+
+PREFETCH = ReferencePrefetcher()
+
+# -------------------- PER-SKU WORKFLOW --------------------
+def generate_with_refs(prompt: str, refs: List[FileHandle], folder: str) -> Tuple[bytes, str, str]:
+    """
+    generate_one_image, re-uploading the SKU's references once if the API rejects a cached handle.
+    Returns (bytes, mime, result cache key); the image is cached only once QC accepts it.
+    """
+    seen = list(refs)
+    try:
+        result = generate_one_image(prompt, refs)
+    except Exception as e:
+        if not is_stale_file_error(e):
+            raise
+        logger.warning(f"Reference handle rejected ({e}); re-uploading references from {folder}")
+        refresh_references(folder, refs, seen, invalidate=not isinstance(e, KeyBenchedError))
+        result = generate_one_image(prompt, refs)
+    return (*result, result_cache_key(prompt, folder, getattr(_call_ctx, "model", None) or MODEL))
+
+def generate_prompt(code: str, key: str, prompt: str, refs: List[FileHandle], folder: str, out_dir: str,
+                    pause_on_error: bool, sku_deadline: float | None = None) -> str:
+    """
+    Generates, saves and QCs one prompt of a SKU. Returns the saved path.
+    Safe to run from several threads at once (one per prompt). No call starts past sku_deadline.
+    """
+    check_stop()
+    try:
+        with call_context(sku=code, prompt=key, sku_deadline=sku_deadline):
+            return _generate_prompt(code, key, prompt, refs, folder, out_dir, pause_on_error)
+    except Exception as e:
+        STORE.record_prompt(code, key, "failed", error_code=e.__class__.__name__)
+        raise
+
+def _generate_prompt(code: str, key: str, prompt: str, refs: List[FileHandle], folder: str, out_dir: str, pause_on_error: bool) -> str:
+    logger.info(f"[{code}] Generating '{key}' (len={len(prompt)} chars) using model={MODEL}, aspect={ASPECT_RATIO}")
+    try:
+        raw_bytes, mime, cache_key = generate_with_refs(prompt, refs, folder)
+    except Exception as gen_err:
+        if isinstance(gen_err, SkuDeadlineError):
+            raise
+        # Notify immediately on first failure (including "No image bytes returned from API"),
+        # then retry once as before.
+        err_msg = str(gen_err)
+        err_code = "gen_first_attempt_failed"
+        if isinstance(gen_err, RuntimeError) and "No image bytes returned from API" in err_msg:
+            err_code = "no_image_bytes"
+
+        record_and_notify_error(
+            product_code=code,
+            prompt_key=key,
+            error_code=err_code,
+            err=gen_err,
+            extra={"will_retry": True, "model": MODEL, "aspect_ratio": ASPECT_RATIO},
+            pause_on_error=False,  # do not pause here; we retry once
+        )
+
+        logger.warning(f"[{code}] '{key}' generation failed once: {gen_err}. Retrying full prompt flow …")
+        check_stop()
+        check_sku_deadline()
+        raw_bytes, mime, cache_key = generate_with_refs(prompt, refs, folder)
+
+    return save_output(code, key, out_dir, raw_bytes, mime, cache_key)
+
+def sku_prompts(item: Dict) -> Dict[str, str]:
+    return {
+        "top": item["ecomm_prompts"]["top"],
+        "side": item["ecomm_prompts"]["side"],
+        "front_45": item["ecomm_prompts"]["front_45"],
+        "lifestyle": item["lifestyle_prompt"],
+    }
+
+def pending_prompts(code: str, prompts: Dict[str, str]) -> Dict[str, str]:
+    """Drops prompts whose recorded output is still on disk with the recorded hash."""
+    rows = STORE.prompt_rows(code)
+    if LEASES is not None:
+        # Prompts another worker saved before its lease expired
+        for k in prompts:
+            if verified_output(rows.get(k)):
+                continue
+            shared = LEASES.prompt_record(code, k)
+            if verified_output(shared):
+                STORE.record_prompt(code, k, "done", output_path=shared["output_path"],
+                                    sha256=shared["sha256"], mime=shared.get("mime"))
+                rows[k] = shared
+    done = [k for k in prompts if verified_output(rows.get(k))]
+    if done:
+        logger.info(f"[{code}] Resuming: {len(done)} prompt(s) already saved ({', '.join(done)})")
+    return {k: v for k, v in prompts.items() if k not in done}
+
+def serve_cached_prompts(code: str, prompts: Dict[str, str], folder: str, out_dir: str) -> Dict[str, str]:
+    """
+    Saves every prompt whose identical request is in the result cache (no upload, no API call)
+    and returns the prompts still to generate. A prompt whose last image failed QC is always
+    regenerated, so a rejected image is never served back.
+    """
+    if not RESULT_CACHE.lookups or not prompts:
+        return prompts
+    rows = STORE.prompt_rows(code)
+    remaining = {}
+    for key, prompt in prompts.items():
+        hit = cache_key = None
+        if (rows.get(key) or {}).get("status") != "qc_failed":
+            for model in KEYS.models():
+                cache_key = result_cache_key(prompt, folder, model)
+                hit = RESULT_CACHE.get(cache_key)
+                if hit is not None:
+                    break
+        if hit is None:
+            remaining[key] = prompt
+            continue
+        logger.info(f"[{code}] '{key}' served from the result cache")
+        save_output(code, key, out_dir, *hit, cache_key)
+    return remaining
+
+def report_reference_folder_problem(code: str):
+    _, candidates = REF_INDEX.resolve(code)
+    if candidates:
+        msg = f"Ambiguous reference folders for product_code '{code}' under {REFERENCE_ROOT}: {', '.join(candidates)}"
+    else:
+        msg = f"Reference folder not found for product_code '{code}' under {REFERENCE_ROOT}"
+    logger.warning(msg)
+    append_error({
+        "timestamp": now_str(),
+        "product_code": code,
+        "prompt": "n/a",
+        "error_code": "reference_folder_ambiguous" if candidates else "reference_folder_missing",
+        "error": msg
+    })
+    notify(
+        level="warning",
+        title="Missing references",
+        message=msg,
+        details={"Product": code, "Reference root": REFERENCE_ROOT},
+        attach_error_log=True,
+        priority=4,
+        tags=["warning"],
+        key="warning:reference_folder",
     )
 
-    if pause_on_error:
-        raise err
+def save_output(code: str, key: str, out_dir: str, raw_bytes: bytes, mime: str, cache_key: str | None = None) -> str:
+    """Writes the exact API bytes, records the prompt as done and hands it to QC, which puts it in
+    the result cache under `cache_key` if it passes (or drops that entry if it fails)."""
+    ext = mime_to_ext(mime)
+    raw_path = os.path.join(out_dir, f"{code}_{key}_raw{ext}")
+    with open(raw_path, "wb") as f:
+        f.write(raw_bytes)
+    logger.info(f"[{code}] Saved '{key}' to {raw_path} (bytes={len(raw_bytes)}, mime={mime})")
+    sha = hashlib.sha256(raw_bytes).hexdigest()
+    STORE.record_prompt(code, key, "done", output_path=raw_path, sha256=sha, mime=mime)
+    if LEASES is not None:
+        LEASES.record_prompt(code, key, raw_path, sha, mime)
+
+    # QC runs off-thread; failures come back through QC_STAGE and requeue the SKU
+    QC_STAGE.submit(code, key, raw_path, mime, cache_key)
+    return raw_path
+
+def process_sku(item: Dict, pause_on_error: bool, parallel_prompts: bool = False, only: set | None = None) -> bool:
+    """
+    Returns True only if the SKU fully succeeds (all prompts done).
+    Any exception/KeyboardInterrupt means the SKU is not marked complete.
+    With parallel_prompts, the four prompts run concurrently against the same uploaded refs.
+    `only` restricts generation to those prompt keys (replay); the others are left as they are.
+    In --shared-dir mode the SKU is claimed first and skipped if another worker holds it.
+    """
+    if LEASES is None:
+        return _process_sku(item, pause_on_error, parallel_prompts, only)
+    code = item["product_code"]
+    if not LEASES.claim(code):
+        logger.info(f"[{code}] Claimed by another worker (or already finished); skipping")
+        PREFETCH.discard(code)
+        return False
+    try:
+        ok = _process_sku(item, pause_on_error, parallel_prompts, only)
+    except KeyboardInterrupt:
+        LEASES.release(code)
+        raise
+    except Exception:
+        LEASES.finish(code, False)
+        raise
+    # A missing or ambiguous reference folder fails the same way every time: don't retry it
+    try:
+        missing_input = not ok and REF_INDEX.resolve(code)[0] is None
+    except OSError:
+        missing_input = False
+    LEASES.finish(code, ok, missing_input)
+    return ok
+
+def _end_without_generating(code: str, why: str) -> bool:
+    """No prompt left to generate here. With replay's `only` (or a QC rejection) the SKU can still
+    be missing other prompts, so it is only reported complete if the store agrees."""
+    if mark_sku_complete(code):
+        logger.info(f"===== END SKU {code} (SUCCESS, {why}) =====")
+        return True
+    logger.info(f"===== END SKU {code} ({why}; other prompts still outstanding) =====")
+    return False
 
-# -------------------- PER-SKU WORKFLOW --------------------
-def process_sku(item: Dict, pause_on_error: bool) -> bool:
-    """
-    Returns True only if the SKU fully succeeds (all prompts done).
-    Any exception/KeyboardInterrupt means the SKU is not marked complete.
-    """
+def _process_sku(item: Dict, pause_on_error: bool, parallel_prompts: bool, only: set | None = None) -> bool:
     code = item["product_code"]
     logger.info(f"===== START SKU {code} =====")
     logger.debug(f"SKU record: {json.dumps(item, ensure_ascii=False)[:2000]}")
 
     folder = find_folder_for_code(code)
     if not folder:
-        msg = f"Reference folder not found for product_code '{code}' under {REFERENCE_ROOT}"
-        logger.warning(msg)
-        append_error({
-            "timestamp": now_str(),
-            "product_code": code,
-            "prompt": "n/a",
-            "error_code": "reference_folder_missing",
-            "error": msg
-        })
-        notify(
-            level="warning",
-            title="Missing references",
-            message=msg,
-            details={"Product": code, "Reference root": REFERENCE_ROOT},
-            attach_error_log=True,
-            priority=4,
-            tags=["warning"]
-        )
+        PREFETCH.discard(code)
+        report_reference_folder_problem(code)
         logger.info(f"===== END SKU {code} (failed: missing refs) =====")
         return False
+    prefetched = PREFETCH.take(code, folder)
 
     out_dir = os.path.join(OUTPUT_ROOT, os.path.basename(folder))
     os.makedirs(out_dir, exist_ok=True)
     logger.debug(f"Output directory: {out_dir}")
 
-    # Upload references (with retries)
+    # Prompts to generate for this SKU; resume skips those already saved and verified
+    prompts = pending_prompts(code, sku_prompts(item))
+    if only is not None:
+        prompts = {k: v for k, v in prompts.items() if k in only}
+    if not prompts:
+        return _end_without_generating(code, "nothing left to generate")
+    logger.debug(f"Prompts prepared for {code}: keys={list(prompts.keys())}")
+
+    # Upload references (with retries), unless the result cache already answers every prompt
     try:
-        refs = upload_references(folder)
+        prompts = serve_cached_prompts(code, prompts, folder, out_dir)
+        if not prompts:
+            return _end_without_generating(code, "served from result cache")
+        t_sku = time.monotonic()
+        deadline = t_sku + SKU_DEADLINE_S if SKU_DEADLINE_S > 0 else None
+        with call_context(sku=code, prompt="upload", sku_deadline=deadline):
+            refs = sku_references(folder, prefetched)
     except Exception as e:
+        if isinstance(e, SkuDeadlineError):
+            WATCHDOG.note_sku_deadline()
         record_and_notify_error(
             product_code=code,
             prompt_key="upload",
-            error_code="upload_failed",
+            error_code="sku_deadline" if isinstance(e, SkuDeadlineError) else "upload_failed",
             err=e,
             extra={"Folder": folder},
             pause_on_error=pause_on_error,
@@ -567,85 +3646,41 @@ def process_sku(item: Dict, pause_on_error: bool) -> bool:
         logger.info(f"===== END SKU {code} (failed: upload) =====")
         return False
 
-    # Prompts to generate for this SKU
-    prompts = {
-        "top": item["ecomm_prompts"]["top"],
-        "side": item["ecomm_prompts"]["side"],
-        "front_45": item["ecomm_prompts"]["front_45"],
-        "lifestyle": item["lifestyle_prompt"],
-    }
-    logger.debug(f"Prompts prepared for {code}: keys={list(prompts.keys())}")
-
+    outcome = "error"
     try:
-        for key, prompt in prompts.items():
-            logger.info(f"[{code}] Generating '{key}' (len={len(prompt)} chars) using model={MODEL}, aspect={ASPECT_RATIO}")
-            try:
-                raw_bytes, mime = generate_one_image(prompt, refs)
-            except Exception as gen_err:
-                # Notify immediately on first failure (including "No image bytes returned from API"),
-                # then retry once as before.
-                err_msg = str(gen_err)
-                err_code = "gen_first_attempt_failed"
-                if isinstance(gen_err, RuntimeError) and "No image bytes returned from API" in err_msg:
-                    err_code = "no_image_bytes"
-
-                record_and_notify_error(
-                    product_code=code,
-                    prompt_key=key,
-                    error_code=err_code,
-                    err=gen_err,
-                    extra={"will_retry": True, "model": MODEL, "aspect_ratio": ASPECT_RATIO},
-                    pause_on_error=False,  # do not pause here; we retry once
-                )
-
-                logger.warning(f"[{code}] '{key}' generation failed once: {gen_err}. Retrying full prompt flow …")
-                raw_bytes, mime = generate_one_image(prompt, refs)
-
-            ext = mime_to_ext(mime)
-            raw_path = os.path.join(out_dir, f"{code}_{key}_raw{ext}")
-            with open(raw_path, "wb") as f:
-                f.write(raw_bytes)
-            logger.info(f"[{code}] Saved '{key}' to {raw_path} (bytes={len(raw_bytes)}, mime={mime})")
-
-            # QC: must be square (1:1)
-            img = Image.open(BytesIO(raw_bytes))
-            if not is_square(img):
-                msg = f"{code} {key}: image not square ({img.size[0]}x{img.size[1]})"
-                logger.warning(msg)
-                append_error({
-                    "timestamp": now_str(),
-                    "product_code": code,
-                    "prompt": key,
-                    "error_code": "not_square",
-                    "error": msg,
-                })
-                notify(
-                    level="warning",
-                    title=f"QC warning — {code} / {key} (not square)",
-                    message=msg,
-                    details={"Product": code, "Prompt": key, "Size": f"{img.size[0]} x {img.size[1]}", "Expected": "1:1"},
-                    attach_error_log=True,
-                    priority=4,
-                    tags=["warning", "ruler"]
-                )
-                if pause_on_error:
-                    raise RuntimeError(msg)
-
-        # All prompts done
-        mark_sku_complete(code)
+        if parallel_prompts:
+            with ThreadPoolExecutor(max_workers=len(prompts), thread_name_prefix=f"{code}-prompt") as pool:
+                future_map = {
+                    pool.submit(generate_prompt, code, key, prompt, refs, folder, out_dir, pause_on_error, deadline): key
+                    for key, prompt in prompts.items()
+                }
+                for fut in as_completed(future_map):
+                    fut.result()
+        else:
+            for key, prompt in prompts.items():
+                generate_prompt(code, key, prompt, refs, folder, out_dir, pause_on_error, deadline)
+        outcome = "ok"
+
+        # All prompts saved; a QC failure that already landed keeps the SKU open
+        if not mark_sku_complete(code):
+            logger.info(f"===== END SKU {code} (QC failure pending regeneration) =====")
+            return False
         logger.info(f"SKU complete: {code}")
         logger.info(f"===== END SKU {code} (SUCCESS) =====")
         return True
 
     except KeyboardInterrupt:
-        logger.info("Interrupted mid-SKU; not marking as complete. Re-run to restart this SKU.")
+        outcome = "interrupted"
+        logger.info("Interrupted mid-SKU; not marking as complete. Re-run to generate its remaining prompts.")
         raise
 
     except Exception as e:
+        if isinstance(e, SkuDeadlineError):
+            WATCHDOG.note_sku_deadline()
         record_and_notify_error(
             product_code=code,
             prompt_key="sku_run",
-            error_code="sku_run_exception",
+            error_code="sku_deadline" if isinstance(e, SkuDeadlineError) else "sku_run_exception",
             err=e,
             extra=None,
             pause_on_error=pause_on_error,
@@ -653,19 +3688,1386 @@ def process_sku(item: Dict, pause_on_error: bool) -> bool:
         logger.info(f"===== END SKU {code} (FAILED) =====")
         return False
 
+    finally:
+        with call_context(sku=code, prompt="upload"):
+            close_reference_context(refs)
+        inline_bytes = sum(len(r.inline_data.data) for r in refs) if ref_strategy_of(refs) == "inline" else 0
+        METRICS.record_sku(code, ref_strategy_of(refs), time.monotonic() - t_sku, outcome, len(prompts), inline_bytes)
+
+def _take_requeued(by_code: Dict[str, Dict], in_flight=()) -> List[Dict]:
+    items = [by_code[c] for c in QC_STAGE.take_requeues(skip=in_flight) if c in by_code]
+    for item in items:
+        logger.info(f"Requeueing {item['product_code']} after QC failure")
+    return items
+
+def run_sequential(pending_items: List[Dict], pause_on_error: bool) -> int:
+    """Original one-SKU-at-a-time loop, plus QC requeues. Returns the number of SKUs that completed."""
+    by_code = {item.get("product_code"): item for item in pending_items}
+    work = list(pending_items)
+    idx = 0
+    while True:
+        if idx >= len(work):
+            # End of pass: let outstanding QC land, then pick up anything it rejected
+            QC_STAGE.drain()
+            work.extend(_take_requeued(by_code))
+            if idx >= len(work) or STOP_EVENT.is_set():
+                break
+        item = work[idx]
+        idx += 1
+        code = item.get("product_code", "UNKNOWN")
+        logger.info(f"--- [{idx}/{len(work)}] Begin {code} ---")
+        PREFETCH.ahead(itertools.islice(work, idx, None))
+        try:
+            process_sku(item, pause_on_error=pause_on_error)
+            work.extend(_take_requeued(by_code))
+        except KeyboardInterrupt:
+            STOP_EVENT.set()
+            logger.info("Paused by user; exiting gracefully. Saved prompts are kept and skipped on resume.")
+            break
+        except Exception as e:
+            STOP_EVENT.set()
+            record_and_notify_error(
+                product_code=code,
+                prompt_key="run_loop",
+                error_code="fatal_run_stop",
+                err=e,
+                extra=None,
+                pause_on_error=False,
+            )
+            break
+        finally:
+            logger.info(f"--- [{idx}/{len(work)}] End {code} ---")
+    # QC verdicts can land after process_sku returned, so count from the store
+    return len(by_code.keys() & STORE.completed_skus())
+
+def run_parallel(pending_items: List[Dict], workers: int, pause_on_error: bool) -> int:
+    """
+    Runs up to `workers` SKUs at once, each fanning its prompts out in parallel.
+    Submission is bounded to the worker count so Ctrl+C / a fatal error stops new SKUs
+    from starting while in-flight prompts finish and get saved. SKUs rejected by QC are
+    fed back into the queue as soon as they are not in flight.
+    Returns the number of SKUs that completed successfully.
+    """
+    by_code = {item.get("product_code"): item for item in pending_items}
+    work = deque(pending_items)
+    total = len(pending_items)
+    started = 0
+    in_flight = {}
+
+    pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="sku")
+    try:
+        while True:
+            work.extend(_take_requeued(by_code, in_flight={c for _, c in in_flight.values()}))
+            while not STOP_EVENT.is_set() and len(in_flight) < workers and work:
+                item = work.popleft()
+                started += 1
+                total = max(total, started + len(work))
+                code = item.get("product_code", "UNKNOWN")
+                logger.info(f"--- [{started}/{total}] Begin {code} ---")
+                in_flight[pool.submit(process_sku, item, pause_on_error, True)] = (started, code)
+            PREFETCH.ahead(work)
+
+            if not in_flight:
+                if STOP_EVENT.is_set():
+                    break
+                # End of pass: let outstanding QC land, then pick up anything it rejected
+                QC_STAGE.drain()
+                work.extend(_take_requeued(by_code))
+                if not work:
+                    break
+                continue
+
+            # Short timeout keeps the main thread responsive to Ctrl+C (notably on Windows)
+            done, _ = wait(list(in_flight), timeout=0.5, return_when=FIRST_COMPLETED)
+            for fut in done:
+                idx, code = in_flight.pop(fut)
+                try:
+                    fut.result()
+                except KeyboardInterrupt:
+                    pass  # stop requested; process_sku already logged it
+                except Exception as e:
+                    STOP_EVENT.set()
+                    record_and_notify_error(
+                        product_code=code,
+                        prompt_key="run_loop",
+                        error_code="fatal_run_stop",
+                        err=e,
+                        extra=None,
+                        pause_on_error=False,
+                    )
+                finally:
+                    logger.info(f"--- [{idx}/{total}] End {code} ---")
+    except KeyboardInterrupt:
+        STOP_EVENT.set()
+        logger.info(f"Paused by user; giving {len(in_flight)} in-flight SKU(s) up to {SHUTDOWN_GRACE_S:.0f}s to finish "
+                    "their current calls. Saved prompts are kept and skipped on resume.")
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+    return len(by_code.keys() & STORE.completed_skus())
+
+# -------------------- BATCH MODE --------------------
+BATCH_DONE_STATES = {"JOB_STATE_SUCCEEDED", "JOB_STATE_PARTIALLY_SUCCEEDED"}
+BATCH_FAILED_STATES = {"JOB_STATE_FAILED", "JOB_STATE_CANCELLED", "JOB_STATE_EXPIRED"}
+
+def _state_name(state) -> str:
+    return getattr(state, "name", None) or str(state)
+
+def _upload_batch_file(path: str):
+    logger.debug(f"Uploading batch input file: {path}")
+    t0 = time.monotonic()
+    with UPLOAD_LIMITER.slot(), METRICS.call("batch_upload", wait_s=time.monotonic() - t0, bytes_in=os.path.getsize(path)):
+        return get_client().files.upload(file=path, config={"mime_type": "jsonl", "display_name": os.path.basename(path)})
+
+def _batch_call(kind: str, func: Callable[..., Any], **kwargs):
+    """A Batch API control call (create / get / download) under the upload limiter, so a 429 sets the
+    shared cooldown that retry_call's next attempt waits out instead of burning its attempts."""
+    t0 = time.monotonic()
+    with UPLOAD_LIMITER.slot(), METRICS.call(kind, wait_s=time.monotonic() - t0):
+        return func(**kwargs)
+
+def batch_request_key(code: str, key: str, folder: str, cache_key: str = "") -> str:
+    # '|' cannot appear in Windows folder names, so it is a safe separator.
+    # The trailing result cache key lets collection store results; older jobs lack it.
+    return f"{code}|{key}|{os.path.basename(folder)}|{cache_key}"
+
+def build_batch_request(prompt: str, refs: List[FileHandle]) -> Dict:
+    """One Batch API request body (REST JSON) equivalent to generate_one_image's call."""
+    parts = [{"fileData": {"fileUri": r.uri, "mimeType": r.mime_type or "image/jpeg"}} for r in refs]
+    parts.append({"text": prompt})
+    return {
+        "contents": [{"role": "user", "parts": parts}],
+        "generationConfig": {"responseModalities": RESP_MODALITIES, "imageConfig": {"aspectRatio": ASPECT_RATIO}},
+    }
+
+def _extract_inline_image(response: Dict) -> Tuple[bytes, str] | None:
+    for cand in response.get("candidates") or []:
+        for part in (cand.get("content") or {}).get("parts") or []:
+            blob = part.get("inlineData") or part.get("inline_data")
+            if blob and blob.get("data"):
+                return base64.b64decode(blob["data"]), blob.get("mimeType") or blob.get("mime_type") or "image/png"
+    return None
+
+def submit_batch_jobs(pending_items: List[Dict]) -> int:
+    """
+    Writes pending (SKU, prompt) requests to JSONL job files of at most BATCH_MAX_REQUESTS,
+    uploads them and creates Batch API jobs. Pairs already in an open job are skipped.
+    Returns the number of requests submitted.
+    """
+    os.makedirs(BATCH_DIR, exist_ok=True)
+    in_flight = STORE.batch_pairs_in_flight()
+    chunk: List[str] = []
+    pairs: List[Tuple[str, str]] = []
+    submitted = 0
+
+    def flush():
+        nonlocal chunk, pairs, submitted
+        if not chunk:
+            return
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        input_path = os.path.join(BATCH_DIR, f"batch_{stamp}_{submitted:06d}.jsonl")
+        with open(input_path, "w", encoding="utf-8") as f:
+            f.writelines(chunk)
+        src = retry_call(_upload_batch_file, input_path)
+        job = retry_call(_batch_call, "batch_create", get_client().batches.create, model=MODEL, src=src.name,
+                         config={"display_name": os.path.basename(input_path)})
+        STORE.add_batch_job(job.name, input_path, pairs)
+        logger.info(f"Batch job submitted: {job.name} ({len(pairs)} request(s), input={input_path})")
+        submitted += len(pairs)
+        chunk, pairs = [], []
+
+    for item in pending_items:
+        check_stop()
+        code = item["product_code"]
+        prompts = {k: v for k, v in pending_prompts(code, sku_prompts(item)).items() if (code, k) not in in_flight}
+        if not prompts:
+            continue
+        folder = find_folder_for_code(code)
+        if not folder:
+            report_reference_folder_problem(code)
+            continue
+        try:
+            out_dir = os.path.join(OUTPUT_ROOT, os.path.basename(folder))
+            os.makedirs(out_dir, exist_ok=True)
+            prompts = serve_cached_prompts(code, prompts, folder, out_dir)
+            if not prompts:
+                if mark_sku_complete(code):
+                    logger.info(f"SKU complete: {code} (served from result cache)")
+                continue
+            with call_context(sku=code, prompt="upload"):
+                refs = upload_references(folder, min_ttl_s=BATCH_MIN_REF_TTL_S, strategy="files", key=KEYS.primary)
+        except Exception as e:
+            record_and_notify_error(product_code=code, prompt_key="upload", error_code="upload_failed",
+                                    err=e, extra={"Folder": folder, "Mode": "batch"})
+            continue
+        for key, prompt in prompts.items():
+            req_key = batch_request_key(code, key, folder, result_cache_key(prompt, folder))
+            line = {"key": req_key, "request": build_batch_request(prompt, refs)}
+            chunk.append(json.dumps(line, ensure_ascii=False) + "\n")
+            pairs.append((code, key))
+            if len(pairs) >= BATCH_MAX_REQUESTS:
+                flush()
+    flush()
+    return submitted
+
+def collect_batch_results(job_name: str, result_path: str) -> Tuple[int, int]:
+    """
+    Streams a result JSONL line by line into output_images/<folder>/<code>_<key>_raw.<ext>,
+    recording each prompt in the run store exactly as interactive mode does.
+    Returns (saved, failed).
+    """
+    saved = failed = 0
+    touched = set()
+    with open(result_path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                rec = json.loads(line)
+            except json.JSONDecodeError as e:
+                # Truncated/corrupt line: the rest of the file is still good
+                failed += 1
+                logger.warning(f"Batch {job_name}: unreadable result line ({e}): {line[:200]}")
+                append_error({
+                    "timestamp": now_str(),
+                    "product_code": "n/a",
+                    "prompt": "batch",
+                    "error_code": "batch_bad_result_line",
+                    "error": f"{e}: {line[:500]}",
+                    "meta": {"batch_job": job_name, "result_path": result_path},
+                })
+                continue
+            try:
+                code, key, folder_name, *rest = rec["key"].split("|")
+            except (KeyError, ValueError):
+                logger.warning(f"Batch {job_name}: result without a usable key: {line[:200]}")
+                continue
+            touched.add(code)
+            image = _extract_inline_image(rec.get("response") or {})
+            usage = (rec.get("response") or {}).get("usageMetadata") or {}
+            prompt_tokens = usage.get("promptTokenCount", 0)
+            output_tokens = usage.get("candidatesTokenCount", 0) or (IMAGE_OUTPUT_TOKENS if image else 0)
+            METRICS.record({
+                "kind": "batch_result", "sku": code, "prompt": key, "attempt": 1,
+                "outcome": "ok" if image else "error", "error_code": None if image else "batch_no_image",
+                "bytes_in": 0, "bytes_out": len(image[0]) if image else 0,
+                "prompt_tokens": prompt_tokens, "output_tokens": output_tokens,
+                "est_cost_usd": round(CallMetrics.estimate_cost(prompt_tokens, output_tokens, batch=True), 6) if image else 0.0,
+                "batch_job": job_name,
+            })
+            if image is None:
+                failed += 1
+                err = rec.get("error") or rec.get("status") or "No image bytes returned from API"
+                STORE.record_prompt(code, key, "failed", error_code="batch_no_image")
+                append_error({
+                    "timestamp": now_str(),
+                    "product_code": code,
+                    "prompt": key,
+                    "error_code": "batch_no_image",
+                    "error": str(err)[:2000],
+                    "meta": {"batch_job": job_name},
+                })
+                continue
+            out_dir = os.path.join(OUTPUT_ROOT, folder_name)
+            os.makedirs(out_dir, exist_ok=True)
+            save_output(code, key, out_dir, *image, rest[0] if rest and rest[0] else None)
+            saved += 1
+    for code in touched:
+        if mark_sku_complete(code):
+            logger.info(f"SKU complete: {code} (batch)")
+    return saved, failed
+
+def poll_batch_jobs(poll_s: float) -> Tuple[int, int]:
+    """
+    Polls open jobs until all are collected (or the run is stopped; they then keep running
+    server-side and the next --batch run picks them up). Returns (saved, failed).
+    """
+    saved = failed = 0
+    while True:
+        jobs = STORE.open_batch_jobs()
+        if not jobs:
+            return saved, failed
+        for job in jobs:
+            check_stop()
+            remote = retry_call(_batch_call, "batch_get", get_client().batches.get, name=job["name"])
+            state = _state_name(remote.state)
+            if state != job["state"]:
+                logger.info(f"Batch job {job['name']}: {job['state']} -> {state}")
+                STORE.update_batch_job(job["name"], state)
+            if state in BATCH_DONE_STATES:
+                result_path = os.path.join(BATCH_DIR, f"{job['name'].replace('/', '_')}_results.jsonl")
+                retry_call(_batch_call, "batch_download", get_client().files.download,
+                           file=remote.dest.file_name, destination=result_path)
+                STORE.update_batch_job(job["name"], state, result_path=result_path)
+                ok, bad = collect_batch_results(job["name"], result_path)
+                saved, failed = saved + ok, failed + bad
+                STORE.update_batch_job(job["name"], "collected")
+                logger.info(f"Batch job {job['name']} collected: {ok} saved, {bad} failed")
+            elif state in BATCH_FAILED_STATES:
+                err = RuntimeError(f"Batch job {job['name']} ended in {state}: {getattr(remote, 'error', None)}")
+                record_and_notify_error(product_code="n/a", prompt_key="batch", error_code="batch_job_failed",
+                                        err=err, extra={"Job": job["name"], "Requests": job["requests"], "Input": job["input_path"]})
+                STORE.update_batch_job(job["name"], "collected")
+                failed += job["requests"]
+        if STORE.open_batch_jobs():
+            logger.info(f"{len(STORE.open_batch_jobs())} batch job(s) still running; next poll in {poll_s:.0f}s")
+            if STOP_EVENT.wait(poll_s):
+                check_stop()
+
+def run_batch(pending_items: List[Dict], poll_s: float) -> int:
+    """--batch: submit everything pending, then poll and collect. Returns SKUs completed."""
+    try:
+        n = submit_batch_jobs(pending_items)
+        logger.info(f"Submitted {n} request(s) in batch mode; polling every {poll_s:.0f}s (Ctrl+C to detach)")
+        saved, failed = poll_batch_jobs(poll_s)
+        logger.info(f"Batch results: {saved} image(s) saved, {failed} failed")
+        QC_STAGE.drain()
+    except KeyboardInterrupt:
+        STOP_EVENT.set()
+        logger.info("Detached from batch jobs; they keep running. Re-run with --batch to collect results.")
+    codes = {item.get("product_code") for item in pending_items}
+    return len(codes & STORE.completed_skus())
+
+# -------------------- GENERATION BACKENDS --------------------
+# A backend exposes the slice of the google-genai client this script uses:
+#   files.upload(file=, config=) / files.download(file=, destination=)
+#   models.generate_content(model=, contents=, config=)
+#   batches.create(model=, src=, config=) / batches.get(name=)
+#   caches.create(model=, config={contents, ttl}) / caches.delete(name=)
+#   file_handle(name, uri, mime_type) -> handle for a cached upload
+#   inline_part(data, mime_type) -> content part carrying image bytes in the request
+class GeminiBackend:
+    """The real API. google-genai is imported here, so commands that never call it start fast."""
+    name = "gemini"
+
+    def __init__(self, api_key: str):
+        from google import genai
+        from google.genai import types
+        self._types = types
+        # Just above the watchdog's timeouts, so an abandoned call's socket is closed soon after
+        http_timeout_s = max(GEN_TIMEOUT_S, UPLOAD_TIMEOUT_S) + 15
+        self._client = genai.Client(api_key=api_key, http_options=types.HttpOptions(timeout=int(http_timeout_s * 1000)))
+        self.files = self._client.files
+        self.models = self._client.models
+        self.batches = self._client.batches
+        self.caches = self._client.caches
+
+    def file_handle(self, name: str, uri: str, mime_type: str):
+        return self._types.File(name=name, uri=uri, mime_type=mime_type)
+
+    def inline_part(self, data: bytes, mime_type: str):
+        return self._types.Part.from_bytes(data=data, mime_type=mime_type)
+
+    def summary(self) -> str:
+        return "gemini"
+
+class SimulatedAPIError(Exception):
+    """Shaped like google.genai.errors.APIError (code/status/details/response) so is_quota_error,
+    retry_after_hint and retry_call treat simulated failures exactly like real ones."""
+    def __init__(self, code: int, status: str, message: str, retry_delay_s: float | None = None):
+        super().__init__(f"{code} {status}. {message}")
+        self.code = code
+        self.status = status
+        self.message = message
+        self.response = None
+        self.details = None
+        if retry_delay_s is not None:
+            self.details = {"error": {"code": code, "status": status, "message": message, "details": [
+                {"@type": "type.googleapis.com/google.rpc.RetryInfo", "retryDelay": f"{retry_delay_s:.3f}s"}]}}
+
+class SimulatedBackend:
+    """
+    Offline stand-in for the Files, Models and Batches APIs (--backend sim, benchmark).
+    - generate_content sleeps a lognormal latency (median latency_s, shape latency_sigma) and
+      returns a square white-background PNG of roughly image_kb, so QC and disk I/O do real work.
+    - error_rate / rate_429 / empty_rate: shares of calls that fail with a 500, get throttled
+      with a retry hint, or come back without an image. quota_rpm adds a server-side quota.
+    - hang_rate: share of calls that stall for SIM_HANG_FACTOR times their latency (the long tail).
+    - time_scale shrinks every simulated delay (0.01 = 100x faster than real time); hints and
+      reported latencies stay consistent with it.
+    - Batch jobs are "run" on a timer by writing a results JSONL (fail_rate of requests error).
+    """
+    name = "sim"
+
+    def __init__(self, root: str, latency_s: float = None, latency_sigma: float = None,
+                 upload_latency_s: float = None, error_rate: float = None, rate_429: float = None,
+                 empty_rate: float = None, image_kb: int = None, quota_rpm: float = None,
+                 hang_rate: float = None, time_scale: float = 1.0, job_latency_s: float = 2.0,
+                 fail_rate: float = 0.0, seed: int | None = None, label: str = "sim"):
+        self.root = root
+        self.label = label
+        self.latency_s = SIM_LATENCY_S if latency_s is None else latency_s
+        self.latency_sigma = SIM_LATENCY_SIGMA if latency_sigma is None else latency_sigma
+        self.upload_latency_s = SIM_UPLOAD_LATENCY_S if upload_latency_s is None else upload_latency_s
+        self.error_rate = SIM_ERROR_RATE if error_rate is None else error_rate
+        self.rate_429 = SIM_429_RATE if rate_429 is None else rate_429
+        self.empty_rate = SIM_EMPTY_RATE if empty_rate is None else empty_rate
+        self.image_kb = SIM_IMAGE_KB if image_kb is None else image_kb
+        self.quota_rpm = SIM_QUOTA_RPM if quota_rpm is None else quota_rpm
+        self.hang_rate = SIM_HANG_RATE if hang_rate is None else hang_rate
+        self.time_scale = time_scale
+        self.job_latency_s = job_latency_s
+        self.fail_rate = fail_rate
+        self.stats = {"ok": 0, "errors": 0, "throttled": 0, "empty": 0, "uploads": 0, "caches": 0}
+        self.latencies: List[float] = []    # simulated seconds per generate call
+        self._rng = random.Random(seed)
+        self._image = None
+        self._quota_window = deque()
+        self._paths: Dict[str, str] = {}
+        self._jobs: Dict[str, Dict] = {}
+        self._caches: Dict[str, Dict] = {}
+        self._n = 0
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+        self.files = _SimFiles(self)
+        self.models = _SimModels(self)
+        self.batches = _SimBatches(self)
+        self.caches = _SimCaches(self)
+
+    def _next(self, prefix: str) -> str:
+        with self._lock:
+            self._n += 1
+            return f"{prefix}/{self.label}-{os.getpid()}-{int(time.time())}-{self._n}"
+
+    def _path(self, name: str) -> str:
+        return self._paths.get(name) or os.path.join(self.root, name.replace("/", "_"))
+
+    def _sleep(self, sim_s: float):
+        time.sleep(sim_s * self.time_scale)
+
+    def _count(self, stat: str, latency: float | None = None):
+        with self._lock:
+            self.stats[stat] += 1
+            if latency is not None:
+                self.latencies.append(latency)
+
+    def _latency(self) -> float:
+        with self._lock:
+            latency = self.latency_s
+            if self.latency_sigma > 0:
+                latency *= self._rng.lognormvariate(0.0, self.latency_sigma)
+            if self.hang_rate > 0 and self._rng.random() < self.hang_rate:
+                latency *= SIM_HANG_FACTOR
+            return latency
+
+    def _roll(self) -> float:
+        with self._lock:
+            return self._rng.random()
+
+    def _over_quota(self) -> float | None:
+        """Simulated seconds until the server-side quota frees a slot, or None if under it."""
+        if self.quota_rpm <= 0:
+            return None
+        window = 60.0 * self.time_scale
+        now = time.monotonic()
+        with self._lock:
+            while self._quota_window and now - self._quota_window[0] >= window:
+                self._quota_window.popleft()
+            if len(self._quota_window) >= self.quota_rpm:
+                return (window - (now - self._quota_window[0])) / self.time_scale
+            self._quota_window.append(now)
+            return None
+
+    def image_bytes(self) -> bytes:
+        """A square PNG: white border, grey product box with an incompressible noise patch sized
+        so the file is about image_kb (built once and reused)."""
+        if self._image is None:
+            size = 1024
+            img = Image.new("RGB", (size, size), (255, 255, 255))
+            img.paste((90, 90, 90), (size // 4, size // 4, 3 * size // 4, 3 * size // 4))
+            side = min(size // 2, int((max(self.image_kb, 1) * 1024 / 3) ** 0.5))
+            if side > 0:
+                noise = np.random.default_rng(0).integers(0, 200, (side, side, 3), dtype=np.uint8)
+                img.paste(Image.fromarray(noise), ((size - side) // 2, (size - side) // 2))
+            buf = io.BytesIO()
+            img.save(buf, "PNG", compress_level=1)
+            self._image = buf.getvalue()
+        return self._image
+
+    def file_handle(self, name: str, uri: str, mime_type: str):
+        return SimpleNamespace(name=name, uri=uri, mime_type=mime_type, expiration_time=None)
+
+    def inline_part(self, data: bytes, mime_type: str):
+        return SimpleNamespace(inline_data=SimpleNamespace(data=data, mime_type=mime_type), text=None)
+
+    def _run_job(self, job: Dict):
+        lines = []
+        with open(self._path(job["src"]), "r", encoding="utf-8") as f:
+            for line in f:
+                rec = json.loads(line)
+                if self._roll() < self.fail_rate:
+                    lines.append({"key": rec["key"], "error": {"code": 500, "message": "simulated failure"}})
+                    continue
+                data = base64.b64encode(self.image_bytes()).decode("ascii")
+                lines.append({"key": rec["key"], "response": {"candidates": [{"content": {"parts": [
+                    {"inlineData": {"mimeType": "image/png", "data": data}}]}}]}})
+        out = self._next("files")
+        with open(self._path(out), "w", encoding="utf-8") as f:
+            for rec in lines:
+                f.write(json.dumps(rec) + "\n")
+        job["dest"] = SimpleNamespace(file_name=out)
+        job["state"] = "JOB_STATE_SUCCEEDED"
+
+    def summary(self) -> str:
+        st = self.stats
+        calls = st["ok"] + st["errors"] + st["throttled"] + st["empty"]
+        return (f"sim: generate={calls} (ok={st['ok']}, throttled={st['throttled']}, "
+                f"errors={st['errors']}, empty={st['empty']}), uploads={st['uploads']}, caches={st['caches']}")
+
+class _SimFiles:
+    def __init__(self, sim: SimulatedBackend):
+        self.sim = sim
+
+    def upload(self, file: str, config=None):
+        self.sim._sleep(self.sim.upload_latency_s)
+        self.sim._count("uploads")
+        name = self.sim._next("files")
+        self.sim._paths[name] = os.path.abspath(file)   # nothing is copied; the source stays put
+        mime = (config or {}).get("mime_type") if isinstance(config, dict) else None
+        return SimpleNamespace(name=name, uri=f"sim://{name}", mime_type=mime or "image/jpeg",
+                               expiration_time=datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=UPLOAD_TTL_S))
+
+    def download(self, file: str, destination: str | None = None, config=None):
+        with open(self.sim._path(file), "rb") as f:
+            data = f.read()
+        if destination is None:
+            return data
+        with open(destination, "wb") as f:
+            f.write(data)
+        return None
+
+class _SimModels:
+    def __init__(self, sim: SimulatedBackend):
+        self.sim = sim
+
+    def generate_content(self, model: str, contents, config=None):
+        sim = self.sim
+        wait_s = sim._over_quota()
+        if wait_s is not None:
+            sim._sleep(0.2)
+            sim._count("throttled")
+            raise SimulatedAPIError(429, "RESOURCE_EXHAUSTED", f"Quota exceeded. Please retry in {wait_s:.1f}s.",
+                                    retry_delay_s=wait_s * sim.time_scale)
+        roll = sim._roll()
+        if roll < sim.rate_429:
+            sim._sleep(0.2)
+            sim._count("throttled")
+            hint = 5.0 + 25.0 * sim._roll()
+            raise SimulatedAPIError(429, "RESOURCE_EXHAUSTED", f"Quota exceeded. Please retry in {hint:.1f}s.",
+                                    retry_delay_s=hint * sim.time_scale)
+        latency = sim._latency()
+        roll -= sim.rate_429
+        if roll < sim.error_rate:
+            sim._sleep(latency * 0.5)
+            sim._count("errors")
+            raise SimulatedAPIError(500, "INTERNAL", "Simulated internal error.")
+        cached = 0
+        if (config or {}).get("cached_content"):
+            cached = sim.caches.tokens(config["cached_content"])
+        sim._sleep(latency)
+        roll -= sim.error_rate
+        refs = sum(1 for c in contents if not isinstance(c, str))
+        text = sum(len(c) for c in contents if isinstance(c, str))
+        prompt_tokens = 258 * refs + text // 4 + cached
+        usage = SimpleNamespace(prompt_token_count=prompt_tokens, candidates_token_count=1290,
+                                cached_content_token_count=cached, total_token_count=prompt_tokens + 1290)
+        if roll < sim.empty_rate:
+            sim._count("empty", latency)
+            return SimpleNamespace(candidates=[SimpleNamespace(content=None)], usage_metadata=usage)
+        sim._count("ok", latency)
+        blob = SimpleNamespace(data=sim.image_bytes(), mime_type="image/png")
+        part = SimpleNamespace(inline_data=blob, text=None)
+        return SimpleNamespace(candidates=[SimpleNamespace(content=SimpleNamespace(parts=[part]))], usage_metadata=usage)
+
+class _SimBatches:
+    def __init__(self, sim: SimulatedBackend):
+        self.sim = sim
+
+    def create(self, model: str, src: str, config=None):
+        job = {"name": self.sim._next("batches"), "src": src, "state": "JOB_STATE_PENDING", "dest": None}
+        self.sim._jobs[job["name"]] = job
+        timer = threading.Timer(self.sim.job_latency_s * self.sim.time_scale, self.sim._run_job, args=(job,))
+        timer.daemon = True
+        timer.start()
+        return self.get(job["name"])
+
+    def get(self, name: str, config=None):
+        job = self.sim._jobs.get(name)
+        if job is None:
+            return SimpleNamespace(name=name, state="JOB_STATE_EXPIRED", dest=None, error="unknown job")
+        return SimpleNamespace(name=name, state=job["state"], dest=job["dest"], error=None)
+
+class _SimCaches:
+    """Cached contents: each image part counts 258 tokens; expired or deleted ones are rejected
+    like the API does."""
+    def __init__(self, sim: SimulatedBackend):
+        self.sim = sim
+
+    def create(self, model: str, config=None):
+        self.sim._sleep(self.sim.upload_latency_s)
+        self.sim._count("caches")
+        contents = config["contents"]
+        tokens = 258 * sum(1 for c in contents if not isinstance(c, str)) + sum(len(c) // 4 for c in contents if isinstance(c, str))
+        ttl_s = float(str(config.get("ttl", "3600s")).rstrip("s"))
+        name = self.sim._next("cachedContents")
+        with self.sim._lock:
+            self.sim._caches[name] = {"tokens": tokens, "expires": time.monotonic() + ttl_s * self.sim.time_scale}
+        return SimpleNamespace(name=name, model=model, usage_metadata=SimpleNamespace(total_token_count=tokens))
+
+    def tokens(self, name: str) -> int:
+        with self.sim._lock:
+            cache = self.sim._caches.get(name)
+        if cache is None or time.monotonic() > cache["expires"]:
+            raise SimulatedAPIError(403, "PERMISSION_DENIED", f"CachedContent not found (or permission denied): {name}")
+        return cache["tokens"]
+
+    def delete(self, name: str, config=None):
+        with self.sim._lock:
+            self.sim._caches.pop(name, None)
+
+# -------------------- API KEY POOL --------------------
+class KeyBenchedError(RuntimeError):
+    """References are bound to a benched key while another key is live; the caller re-uploads
+    them there rather than waiting out the bench."""
+
+def is_auth_error(err: Exception) -> bool:
+    """The key itself was refused: invalid, disabled, or without access to the model."""
+    code = getattr(err, "code", None)
+    text = str(err).lower()
+    if code == 401:
+        return True
+    if code == 403:
+        return not is_stale_file_error(err)
+    return code == 400 and ("api key" in text or "api_key_invalid" in text)
+
+def parse_key_pool(spec: str) -> List[Tuple[str, str | None]]:
+    """'KEY1,KEY2@models/x' -> [(KEY1, None), (KEY2, 'models/x')]; blanks and duplicates dropped."""
+    out, seen = [], set()
+    for entry in spec.replace("\n", ",").split(","):
+        api_key, _, model = entry.strip().partition("@")
+        if api_key and api_key not in seen:
+            seen.add(api_key)
+            out.append((api_key, model.strip() or None))
+    return out
+
+class PoolKey:
+    """One API key: its own client, generate/upload limiters, counters and bench state."""
+    def __init__(self, key_id: str, backend, model: str | None, gen_limiter: AdaptiveLimiter, upload_limiter: AdaptiveLimiter):
+        self.id = key_id
+        self.backend = backend
+        self.model = model
+        self.limiters = {"generate": gen_limiter, "upload": upload_limiter}
+        self.benched_until = 0.0
+        self.bench_reason = ""
+        self.calls = 0
+        self.ok = 0
+        self.throttles = 0
+        self.auth_errors = 0
+        self.benches = 0
+
+    def benched(self) -> bool:
+        return time.monotonic() < self.benched_until
+
+    def headroom(self, kind: str) -> float:
+        return self.limiters[kind].headroom()
+
+    @contextmanager
+    def slot(self, kind: str):
+        """The key's limiter slot for one call; quota and auth errors bench the key."""
+        with self.limiters[kind].slot():
+            self.calls += 1
+            try:
+                yield
+            except Exception as e:
+                KEYS.note_error(self, e)
+                raise
+            self.ok += 1
+
+    def summary(self) -> str:
+        state = f"benched ({self.bench_reason}, {self.benched_until - time.monotonic():.0f}s left)" if self.benched() else "active"
+        return (f"{self.id}{'@' + self.model if self.model else ''}: {state}; calls={self.calls}, ok={self.ok}, "
+                f"throttled={self.throttles}, auth_errors={self.auth_errors}, benched {self.benches}x")
+
+class KeyPool:
+    """
+    Routes calls across API keys (GEMINI_API_KEYS, or just GEMINI_API_KEY):
+    - pick() returns the unbenched key whose limiter has the most headroom, waiting if every
+      key is benched for a short while and failing fast if all are out for long.
+    - Uploaded files and cached contexts belong to the creating key's project: bind() records
+      the owner and route() sends any call using them to the same key.
+    - A 429 benches the key for its retry-after hint (KEY_BENCH_DAILY_S for a per-day quota);
+      an auth error benches it for KEY_BENCH_AUTH_S and sends one notification per key.
+    - Work pinned to a benched key waits out a short bench (wait_for); it only moves, by
+      re-uploading, when another key is live.
+    """
+    def __init__(self, keys: List[PoolKey]):
+        self.keys = keys
+        self.primary = keys[0]   # batch jobs (and anything else that needs one fixed key)
+        self._owners: Dict[str, PoolKey] = {}
+        self._lock = threading.Lock()
+
+    def models(self) -> List[str]:
+        return list(dict.fromkeys(k.model or MODEL for k in self.keys))
+
+    def bind(self, fobj, key: PoolKey):
+        with self._lock:
+            self._owners[getattr(fobj, "name", None)] = key
+
+    def route(self, parts, cached_content: str | None = None) -> PoolKey:
+        names = [cached_content] if cached_content else []
+        names += [getattr(p, "name", None) for p in parts
+                  if not isinstance(p, str) and getattr(p, "inline_data", None) is None]
+        for name in names:
+            with self._lock:
+                owner = self._owners.get(name)
+            if owner is not None:
+                self.wait_for(owner, "References were uploaded with")
+                return owner
+        return self.pick("generate")
+
+    def others_live(self, key: PoolKey) -> bool:
+        return any(not k.benched() for k in self.keys if k is not key)
+
+    def wait_for(self, key: PoolKey, what: str = "Work is pinned to"):
+        """
+        Returns once `key` is off the bench. Raises KeyBenchedError if another key is live (move
+        the work there instead), or RuntimeError if the bench is long, as pick() does.
+        """
+        while key.benched():
+            check_stop()
+            if self.others_live(key):
+                raise KeyBenchedError(f"{what} {key.id}, which is benched ({key.bench_reason})")
+            wait_s = key.benched_until - time.monotonic()
+            if wait_s > RETRY_MAX_DELAY_S * 3:
+                raise RuntimeError(f"{what} {key.id}, which is benched ({key.bench_reason}) for another {wait_s:.0f}s")
+            logger.debug(f"{key.id} benched ({key.bench_reason}); waiting {wait_s:.1f}s")
+            STOP_EVENT.wait(max(wait_s, 0.05))
+
+    def pick(self, kind: str) -> PoolKey:
+        while True:
+            check_stop()
+            live = [k for k in self.keys if not k.benched()]
+            if live:
+                # Tiny jitter so threads picking at the same instant spread across equal keys
+                return max(live, key=lambda k: k.headroom(kind) + random.random() * 1e-3)
+            wait_s = min(k.benched_until for k in self.keys) - time.monotonic()
+            if wait_s > RETRY_MAX_DELAY_S * 3:
+                raise RuntimeError(f"All {len(self.keys)} API key(s) are benched; the first returns in {wait_s:.0f}s")
+            if len(self.keys) > 1:
+                logger.warning(f"All API keys benched; waiting {wait_s:.1f}s")
+            STOP_EVENT.wait(max(wait_s, 0.05))
+
+    def bench(self, key: PoolKey, seconds: float, reason: str) -> bool:
+        """False if the key is already benched at least that long (calls that were in flight)."""
+        with self._lock:
+            until = time.monotonic() + seconds
+            if key.benched() and (until <= key.benched_until or reason == key.bench_reason):
+                return False
+            key.benched_until = until
+            key.bench_reason = reason
+            key.benches += 1
+        if len(self.keys) > 1 or seconds > THROTTLE_COOLDOWN_S:
+            logger.warning(f"{key.id} benched for {seconds:.0f}s ({reason})")
+        return True
+
+    def note_error(self, key: PoolKey, err: Exception):
+        if is_quota_error(err):
+            key.throttles += 1
+            text = str(err)
+            if "perday" in text.lower().replace(" ", "").replace("_", ""):
+                self.bench(key, KEY_BENCH_DAILY_S, "daily quota exhausted")
+            else:
+                hint = retry_after_hint(err)
+                self.bench(key, hint if hint is not None else THROTTLE_COOLDOWN_S, "quota")
+        elif is_auth_error(err):
+            key.auth_errors += 1
+            if not self.bench(key, KEY_BENCH_AUTH_S, f"auth error {getattr(err, 'code', '')}".strip()):
+                return
+            notify(
+                level="warning",
+                title=f"API key {key.id} benched",
+                message=f"{key.id} was refused ({err}); it is out of rotation for {KEY_BENCH_AUTH_S:.0f}s",
+                details={"Key": key.id, "Model": key.model or MODEL, "Keys in pool": len(self.keys)},
+                attach_error_log=False,
+                priority=4,
+                tags=["warning", "key"],
+                key=f"warning:key_auth:{key.id}",
+            )
+
+    def summary_lines(self) -> List[str]:
+        return [k.summary() for k in self.keys]
+
+# Set by init_backend()
+KEYS: KeyPool | None = None
+
+def init_backend(kind: str, keys: int | None = None, **sim_options):
+    """
+    Creates the key pool and the module client (its primary key's backend). Each pooled key
+    gets its own limiters; the first reuses GEN_LIMITER/UPLOAD_LIMITER. `keys` simulated keys
+    (default SIM_KEYS) each have their own quota. Non-gemini backends get their own upload
+    cache so simulated handles never end up in upload_cache.jsonl.
+    """
+    global client, UPLOAD_CACHE, KEYS
+    if kind == "sim":
+        root = sim_options.pop("root", None) or os.path.join(BATCH_DIR, "sim_endpoint")
+        seed = sim_options.pop("seed", None)
+        backends = [(f"sim-{i + 1}", None, SimulatedBackend(root, label=f"sim{i + 1}", seed=None if seed is None else seed + i,
+                                                            **sim_options))
+                    for i in range(keys or SIM_KEYS)]
+        UPLOAD_CACHE = UploadCache(os.path.join(root, "upload_cache.jsonl"))
+    elif kind == "gemini":
+        specs = parse_key_pool(GEMINI_API_KEYS) or ([(GEMINI_API_KEY, None)] if GEMINI_API_KEY else [])
+        if not specs:
+            logger.error("GEMINI_API_KEY (or GEMINI_API_KEYS) is missing in .env")
+            sys.exit(1)
+        backends = [(api_key_id(api_key), model, GeminiBackend(api_key)) for api_key, model in specs]
+    else:
+        raise ValueError(f"Unknown backend '{kind}' (use gemini or sim)")
+    pool = []
+    for i, (key_id, model, backend) in enumerate(backends):
+        if i == 0:
+            pool.append(PoolKey(key_id, backend, model, GEN_LIMITER, UPLOAD_LIMITER))
+        else:
+            pool.append(PoolKey(key_id, backend, model, GEN_LIMITER.spawn(f"generate[{key_id}]"),
+                                UPLOAD_LIMITER.spawn(f"upload[{key_id}]")))
+    KEYS = KeyPool(pool)
+    client = pool[0].backend
+    logger.debug(f"Backend initialised: {client.name} with {len(pool)} key(s): {', '.join(k.id for k in pool)}")
+    return client
+
+def get_client():
+    if client is None:
+        init_backend(BACKEND)
+    return client
+
+# -------------------- BENCHMARK --------------------
+def build_synthetic_catalogue(root: str, skus: int, refs_per_sku: int) -> List[Dict]:
+    """Writes <root>/refs/<CODE> - Bench product/ref_N.jpg and returns prompts.json-style items."""
+    items = []
+    rng = random.Random(0)
+    for i in range(skus):
+        code = f"BENCH{i:05d}"
+        folder = os.path.join(root, "refs", f"{code} - Bench product {i}")
+        os.makedirs(folder, exist_ok=True)
+        for r in range(refs_per_sku):
+            img = Image.new("RGB", (640, 640), (255, 255, 255))
+            img.paste(tuple(rng.randrange(40, 200) for _ in range(3)), (160, 160, 480, 480))
+            img.save(os.path.join(folder, f"ref_{r + 1}.jpg"), "JPEG", quality=85)
+        items.append({
+            "product_code": code,
+            "ecomm_prompts": {k: f"Studio {k} shot of bench product {i} on a pure white background."
+                              for k in WHITE_BG_PROMPTS},
+            "lifestyle_prompt": f"Lifestyle shot of bench product {i} in a bright kitchen.",
+        })
+    return items
+
+@contextmanager
+def module_overrides(**values):
+    """Rebinds module globals for the duration (benchmark runs) and restores them afterwards."""
+    g = globals()
+    saved = {name: g[name] for name in values}
+    g.update(values)
+    try:
+        yield
+    finally:
+        g.update(saved)
+
+def run_benchmark(args, work: str) -> Dict[str, Any]:
+    """
+    The benchmark harness: runs the real scheduling/retry/QC/store code against the simulated
+    backend on a synthetic catalogue written under `work` (notifications off). Delays, retry
+    backoff and limiter rates are all divided by args.time_scale. Every module global it
+    reconfigures (paths, stores, limiters, the key pool, the SIGINT handler) is restored before
+    it returns, and nothing is written outside `work`. Returns the measurements, in simulated time.
+    """
+    scale = args.time_scale
+    items = build_synthetic_catalogue(work, args.skus, args.refs)
+    prompt_latencies: List[float] = []
+    inner = generate_prompt
+    def timed_generate_prompt(*a, **kw):
+        # Prompt latency = generate_prompt wall time (retries and limiter waits included)
+        t0 = time.monotonic()
+        try:
+            return inner(*a, **kw)
+        finally:
+            prompt_latencies.append((time.monotonic() - t0) / scale)
+
+    overrides = module_overrides(
+        REFERENCE_ROOT=os.path.join(work, "refs"),
+        OUTPUT_ROOT=os.path.join(work, "output_images"),
+        ERROR_FILE=os.path.join(work, "error_log.jsonl"),
+        BATCH_DIR=os.path.join(work, "batch_jobs"),
+        REF_CACHE_DIR=os.path.join(work, REF_CACHE_DIR),
+        NOTIFY_ENABLED=False,
+        RETRY_BASE_DELAY_S=RETRY_BASE_DELAY_S * scale,
+        RETRY_MAX_DELAY_S=RETRY_MAX_DELAY_S * scale,
+        THROTTLE_COOLDOWN_S=THROTTLE_COOLDOWN_S * scale,
+        GEN_TIMEOUT_S=GEN_TIMEOUT_S * scale,
+        UPLOAD_TIMEOUT_S=UPLOAD_TIMEOUT_S * scale,
+        SKU_DEADLINE_S=SKU_DEADLINE_S * scale,
+        BREAKER=CircuitBreaker(BREAKER_WINDOW_S * scale, open_s=BREAKER_OPEN_S * scale, max_open_s=BREAKER_MAX_OPEN_S * scale),
+        STORE=RunStore(os.path.join(work, RUN_DB_FILE)),
+        RESULT_CACHE=ResultCache(os.path.join(work, RESULT_CACHE_DIR), RESULT_CACHE_MAX_BYTES),
+        METRICS=CallMetrics(os.path.join(work, METRICS_DIR)),
+        QC_STAGE=QCStage(),
+        WATCHDOG=Watchdog(),
+        HEDGER=Hedger(args.hedge),
+        PREFETCH=ReferencePrefetcher(args.prefetch),
+        GEN_LIMITER=AdaptiveLimiter("generate", GEN_RPM / scale, GEN_MAX_CONCURRENCY),
+        UPLOAD_LIMITER=AdaptiveLimiter("upload", UPLOAD_RPM / scale, UPLOAD_MAX_CONCURRENCY),
+        generate_prompt=timed_generate_prompt,
+        # Rebound by init_backend(); listed so they are put back too
+        KEYS=KEYS, client=client, UPLOAD_CACHE=UPLOAD_CACHE,
+    )
+    previous_sigint = signal.signal(signal.SIGINT, lambda sig, frame: (_ for _ in ()).throw(KeyboardInterrupt()))
+    try:
+        with overrides:
+            init_backend("sim", keys=args.keys, root=os.path.join(work, "sim_endpoint"), latency_s=args.latency,
+                         latency_sigma=args.latency_sigma, error_rate=args.error_rate, rate_429=args.rate_429,
+                         empty_rate=args.empty_rate, image_kb=args.image_kb, quota_rpm=args.quota_rpm,
+                         hang_rate=args.hang_rate, time_scale=scale, seed=0)
+            sims = [k.backend for k in KEYS.keys]
+            t0 = time.monotonic()
+            try:
+                if args.workers > 1:
+                    completed = run_parallel(items, args.workers, False)
+                else:
+                    completed = run_sequential(items, False)
+                QC_STAGE.drain()
+            finally:
+                PREFETCH.close()
+                QC_STAGE.close()
+                HEDGER.drain(GEN_TIMEOUT_S)
+                METRICS.close()
+            wall = time.monotonic() - t0
+            saved = sum(1 for it in items for r in STORE.prompt_rows(it["product_code"]).values() if r["status"] == "done")
+            STORE.close()
+            stats = {k: sum(sim.stats[k] for sim in sims) for k in sims[0].stats}
+            return {
+                "skus": len(items),
+                "completed": completed,
+                "saved": saved,
+                "wall_s": wall,
+                "sim_hours": wall / scale / 3600.0,
+                "prompt_latencies": prompt_latencies,
+                "call_latencies": [v for sim in sims for v in sim.latencies],
+                "stats": stats,
+                "calls": sum(stats[k] for k in ("ok", "errors", "throttled", "empty")),
+                "spend": METRICS.spend,
+                "images": METRICS.images,
+                "summaries": {
+                    "limiters": f"{GEN_LIMITER.summary()}; {UPLOAD_LIMITER.summary()}",
+                    "circuit": BREAKER.summary(),
+                    "hedging": HEDGER.summary() if HEDGER.pct > 0 else None,
+                    "watchdog": WATCHDOG.summary(),
+                    "prefetch": PREFETCH.summary(),
+                    "keys": KEYS.summary_lines() if len(KEYS.keys) > 1 else [],
+                },
+            }
+    finally:
+        signal.signal(signal.SIGINT, previous_sigint)
+
+def cmd_benchmark(args):
+    """
+    `imagen.py benchmark`: run_benchmark() in a scratch directory, then a report of throughput in
+    simulated time, so the numbers correspond to a real-time run at full speed. Logs go to the
+    console only (warnings, or everything with -vv).
+    """
+    work = args.dir or tempfile.mkdtemp(prefix="imagen_bench_")
+    os.makedirs(work, exist_ok=True)
+    init_logging(force_debug=args.very_verbose, log_file=None)
+    logger.setLevel(logging.DEBUG if args.very_verbose else logging.WARNING)
+    print(f"Benchmark: {args.skus} SKU(s) x {len(PROMPT_KEYS)} prompts, workers={args.workers}, "
+          f"time scale={args.time_scale:g}, work dir={work}")
+    try:
+        r = run_benchmark(args, work)
+    finally:
+        if not args.keep and not args.dir:
+            shutil.rmtree(work, ignore_errors=True)
+    stats, sim_hours = r["stats"], r["sim_hours"]
+    print(f"  wall time            {r['wall_s']:.1f}s ({sim_hours * 3600:.0f}s simulated)")
+    print(f"  SKUs completed       {r['completed']}/{r['skus']}")
+    print(f"  SKUs/hour            {r['completed'] / sim_hours if sim_hours else 0.0:.1f}")
+    print(f"  prompt latency       p50={percentile(r['prompt_latencies'], 50):.1f}s  "
+          f"p95={percentile(r['prompt_latencies'], 95):.1f}s  (call p50={percentile(r['call_latencies'], 50):.1f}s)")
+    print(f"  generate calls       {r['calls']} for {r['saved']} saved image(s); wasted={r['calls'] - r['saved']} "
+          f"(throttled={stats['throttled']}, errors={stats['errors']}, empty={stats['empty']})")
+    print(f"  uploads              {stats['uploads']}")
+    print(f"  estimated spend      ${r['spend']:.2f} ({r['images']} image(s))")
+    summaries = r["summaries"]
+    print(f"  limiters             {summaries['limiters']}")
+    print(f"  circuit              {summaries['circuit']}")
+    if summaries["hedging"]:
+        print(f"  hedging              {summaries['hedging']}")
+    print(f"  watchdog             {summaries['watchdog']}")
+    print(f"  prefetch             {summaries['prefetch']}")
+    for line in summaries["keys"]:
+        print(f"  key                  {line}")
+
+# -------------------- STATUS --------------------
+STATUS_WINDOWS = ((300, "5m"), (900, "15m"), (3600, "1h"))
+
+class _JsonlTail:
+    """Returns the JSONL records appended since the last read (starts over if the file shrank)."""
+    def __init__(self, path: str):
+        self.path = path
+        self.offset = 0
+
+    def read(self) -> List[Dict]:
+        try:
+            size = os.path.getsize(self.path)
+        except OSError:
+            return []
+        if size < self.offset:
+            self.offset = 0
+        out = []
+        with open(self.path, "rb") as f:
+            f.seek(self.offset)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break   # still being written; picked up next time
+                self.offset += len(line)
+                try:
+                    out.append(json.loads(line))
+                except ValueError:
+                    continue
+        return out
+
+class RunStatus:
+    """
+    `imagen.py status`: progress from the run store and prompts file, throughput from prompt
+    completion times, API error rate from the metrics JSONL and top codes from the journal.
+    Metrics and journal files are tailed, so --watch refreshes only read what was appended.
+    """
+    def __init__(self):
+        self._tails: Dict[str, _JsonlTail] = {}
+        self._calls: List[Tuple[float, str]] = []    # (ts, outcome) of generate calls
+        self._errors: List[Tuple[float, str]] = []   # (ts, error_code) from the journal
+
+    def _poll(self, now: float):
+        horizon = now - STATUS_WINDOWS[-1][0]
+        paths = [ERROR_FILE]
+        if os.path.isdir(METRICS_DIR):
+            paths += [os.path.join(METRICS_DIR, n) for n in sorted(os.listdir(METRICS_DIR)) if n.endswith(".jsonl")]
+        for path in paths:
+            tail = self._tails.get(path)
+            if tail is None:
+                try:
+                    if os.path.getmtime(path) < horizon:
+                        continue   # nothing recent in it
+                except OSError:
+                    continue
+                tail = self._tails[path] = _JsonlTail(path)
+            for rec in tail.read():
+                if path == ERROR_FILE:
+                    self._errors.append((_entry_ts(rec), rec.get("error_code", "unknown")))
+                elif rec.get("kind") == "generate":
+                    self._calls.append((rec.get("ts", 0.0), rec.get("outcome", "ok")))
+        self._calls = [c for c in self._calls if c[0] >= horizon]
+        self._errors = [e for e in self._errors if e[0] >= horizon]
+
+    def render(self, now: float | None = None) -> List[str]:
+        now = now or time.time()
+        self._poll(now)
+        codes = list(dict.fromkeys(item.get("product_code") for item in load_json(PROMPTS_FILE, []) if item.get("product_code")))
+        rows = STORE.prompt_states() if os.path.exists(RUN_DB_FILE) else []
+        completed = (STORE.completed_skus() if os.path.exists(RUN_DB_FILE) else set()) & set(codes)
+        states: Dict[str, Dict[str, str]] = {}
+        for code, key, status, _ in rows:
+            states.setdefault(code, {})[key] = status
+        open_codes = [c for c in codes if c not in completed]
+        failed = {c for c in open_codes if {"failed", "qc_failed"} & set(states.get(c, {}).values())}
+        partial = {c for c in open_codes if c not in failed and "done" in states.get(c, {}).values()}
+        left = sum(len(PROMPT_KEYS) - sum(1 for k in PROMPT_KEYS if states.get(c, {}).get(k) == "done") for c in open_codes)
+
+        out = [f"imagen status — {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(now))} ({os.path.abspath(RUN_DB_FILE)})"]
+        out.append(f"  SKUs        {len(codes)} total: {len(completed)} completed, {len(partial)} in progress, "
+                   f"{len(failed)} with failed prompts, {len(open_codes) - len(partial) - len(failed)} not started")
+        done_ts = [t for _, _, status, t in rows if status == "done"]
+        # A run younger than a window is measured over its own age (at least a minute)
+        started = min([t for t, _ in self._calls] + [t for t in done_ts if t >= now - STATUS_WINDOWS[-1][0]], default=now)
+        rates = {}
+        for window, label in STATUS_WINDOWS:
+            span = max(60.0, min(window, now - started))
+            rates[label] = sum(1 for t in done_ts if t >= now - window) * 3600.0 / span
+        out.append("  images/hour " + ", ".join(f"{rates[label]:.0f} ({label})" for _, label in STATUS_WINDOWS))
+        rate = rates["15m"] or rates["1h"]
+        if not left:
+            out.append("  ETA         nothing left")
+        elif rate:
+            out.append(f"  ETA         {left} prompt(s) left, ~{datetime.timedelta(seconds=int(left / rate * 3600))} "
+                       f"at {rate:.0f}/hour")
+        else:
+            out.append(f"  ETA         {left} prompt(s) left; no images saved in the last hour")
+
+        recent = [o for t, o in self._calls if t >= now - 900]
+        if recent:
+            errors = sum(1 for o in recent if o == "error")
+            throttled = sum(1 for o in recent if o == "throttle")
+            out.append(f"  API (15m)   {len(recent)} generate call(s): error rate {errors / len(recent):.0%}, "
+                       f"throttled {throttled / len(recent):.0%}")
+        else:
+            out.append("  API (15m)   no generate calls")
+        last = max([t for t, _ in self._calls] + done_ts, default=0.0)
+        if last:
+            out.append(f"  last activity {now - last:.0f}s ago")
+        counts: Dict[str, int] = {}
+        for _, code in self._errors:
+            counts[code] = counts.get(code, 0) + 1
+        if counts:
+            out.append("  top errors (1h): " + ", ".join(f"{code} x{n}" for code, n in sorted(counts.items(), key=lambda kv: -kv[1])[:5]))
+        return out
+
+def cmd_status(args):
+    """`imagen.py status [--watch [S]]`: one report, or a refreshing one until Ctrl+C. Needs no API key
+    and writes nothing: the run store is opened read-only and logging is left unconfigured."""
+    globals()["STORE"] = RunStore(RUN_DB_FILE, readonly=True)
+    status = RunStatus()
+    if not args.watch:
+        print("\n".join(status.render()))
+        return
+    try:
+        while True:
+            print("\033[2J\033[H" + "\n".join(status.render()), flush=True)
+            STORE.close()   # reopen next time: a run may have started or finished meanwhile
+            time.sleep(args.watch)
+    except KeyboardInterrupt:
+        pass
+
+# -------------------- REPLAY --------------------
+# Failures of the SKU's inputs: regenerating can't fix them until someone fixes the input
+MANUAL_ERROR_CODES = {"reference_folder_missing", "reference_folder_ambiguous", "prompts_missing"}
+
+def needs_manual_action(error_code: str) -> bool:
+    return error_code in MANUAL_ERROR_CODES or error_code.startswith("preflight_")
+
+def replay_targets(sku: str | None = None, codes: set | None = None, since: float | None = None,
+                   until: float | None = None) -> Tuple[Dict[str, Dict[str, str]], Dict[str, str]]:
+    """
+    ({code: {prompt_key: last error_code}}, {code: error_code}) for journaled failures that still
+    have no verified output. Entries not tied to one prompt (upload, sku_run, n/a, ...) stand for
+    every prompt of the SKU; a prompt that failed once and was saved on a retry drops out here.
+    SKUs whose latest failure is a bad input (needs_manual_action) go to the second dict instead:
+    a replay would only fail the same way. A later replayable failure means a run got past the
+    input, so the SKU is a target again.
+    """
+    targets: Dict[str, Dict[str, str]] = {}
+    manual: Dict[str, str] = {}
+    for e in iter_errors(sku=sku, codes=codes, since=since, until=until):
+        code = e.get("product_code")
+        if not code or code == "n/a" or e.get("prompt") == "startup":
+            continue
+        err = e.get("error_code", "unknown")
+        if needs_manual_action(err):
+            manual[code] = err
+            targets.pop(code, None)
+            continue
+        manual.pop(code, None)
+        if e.get("prompt") in PROMPT_KEYS:
+            targets.setdefault(code, {})[e["prompt"]] = err
+            continue
+        for k in PROMPT_KEYS:
+            # A prompt's own error code is more telling than the SKU-level one
+            targets.setdefault(code, {}).setdefault(k, err)
+    for code in list(targets):
+        rows = STORE.prompt_rows(code)
+        left = {k: c for k, c in targets[code].items() if not verified_output(rows.get(k))}
+        if left:
+            targets[code] = left
+        else:
+            del targets[code]
+    for code in list(manual):
+        rows = STORE.prompt_rows(code)
+        if all(verified_output(rows.get(k)) for k in PROMPT_KEYS):
+            del manual[code]
+    return targets, manual
+
+def _prompt_state(row: Dict | None) -> str:
+    if verified_output(row):
+        return "done"
+    if not row:
+        return "missing"
+    return f"{row['status']} ({row['error_code']})" if row.get("error_code") else row["status"]
+
+def cmd_replay(args):
+    """
+    `imagen.py replay`: regenerates exactly the (SKU, prompt) pairs that the error journal shows
+    failing, SKUs in parallel (--workers) with each SKU's prompts fanned out as in a normal run.
+    References come through the usual upload cache, so live Files API handles are reused. The
+    run store and state.json are updated and a before/after line is printed per pair. SKUs whose
+    inputs are at fault are listed for manual action instead. --dry-run writes no files.
+    """
+    if args.dry_run:
+        globals()["STORE"] = RunStore(RUN_DB_FILE, readonly=True)
+    targets, manual = replay_targets(sku=args.sku, codes=set(args.code) if args.code else None,
+                                     since=args.since, until=args.until)
+    if manual:
+        print(f"Needs manual action, not replayed ({len(manual)} SKU(s)):")
+        for code, err in sorted(manual.items()):
+            print(f"  {code}: {err}")
+    by_code = {item.get("product_code"): item for item in load_json(PROMPTS_FILE, [])}
+    unknown = sorted(c for c in targets if c not in by_code)
+    for code in unknown:
+        print(f"Skipping {code}: not in {PROMPTS_FILE}")
+        del targets[code]
+    pairs = sum(len(v) for v in targets.values())
+    if not pairs:
+        print("Nothing to replay: no matching failure is still missing its output.")
+        return
+    print(f"Replaying {pairs} prompt(s) across {len(targets)} SKU(s)")
+    if args.dry_run:
+        for code, keys in sorted(targets.items()):
+            print(f"  {code}: " + ", ".join(f"{k} [{c}]" for k, c in sorted(keys.items())))
+        return
+
+    before = {code: {k: _prompt_state(row) for k, row in STORE.prompt_rows(code).items()} for code in targets}
+    apply_run_options(args)
+    init_backend(args.backend)
+    signal.signal(signal.SIGINT, lambda sig, frame: (_ for _ in ()).throw(KeyboardInterrupt()))
+    logger.info(f"=== Replay starting: {pairs} prompt(s), {len(targets)} SKU(s), {args.workers} worker(s) ===")
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, args.workers), thread_name_prefix="replay") as pool:
+            futures = {pool.submit(process_sku, by_code[code], False, True, set(keys)): code
+                       for code, keys in targets.items()}
+            try:
+                for fut in as_completed(futures):
+                    try:
+                        fut.result()
+                    except Exception as e:
+                        logger.error(f"[{futures[fut]}] Replay failed: {e}")
+            except KeyboardInterrupt:
+                STOP_EVENT.set()
+                for fut in futures:
+                    fut.cancel()
+                logger.info("Replay interrupted; prompts saved so far are kept.")
+        # Let outstanding QC verdicts land; a rejection shows up below instead of being requeued
+        QC_STAGE.drain()
+    finally:
+        QC_STAGE.close()
+        STORE.export_state_json(STATE_FILE)
+        NOTIFIER.close()
+        METRICS.close()
+
+    fixed = 0
+    completed = STORE.completed_skus()
+    for code, keys in sorted(targets.items()):
+        rows = STORE.prompt_rows(code)
+        for k, err in sorted(keys.items()):
+            after = _prompt_state(rows.get(k))
+            fixed += after == "done"
+            was = before[code].get(k, "missing")
+            print(f"  {'FIXED ' if after == 'done' else 'FAILED'}  {code}/{k}  [{err}] {was} -> {after}")
+    done_skus = sum(1 for code in targets if code in completed)
+    print(f"Replay: {fixed} of {pairs} prompt(s) fixed, {pairs - fixed} still failing; "
+          f"{done_skus} of {len(targets)} SKU(s) now complete")
+    for line in METRICS.summary_lines():
+        logger.info(f"Metrics — {line}")
+
 # -------------------- CLI --------------------
+def apply_run_options(args):
+    """CLI overrides shared by a run and `replay`."""
+    QC_STAGE.pause_on_error = args.pause_on_error
+    RESULT_CACHE.lookups = not args.no_cache
+    globals()["REF_MAX_EDGE_PX"] = args.ref_max_edge
+    globals()["REF_STRATEGY"] = args.ref_strategy
+    globals()["REF_CONTEXT"] = args.ref_context
+    HEDGER.pct = args.hedge
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--pause-on-error", action="store_true", help="Pause (exit) on first error.")
     parser.add_argument("--stop-after", type=int, default=DEFAULT_STOP_AFTER,
                         help="Max SKUs to process this run (0 means ALL).")
     parser.add_argument("--very-verbose", action="store_true", help="Force DEBUG logging for this run.")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS,
+                        help="SKUs to process concurrently; >1 also runs each SKU's prompts in parallel (default 1).")
+    parser.add_argument("--batch", action="store_true",
+                        help="Submit pending prompts as Gemini Batch API jobs, then poll and collect results.")
+    parser.add_argument("--batch-poll", type=float, default=BATCH_POLL_S, help="Seconds between batch job polls.")
+    parser.add_argument("--shared-dir",
+                        help="Coordinate with other processes/hosts through lease files in this shared directory.")
+    parser.add_argument("--preflight", action="store_true",
+                        help=f"Validate pending SKUs offline first; failures go to {PREFLIGHT_REPORT} and are skipped.")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="Don't serve prompts from the result cache (fresh results are still stored).")
+    parser.add_argument("--ref-max-edge", type=int, default=REF_MAX_EDGE_PX,
+                        help=f"Downscale references to this long edge before upload (0 = upload originals; default {REF_MAX_EDGE_PX}).")
+    parser.add_argument("--ref-strategy", choices=["auto", "inline", "files"], default=REF_STRATEGY,
+                        help=f"Send references inline or via the Files API; auto inlines up to {REF_INLINE_MAX_BYTES} bytes per SKU.")
+    parser.add_argument("--ref-context", choices=["request", "cache"], default=REF_CONTEXT,
+                        help="'cache' puts each SKU's references in a cached context shared by its prompts "
+                             "instead of sending them with every request.")
+    parser.add_argument("--prefetch", type=int, default=PREFETCH_SKUS, metavar="K",
+                        help=f"Prepare/upload references for the next K queued SKUs while generating (0 = off; default {PREFETCH_SKUS}).")
+    parser.add_argument("--hedge", type=float, default=HEDGE_PERCENTILE, metavar="PCT",
+                        help="Duplicate a generate call still running past this percentile of recent latencies (0 = off).")
+    parser.add_argument("--backend", choices=["gemini", "sim"], default=BACKEND,
+                        help="'sim' runs against the offline simulator (SIM_* settings) instead of the API.")
+
+    sub = parser.add_subparsers(dest="command")
+    p_err = sub.add_parser("errors", help="Query the error journal (streams; does not load it all).")
+    p_err.add_argument("--sku", help="Only this product_code.")
+    p_err.add_argument("--code", action="append", help="Only this error_code (repeatable).")
+    p_err.add_argument("--prompt", help="Only this prompt key (top/side/front_45/lifestyle/upload/...).")
+    p_err.add_argument("--since", type=parse_time_arg, help="From time: 'YYYY-MM-DD[ HH:MM[:SS]]' or age like 2h.")
+    p_err.add_argument("--until", type=parse_time_arg, help="Up to time (same formats as --since).")
+    p_err.add_argument("--limit", type=int, default=0, help="Stop after N entries (0 = no limit).")
+    p_err.add_argument("--json", action="store_true", help="Print raw JSON lines.")
+    p_err.add_argument("--summary", action="store_true", help="Print counts by error_code and SKU instead of entries.")
+    p_status = sub.add_parser("status", help="Progress, throughput, ETA and error rate of the current/last run (no API key needed).")
+    p_status.add_argument("--watch", type=float, nargs="?", const=10.0, default=0.0, metavar="SECONDS",
+                          help="Refresh every SECONDS (default 10) until Ctrl+C.")
+    p_replay = sub.add_parser("replay", help="Regenerate only the (SKU, prompt) pairs the error journal shows failing.")
+    p_replay.add_argument("--sku", help="Only this product_code.")
+    p_replay.add_argument("--code", action="append", help="Only failures with this error_code (repeatable).")
+    p_replay.add_argument("--since", type=parse_time_arg, help="Failures from this time: 'YYYY-MM-DD[ HH:MM[:SS]]' or age like 2h.")
+    p_replay.add_argument("--until", type=parse_time_arg, help="Failures up to this time (same formats as --since).")
+    p_replay.add_argument("--workers", type=int, default=4, help="SKUs replayed concurrently (default 4).")
+    p_replay.add_argument("--dry-run", action="store_true", help="List what would be replayed and exit.")
+    p_bench = sub.add_parser("benchmark", help="Measure throughput on a synthetic catalogue with the simulated backend.")
+    p_bench.add_argument("--skus", type=int, default=100, help="Synthetic SKUs to generate (default 100).")
+    p_bench.add_argument("--workers", type=int, default=8, help="SKU workers, as for a normal run (default 8).")
+    p_bench.add_argument("--refs", type=int, default=3, help="Reference JPGs per SKU (default 3).")
+    p_bench.add_argument("--latency", type=float, default=SIM_LATENCY_S, help="Median generate latency in seconds.")
+    p_bench.add_argument("--latency-sigma", type=float, default=SIM_LATENCY_SIGMA, help="Lognormal latency shape (0 = constant).")
+    p_bench.add_argument("--error-rate", type=float, default=SIM_ERROR_RATE, help="Share of calls failing with a 500.")
+    p_bench.add_argument("--rate-429", type=float, default=SIM_429_RATE, help="Share of calls throttled at random.")
+    p_bench.add_argument("--empty-rate", type=float, default=SIM_EMPTY_RATE, help="Share of responses without an image.")
+    p_bench.add_argument("--image-kb", type=int, default=SIM_IMAGE_KB, help="Approximate size of returned images.")
+    p_bench.add_argument("--hang-rate", type=float, default=SIM_HANG_RATE,
+                         help=f"Share of calls that stall for {SIM_HANG_FACTOR:g}x their latency.")
+    p_bench.add_argument("--hedge", type=float, default=HEDGE_PERCENTILE, metavar="PCT",
+                         help="Hedge generate calls past this latency percentile (0 = off).")
+    p_bench.add_argument("--prefetch", type=int, default=PREFETCH_SKUS, metavar="K",
+                         help="Reference look-ahead in SKUs (0 = off).")
+    p_bench.add_argument("--quota-rpm", type=float, default=SIM_QUOTA_RPM, help="Simulated server-side quota (0 = none).")
+    p_bench.add_argument("--keys", type=int, default=SIM_KEYS, help="Simulated API keys in the pool, each with its own quota.")
+    p_bench.add_argument("--time-scale", type=float, default=0.01,
+                         help="Wall seconds per simulated second (default 0.01 = 100x faster); results are reported in simulated time.")
+    p_bench.add_argument("--dir", help="Work directory (kept afterwards); default is a temporary directory.")
+    p_bench.add_argument("--keep", action="store_true", help="Keep the temporary work directory.")
     args = parser.parse_args()
 
-    if args.very_verbose:
-        # Reinitialise logging at DEBUG if requested
-        globals()["logger"] = init_logging(force_debug=True)
-        log_env_summary()
+    if args.command == "errors":
+        cmd_errors(args)
+        return
+    if args.command == "status":
+        cmd_status(args)
+        return
+
+    if args.command == "benchmark":
+        cmd_benchmark(args)
+        return
+    if args.command == "replay" and args.dry_run:
+        cmd_replay(args)
+        return
+    globals()["logger"] = init_logging(force_debug=args.very_verbose)
+    log_env_summary()
+    if args.command == "replay":
+        cmd_replay(args)
+        return
+    if args.batch and args.shared_dir:
+        parser.error("--shared-dir coordinates interactive workers; submit --batch jobs from one host")
 
     # Convert Ctrl+C into KeyboardInterrupt immediately
     signal.signal(signal.SIGINT, lambda sig, frame: (_ for _ in ()).throw(KeyboardInterrupt()))
@@ -692,10 +5094,14 @@ def main():
             priority=5,
             tags=["rotating_light"]
         )
+        NOTIFIER.close()
         return
 
     # Resume: skip SKUs already completed in previous runs
     completed = load_completed_skus()
+    if args.shared_dir:
+        globals()["LEASES"] = WorkLeases(args.shared_dir)
+        LEASES.publish_done(completed & {item.get("product_code") for item in data})
     pending_items = [item for item in data if item.get("product_code") not in completed]
     logger.info(f"Pending SKUs: {len(pending_items)} (completed already: {len(completed)})")
 
@@ -708,34 +5114,68 @@ def main():
         logger.info(f"Applying stop-after cap: {args.stop_after}")
         pending_items = pending_items[: args.stop_after]
 
-    processed_success = 0
+    if args.preflight:
+        pending_items = run_preflight(pending_items)
+        if not pending_items:
+            logger.error(f"No SKU passed preflight; see {PREFLIGHT_REPORT}")
+            NOTIFIER.close()
+            sys.exit(1)
+
     total = len(pending_items)
     logger.info(f"Processing {total} SKU(s) this run")
+    apply_run_options(args)
+    PREFETCH.depth = args.prefetch
 
-    for idx, item in enumerate(pending_items, start=1):
-        code = item.get("product_code", "UNKNOWN")
-        logger.info(f"--- [{idx}/{total}] Begin {code} ---")
-        try:
-            ok = process_sku(item, pause_on_error=args.pause_on_error)
-            if ok:
-                processed_success += 1
-        except KeyboardInterrupt:
-            logger.info("Paused by user; exiting gracefully. Progress saved for completed SKUs only.")
-            break
-        except Exception as e:
-            record_and_notify_error(
-                product_code=code,
-                prompt_key="run_loop",
-                error_code="fatal_run_stop",
-                err=e,
-                extra=None,
-                pause_on_error=False,
-            )
-            break
-        finally:
-            logger.info(f"--- [{idx}/{total}] End {code} ---")
+    init_backend(args.backend)
+    if args.backend != "gemini":
+        logger.info(f"Backend: {args.backend} (no API calls are made)")
+
+    try:
+        if args.batch:
+            logger.info("Batch mode: requests go through the Gemini Batch API")
+            processed_success = run_batch(pending_items, args.batch_poll)
+        else:
+            if args.workers > 1:
+                logger.info(f"Parallel mode: {args.workers} SKU worker(s), {len(PROMPT_KEYS)} prompt thread(s) per SKU")
+                run_pass = lambda items: run_parallel(items, args.workers, args.pause_on_error)
+            else:
+                run_pass = lambda items: run_sequential(items, args.pause_on_error)
+            if LEASES is not None:
+                LEASES.start()
+                processed_success = run_shared(pending_items, run_pass)
+            else:
+                processed_success = run_pass(pending_items)
+    finally:
+        # Mirror completed SKUs for state.json consumers (one write per run, not per SKU)
+        PREFETCH.close()
+        QC_STAGE.close()
+        if LEASES is not None:
+            LEASES.close()
+        HEDGER.drain(SHUTDOWN_GRACE_S if STOP_EVENT.is_set() else GEN_TIMEOUT_S)
+        STORE.export_state_json(STATE_FILE)
+        NOTIFIER.close()
+        METRICS.close()
 
     logger.info(f"Run complete. Successful SKUs this run: {processed_success}/{total}")
+    logger.info(f"Rate limits — {GEN_LIMITER.summary()}; {UPLOAD_LIMITER.summary()}")
+    if BREAKER.trips:
+        logger.info(f"Circuit — {BREAKER.summary()}")
+    if HEDGER.pct > 0:
+        logger.info(f"Hedging — {HEDGER.summary()}")
+    if WATCHDOG.abandoned or WATCHDOG.sku_deadlines:
+        logger.info(f"Watchdog — {WATCHDOG.summary()}")
+    if PREFETCH.depth > 0 and not args.batch:
+        logger.info(f"Prefetch — {PREFETCH.summary()}")
+    if len(KEYS.keys) > 1:
+        for line in KEYS.summary_lines():
+            logger.info(f"Key pool — {line}")
+    logger.info(f"Result cache — {RESULT_CACHE.summary()}")
+    for line in METRICS.summary_lines():
+        logger.info(f"Metrics — {line}")
+    logger.info(f"Per-call metrics: {METRICS.path}")
+    if args.backend != "gemini":
+        for k in KEYS.keys:
+            logger.info(f"Backend — {k.backend.summary()}")
     logger.info("=== Run finished ===")
 
 if __name__ == "__main__":
@@ -0,0 +1,66 @@
+"""
+Shared fixtures: every test runs in its own scratch directory against the simulated backend,
+with the module's stores, caches and limiters swapped for fresh ones (restored afterwards).
+"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import imagen  # noqa: E402
+
+
+@pytest.fixture
+def work(tmp_path, monkeypatch):
+    """Scratch directory as the working directory, with fresh module state and notifications off."""
+    monkeypatch.chdir(tmp_path)
+    fresh = dict(
+        REFERENCE_ROOT=str(tmp_path / "refs"),
+        OUTPUT_ROOT=str(tmp_path / "output_images"),
+        ERROR_FILE=str(tmp_path / "error_log.jsonl"),
+        BATCH_DIR=str(tmp_path / "batch_jobs"),
+        REF_CACHE_DIR=str(tmp_path / "ref_cache"),
+        PROMPTS_FILE=str(tmp_path / "prompts_new.json"),
+        STATE_FILE=str(tmp_path / "state.json"),
+        NOTIFY_ENABLED=False,
+        RETRY_BASE_DELAY_S=0.01,
+        RETRY_MAX_DELAY_S=0.05,
+        THROTTLE_COOLDOWN_S=0.05,
+        SIM_LATENCY_S=0.01,
+        SIM_LATENCY_SIGMA=0.0,
+        SIM_UPLOAD_LATENCY_S=0.0,
+        SIM_IMAGE_KB=8,
+        STORE=imagen.RunStore(str(tmp_path / "run_state.sqlite3")),
+        RESULT_CACHE=imagen.ResultCache(str(tmp_path / "gen_cache"), imagen.RESULT_CACHE_MAX_BYTES),
+        METRICS=imagen.CallMetrics(str(tmp_path / "metrics")),
+        NOTIFIER=imagen.NotificationDispatcher(),
+        QC_STAGE=imagen.QCStage(workers=0),
+        REF_INDEX=imagen.ReferenceIndex(),
+        BREAKER=imagen.CircuitBreaker(),
+        HEDGER=imagen.Hedger(0),
+        PREFETCH=imagen.ReferencePrefetcher(0),
+        GEN_LIMITER=imagen.AdaptiveLimiter("generate", 60000, 8),
+        UPLOAD_LIMITER=imagen.AdaptiveLimiter("upload", 60000, 4),
+    )
+    for name in ("KEYS", "client", "UPLOAD_CACHE", "LEASES"):
+        monkeypatch.setattr(imagen, name, getattr(imagen, name))
+    for name, value in fresh.items():
+        monkeypatch.setattr(imagen, name, value)
+    monkeypatch.setattr(imagen.signal, "signal", lambda *a: None)
+    imagen.STOP_EVENT.clear()
+    yield tmp_path
+    imagen.QC_STAGE.close()
+    imagen.STORE.close()
+    imagen.METRICS.close()
+    imagen.STOP_EVENT.clear()
+
+
+@pytest.fixture
+def catalogue(work):
+    """Two synthetic SKUs (two references each) written to the prompts file, plus a sim backend."""
+    items = imagen.build_synthetic_catalogue(str(work), 2, 2)
+    imagen.save_json(imagen.PROMPTS_FILE, items)
+    imagen.init_backend("sim", root=str(work / "sim_endpoint"), seed=0)
+    return items
@@ -0,0 +1,65 @@
+import json
+import time
+
+import imagen
+
+
+def start_batch_backend(work):
+    return imagen.init_backend("sim", root=str(work / "sim_endpoint"), seed=0, job_latency_s=0.05)
+
+
+def test_batch_submit_and_collect(catalogue, work):
+    start_batch_backend(work)
+
+    completed = imagen.run_batch(catalogue, poll_s=0.02)
+
+    assert completed == len(catalogue)
+    for item in catalogue:
+        rows = imagen.STORE.prompt_rows(item["product_code"])
+        assert all(imagen.verified_output(rows.get(k)) for k in imagen.PROMPT_KEYS)
+    assert imagen.STORE.open_batch_jobs() == []
+
+
+def test_batch_poll_waits_out_a_429(catalogue, work, monkeypatch):
+    # The quota stays exhausted for a while: without a limiter cooldown every retry attempt would
+    # hit it back to back and the job would be given up
+    sim = start_batch_backend(work)
+    assert imagen.submit_batch_jobs(catalogue) == len(catalogue) * len(imagen.PROMPT_KEYS)
+    get = sim.batches.get
+    until = []
+
+    def throttled_get(name, config=None):
+        if not until:
+            until.append(time.monotonic() + 0.3)
+        if time.monotonic() < until[0]:
+            raise imagen.SimulatedAPIError(429, "RESOURCE_EXHAUSTED", "Quota exceeded", retry_delay_s=0.3)
+        return get(name, config)
+
+    monkeypatch.setattr(sim.batches, "get", throttled_get)
+
+    saved, failed = imagen.poll_batch_jobs(0.02)
+    assert (saved, failed) == (len(catalogue) * len(imagen.PROMPT_KEYS), 0)
+    assert imagen.UPLOAD_LIMITER.throttles >= 1
+
+
+def test_collect_skips_malformed_result_lines(catalogue, work):
+    start_batch_backend(work)
+    imagen.submit_batch_jobs(catalogue)
+    job = imagen.STORE.open_batch_jobs()[0]
+    while imagen.get_client().batches.get(job["name"]).state != "JOB_STATE_SUCCEEDED":
+        time.sleep(0.01)
+    remote = imagen.get_client().batches.get(job["name"])
+    result_path = str(work / "results.jsonl")
+    imagen.get_client().files.download(file=remote.dest.file_name, destination=result_path)
+    with open(result_path, encoding="utf-8") as f:
+        lines = f.readlines()
+    lines.insert(1, lines[0][: len(lines[0]) // 2] + "\n")   # truncated copy of the first result
+
+    with open(result_path, "w", encoding="utf-8") as f:
+        f.writelines(lines)
+    saved, failed = imagen.collect_batch_results(job["name"], result_path)
+
+    assert (saved, failed) == (len(lines) - 1, 1)
+    with open(imagen.ERROR_FILE, encoding="utf-8") as f:
+        codes = [json.loads(line)["error_code"] for line in f]
+    assert codes == ["batch_bad_result_line"]
@@ -0,0 +1,43 @@
+import argparse
+import os
+import subprocess
+import sys
+
+import imagen
+
+
+def bench_args(**overrides):
+    args = dict(skus=3, workers=2, refs=2, latency=1.0, latency_sigma=0.0, error_rate=0.0, rate_429=0.0,
+                empty_rate=0.0, image_kb=8, hang_rate=0.0, hedge=0.0, prefetch=1, quota_rpm=0.0, keys=1,
+                time_scale=0.01)
+    args.update(overrides)
+    return argparse.Namespace(**args)
+
+
+def test_benchmark_harness_measures_and_restores_module_state(work):
+    before = {name: getattr(imagen, name) for name in (
+        "OUTPUT_ROOT", "REFERENCE_ROOT", "STORE", "METRICS", "QC_STAGE", "GEN_LIMITER", "KEYS", "client",
+        "UPLOAD_CACHE", "generate_prompt", "GEN_TIMEOUT_S", "NOTIFY_ENABLED")}
+    bench_dir = work / "bench"
+    bench_dir.mkdir()
+
+    result = imagen.run_benchmark(bench_args(), str(bench_dir))
+
+    assert result["completed"] == 3
+    assert result["saved"] == 3 * len(imagen.PROMPT_KEYS)
+    assert len(result["prompt_latencies"]) == result["saved"]
+    assert result["calls"] == result["saved"]   # no faults configured, so nothing wasted
+    assert all(getattr(imagen, name) is value for name, value in before.items())
+    assert sorted(os.listdir(work)) == ["bench"]
+
+
+def test_benchmark_command_writes_nothing_to_the_working_directory(tmp_path):
+    script = os.path.join(os.path.dirname(os.path.abspath(imagen.__file__)), "imagen.py")
+
+    out = subprocess.run([sys.executable, script, "benchmark", "--skus", "2", "--workers", "2", "--refs", "1",
+                          "--latency", "1", "--image-kb", "8", "--time-scale", "0.01"],
+                         cwd=str(tmp_path), capture_output=True, text=True, timeout=300)
+
+    assert out.returncode == 0, out.stderr
+    assert "SKUs completed       2/2" in out.stdout
+    assert os.listdir(tmp_path) == []
@@ -0,0 +1,99 @@
+import threading
+import time
+
+import pytest
+import requests
+
+import imagen
+
+
+def api_error(code, status="ERROR"):
+    return imagen.SimulatedAPIError(code, status, "simulated")
+
+
+@pytest.mark.parametrize("err, outage", [
+    (api_error(500, "INTERNAL"), True),
+    (api_error(503, "UNAVAILABLE"), True),
+    (imagen.CallTimeoutError("generate took too long"), True),
+    (ConnectionResetError("reset by peer"), True),
+    (requests.exceptions.ConnectionError("refused"), True),
+    (api_error(429, "RESOURCE_EXHAUSTED"), False),
+    (api_error(400, "INVALID_ARGUMENT"), False),
+    (imagen.KeyBenchedError("benched"), False),
+    (ValueError("bad argument"), False),
+    (TypeError("programming error"), False),
+])
+def test_outage_classification(err, outage):
+    assert imagen.is_outage_error(err) is outage
+
+
+def test_httpx_transport_errors_are_outages():
+    httpx = pytest.importorskip("httpx")
+    assert imagen.is_outage_error(httpx.ConnectError("connection refused"))
+    assert imagen.is_outage_error(httpx.ReadTimeout("timed out"))
+
+
+def breaker(**kw):
+    return imagen.CircuitBreaker(window_s=60, min_calls=3, error_rate=0.5, open_s=kw.get("open_s", 0.2), max_open_s=1.0)
+
+
+def fail(b, err):
+    with pytest.raises(type(err)):
+        with b.guard():
+            raise err
+
+
+def trip(b):
+    for _ in range(3):
+        fail(b, api_error(503, "UNAVAILABLE"))
+    assert b.state == "open"
+
+
+def admit_in_threads(b, n):
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(b.admit()), daemon=True) for _ in range(n)]
+    for t in threads:
+        t.start()
+    return results, threads
+
+
+def test_local_errors_do_not_trip_the_breaker(work):
+    b = breaker()
+    for err in (ValueError("x"), TypeError("y"), imagen.KeyBenchedError("z")) * 2:
+        fail(b, err)
+
+    assert b.state == "closed"
+    assert b.trips == 0
+
+
+def test_closed_open_half_open_closed_with_exactly_one_canary(work):
+    b = breaker()
+    trip(b)
+    assert b.trips == 1
+
+    results, threads = admit_in_threads(b, 5)
+    time.sleep(0.05)
+    assert results == []          # open: everyone waits
+    time.sleep(0.4)
+    assert results == [True]      # half-open: one canary, the rest still wait
+    assert b.state == "half_open" and b.probes == 1
+
+    b.record(True, None)          # the canary succeeded
+    for t in threads:
+        t.join(timeout=2)
+    assert b.state == "closed"
+    assert sorted(results) == [False] * 4 + [True]
+    assert b.probes == 1
+
+
+def test_failed_canary_reopens_for_twice_as_long(work):
+    b = breaker(open_s=0.1)
+    trip(b)
+    time.sleep(0.15)
+    assert b.admit() is True
+
+    b.record(True, api_error(500, "INTERNAL"))
+
+    assert b.state == "open"
+    assert b.open_s == pytest.approx(0.2)
+    assert b.trips == 1
@@ -0,0 +1,118 @@
+import json
+import threading
+import time
+
+import pytest
+
+import imagen
+
+
+@pytest.fixture
+def watchdog(work, monkeypatch):
+    wd = imagen.Watchdog()
+    monkeypatch.setattr(imagen, "WATCHDOG", wd)
+    return wd
+
+
+def blocking_call(release):
+    started = threading.Event()
+
+    def call():
+        started.set()
+        release.wait(5)
+        return "late"
+    return call, started
+
+
+def test_call_within_its_timeout_returns_or_raises(watchdog):
+    assert watchdog.call("generate", 1.0, lambda x: x * 2, 21) == 42
+    with pytest.raises(ValueError):
+        watchdog.call("generate", 1.0, lambda: int("x"))
+    assert watchdog.abandoned == {}
+
+
+def test_overrunning_call_is_abandoned(watchdog):
+    release = threading.Event()
+    call, started = blocking_call(release)
+
+    t0 = time.monotonic()
+    with pytest.raises(imagen.CallTimeoutError):
+        watchdog.call("generate", 0.1, call)
+
+    assert time.monotonic() - t0 < 1.0
+    assert started.is_set()
+    assert watchdog.abandoned == {"generate": 1}
+    release.set()
+
+
+def test_sku_deadline_caps_the_call_timeout(watchdog):
+    release = threading.Event()
+    call, _ = blocking_call(release)
+
+    with imagen.call_context(sku="SKU1", sku_deadline=time.monotonic() + 0.1):
+        t0 = time.monotonic()
+        with pytest.raises(imagen.SkuDeadlineError):
+            watchdog.call("generate", 30.0, call)
+        assert time.monotonic() - t0 < 1.0
+    release.set()
+
+
+def test_no_call_starts_past_the_sku_deadline(watchdog):
+    calls = []
+    with imagen.call_context(sku="SKU1", sku_deadline=time.monotonic() - 1):
+        with pytest.raises(imagen.SkuDeadlineError):
+            watchdog.call("generate", 30.0, lambda: calls.append(1))
+        with pytest.raises(imagen.SkuDeadlineError):
+            imagen.retry_call(lambda: calls.append(2))
+    assert calls == []
+
+
+def test_shutdown_abandons_after_the_grace_period(watchdog, monkeypatch):
+    monkeypatch.setattr(imagen, "SHUTDOWN_GRACE_S", 0.1)
+    release = threading.Event()
+    call, _ = blocking_call(release)
+    imagen.STOP_EVENT.set()
+
+    with pytest.raises(KeyboardInterrupt):
+        watchdog.call("upload", 30.0, call)
+
+    assert watchdog.abandoned == {"upload": 1}
+    release.set()
+
+
+def test_timed_out_call_is_retried_but_deadline_is_not(watchdog):
+    attempts = []
+
+    def flaky():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise imagen.CallTimeoutError("abandoned")
+        return "ok"
+    assert imagen.retry_call(flaky) == "ok"
+    assert len(attempts) == 2
+
+    def overran():
+        attempts.append(1)
+        raise imagen.SkuDeadlineError("deadline")
+    with pytest.raises(imagen.SkuDeadlineError):
+        imagen.retry_call(overran)
+    assert len(attempts) == 3
+
+
+def test_stalled_sku_is_abandoned_at_its_deadline(catalogue, watchdog, monkeypatch):
+    monkeypatch.setattr(imagen, "SKU_DEADLINE_S", 0.3)
+    monkeypatch.setattr(imagen, "GEN_TIMEOUT_S", 30.0)
+    backend = imagen.KEYS.keys[0].backend
+    release = threading.Event()
+    monkeypatch.setattr(backend.models, "generate_content", lambda **kw: release.wait(5))
+    item = catalogue[0]
+
+    t0 = time.monotonic()
+    assert not imagen.process_sku(item, False, True)
+
+    assert time.monotonic() - t0 < 3.0
+    assert watchdog.sku_deadlines == 1
+    assert item["product_code"] not in imagen.STORE.completed_skus()
+    with open(imagen.ERROR_FILE, encoding="utf-8") as f:
+        assert "sku_deadline" in {json.loads(line)["error_code"] for line in f}
+    release.set()
@@ -0,0 +1,87 @@
+import threading
+import time
+
+import imagen
+
+
+def warm_hedger(**kw):
+    """A hedger past its warm-up whose threshold is 0.05s."""
+    hedger = imagen.Hedger(pct=50, min_samples=3, max_share=kw.get("max_share", 1.0), max_usd=kw.get("max_usd", 0))
+    hedger._recent.extend([0.05] * 3)
+    return hedger
+
+
+def timed_call(durations):
+    """A call that goes on the wire, takes the next of `durations` and returns its index."""
+    lock = threading.Lock()
+    started = []
+
+    def call():
+        with lock:
+            n = len(started)
+            started.append(n)
+        on_wire = getattr(imagen._call_ctx, "on_wire", None)
+        if on_wire:
+            on_wire()
+        time.sleep(durations[n])
+        return n
+    return call, started
+
+
+def test_no_hedge_until_warmed_up(work):
+    hedger = imagen.Hedger(pct=50, min_samples=3, max_share=1.0, max_usd=0)
+    call, started = timed_call([0.2])
+
+    assert hedger.call(call) == 0
+
+    assert started == [0]
+    assert hedger.fired == 0
+    assert len(hedger._recent) == 1
+
+
+def test_slow_call_is_hedged_and_the_hedge_wins(work):
+    hedger = warm_hedger()
+    call, started = timed_call([0.6, 0.05])
+
+    t0 = time.monotonic()
+    assert hedger.call(call) == 1
+    assert time.monotonic() - t0 < 0.5
+
+    assert (hedger.fired, hedger.won) == (1, 1)
+    # The primary is not cancelled: it is tracked until it finishes
+    assert hedger.losing == 1
+    hedger.drain(timeout=5)
+    assert (hedger.losing, hedger.lost) == (0, 1)
+
+
+def test_primary_that_finishes_first_wins(work):
+    hedger = warm_hedger()
+    call, started = timed_call([0.15, 0.6])
+
+    assert hedger.call(call) == 0
+
+    assert started == [0, 1]
+    assert (hedger.fired, hedger.won) == (1, 0)
+    hedger.drain(timeout=5)
+    assert hedger.lost == 1
+
+
+def test_share_cap_stops_hedging(work):
+    hedger = warm_hedger(max_share=0.0)
+    call, started = timed_call([0.2])
+
+    assert hedger.call(call) == 0
+
+    assert started == [0]
+    assert (hedger.fired, hedger.skipped) == (0, 1)
+
+
+def test_spend_cap_stops_hedging(work):
+    hedger = warm_hedger(max_usd=imagen.Hedger.hedge_cost() * 1.5)
+    call, started = timed_call([0.2, 0.01, 0.2, 0.01])
+
+    hedger.call(call)
+    hedger.call(call)
+
+    assert (hedger.fired, hedger.skipped) == (1, 1)
+    hedger.drain(timeout=5)
@@ -0,0 +1,54 @@
+import pytest
+
+import imagen
+
+
+def throttle_first_generate(backend, monkeypatch, hint_s=0.1):
+    real = backend.models.generate_content
+    calls = []
+
+    def generate_content(**kwargs):
+        calls.append(kwargs)
+        if len(calls) == 1:
+            raise imagen.SimulatedAPIError(429, "RESOURCE_EXHAUSTED", "Quota exceeded", retry_delay_s=hint_s)
+        return real(**kwargs)
+    monkeypatch.setattr(backend.models, "generate_content", generate_content)
+    return calls
+
+
+def test_single_key_waits_out_a_429_instead_of_reuploading(catalogue, monkeypatch):
+    monkeypatch.setattr(imagen, "REF_STRATEGY", "files")
+    backend = imagen.KEYS.keys[0].backend
+    throttle_first_generate(backend, monkeypatch)
+    item = catalogue[0]
+
+    assert imagen.process_sku(item, False, True)
+
+    assert imagen.KEYS.keys[0].throttles == 1
+    assert backend.stats["uploads"] == 2   # the SKU's two references, uploaded once
+    assert item["product_code"] in imagen.STORE.completed_skus()
+
+
+def test_upload_on_a_briefly_benched_single_key_waits(catalogue, monkeypatch):
+    monkeypatch.setattr(imagen, "REF_STRATEGY", "files")
+    key = imagen.KEYS.keys[0]
+    imagen.KEYS.bench(key, 0.1, "quota")   # within pick()'s wait threshold (3x RETRY_MAX_DELAY_S)
+
+    refs = imagen.upload_references(imagen.find_folder_for_code(catalogue[0]["product_code"]))
+
+    assert len(refs) == 2
+    assert not key.benched()
+
+
+def test_benched_owner_moves_references_to_a_live_key(work, monkeypatch):
+    imagen.build_synthetic_catalogue(str(work), 1, 2)
+    imagen.init_backend("sim", keys=2, root=str(work / "sim_endpoint"), seed=0)
+    monkeypatch.setattr(imagen, "REF_STRATEGY", "files")
+    first, second = imagen.KEYS.keys
+    refs = imagen.upload_references(imagen.find_folder_for_code("BENCH00000"), key=first)
+    imagen.KEYS.bench(first, 60, "quota")
+
+    assert imagen.KEYS.others_live(first)
+    with pytest.raises(imagen.KeyBenchedError):
+        imagen.KEYS.route(refs)
+    assert imagen.KEYS.route([]) is second
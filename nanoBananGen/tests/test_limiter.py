@@ -0,0 +1,90 @@
+import time
+
+import pytest
+
+import imagen
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+class QuotaError(Exception):
+    code = 429
+
+
+def test_429_halves_the_window_and_holds_everyone_for_the_hint():
+    clock = FakeClock()
+    limiter = imagen.AdaptiveLimiter("generate", 600, 8, clock=clock)
+    ticket = limiter.acquire()
+
+    limiter.release(ticket, "throttle", hint=5.0)
+
+    assert limiter.limit == 4.0
+    assert limiter.throttles == 1
+    assert limiter.cooldown_until == pytest.approx(105.0)
+    assert limiter.headroom() == pytest.approx(-5.0)
+    clock.now += 5.0
+    assert limiter.headroom() >= 0.0
+
+
+def test_burst_of_429s_shrinks_the_window_once():
+    clock = FakeClock()
+    limiter = imagen.AdaptiveLimiter("generate", 600, 8, clock=clock)
+    tickets = [limiter.acquire() for _ in range(3)]
+
+    clock.now += 0.5
+    for t in tickets:
+        limiter.release(t, "throttle", hint=1.0)
+    assert limiter.limit == 4.0
+
+    # A call admitted after that decrease that is throttled again halves it again
+    clock.now += 2.0
+    limiter.release(limiter.acquire(), "throttle", hint=1.0)
+    assert limiter.limit == 2.0
+
+
+def test_429_without_hint_uses_the_default_cooldown(monkeypatch):
+    monkeypatch.setattr(imagen, "THROTTLE_COOLDOWN_S", 7.0)
+    clock = FakeClock()
+    limiter = imagen.AdaptiveLimiter("upload", 600, 4, clock=clock)
+
+    limiter.release(limiter.acquire(), "throttle")
+
+    assert limiter.cooldown_until == pytest.approx(107.0)
+
+
+def test_successes_grow_the_window_back():
+    clock = FakeClock()
+    limiter = imagen.AdaptiveLimiter("generate", 6000, 8, clock=clock)
+    limiter.release(limiter.acquire(), "throttle", hint=0.0)
+    assert limiter.limit == 4.0
+
+    for _ in range(40):
+        clock.now += 1.0
+        limiter.release(limiter.acquire(), "ok")
+
+    assert limiter.limit == 8.0
+
+
+def test_retry_waits_out_the_retry_after_hint_before_the_next_attempt(work):
+    limiter = imagen.AdaptiveLimiter("generate", 60000, 4)
+    sent = []
+
+    def call():
+        with limiter.slot():
+            sent.append(time.monotonic())
+            if len(sent) == 1:
+                raise QuotaError("429 RESOURCE_EXHAUSTED. Please retry in 300ms.")
+            return "ok"
+
+    assert imagen.retry_call(call) == "ok"
+
+    assert len(sent) == 2
+    assert sent[1] - sent[0] >= 0.3
+    assert limiter.throttles == 1
+    assert limiter.limit == 2.5   # halved from 4, then +1/window for the success
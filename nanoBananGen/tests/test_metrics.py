@@ -0,0 +1,99 @@
+import json
+from contextlib import nullcontext
+from types import SimpleNamespace
+
+import pytest
+
+import imagen
+
+
+def response(image_bytes=b"", prompt_tokens=None, output_tokens=None, cached_tokens=None):
+    parts = [SimpleNamespace(inline_data=SimpleNamespace(data=image_bytes))] if image_bytes else []
+    usage = None
+    if prompt_tokens is not None:
+        usage = SimpleNamespace(prompt_token_count=prompt_tokens, candidates_token_count=output_tokens,
+                                cached_content_token_count=cached_tokens,
+                                total_token_count=prompt_tokens + (output_tokens or 0))
+    return SimpleNamespace(candidates=[SimpleNamespace(content=SimpleNamespace(parts=parts))], usage_metadata=usage)
+
+
+def generate(metrics, resp=None, error=None):
+    with pytest.raises(type(error)) if error else nullcontext():
+        with metrics.call("generate", wait_s=0.25, bytes_in=100, key="key-a") as rec:
+            if error:
+                raise error
+            metrics.note_response(rec, resp)
+
+
+def lines(metrics):
+    with open(metrics.path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+
+def test_calls_are_journaled_with_outcome_context_and_cost(work):
+    metrics = imagen.CallMetrics(str(work / "metrics"))
+    with imagen.call_context(sku="SKU1", prompt="top", attempt=2):
+        generate(metrics, response(b"x" * 500, prompt_tokens=1000, output_tokens=1290, cached_tokens=400))
+        generate(metrics, error=imagen.SimulatedAPIError(429, "RESOURCE_EXHAUSTED", "quota"))
+        generate(metrics, error=ValueError("bad"))
+    metrics.close()
+
+    ok, throttled, failed = lines(metrics)
+    assert (ok["sku"], ok["prompt"], ok["attempt"], ok["key"], ok["wait_s"]) == ("SKU1", "top", 2, "key-a", 0.25)
+    assert (ok["outcome"], ok["bytes_out"], ok["prompt_tokens"], ok["cached_tokens"]) == ("ok", 500, 1000, 400)
+    assert ok["est_cost_usd"] == pytest.approx(imagen.CallMetrics.estimate_cost(1000, 1290, cached_tokens=400), abs=1e-6)
+    assert (throttled["outcome"], throttled["error_code"]) == ("throttle", "429")
+    assert (failed["outcome"], failed["error_code"]) == ("error", "ValueError")
+
+
+def test_image_without_usage_is_costed_at_the_flat_image_rate(work):
+    metrics = imagen.CallMetrics(str(work / "metrics"))
+    generate(metrics, response(b"x" * 10))
+
+    rec, = lines(metrics)
+    assert "prompt_tokens" not in rec
+    assert rec["est_cost_usd"] == pytest.approx(imagen.IMAGE_OUTPUT_TOKENS * imagen.PRICE_OUTPUT_PER_MTOK / 1e6, abs=1e-6)
+    assert metrics.images == 1
+    metrics.close()
+
+
+def test_aggregates_feed_summary_and_prometheus_file(work):
+    metrics = imagen.CallMetrics(str(work / "metrics"))
+    for _ in range(3):
+        generate(metrics, response(b"x", prompt_tokens=100, output_tokens=1290))
+    generate(metrics, error=imagen.SimulatedAPIError(429, "RESOURCE_EXHAUSTED", "quota"))
+    generate(metrics, response())   # answered, but without an image
+    metrics.close()
+
+    assert metrics.images == 3
+    assert metrics.spend == pytest.approx(3 * imagen.CallMetrics.estimate_cost(100, 1290), abs=1e-5)
+    summary = metrics.summary_lines()
+    assert summary[0].startswith("generate: 5 call(s), ok=4, throttled=1, errors=0;")
+    assert "retries per success 0.25" in summary[0]
+    assert "tokens in=300, out=3870" in summary[-1]
+    with open(work / "metrics" / "imagen.prom", encoding="utf-8") as f:
+        prom = f.read()
+    assert f'imagen_calls_total{{run_id="{metrics.run_id}",kind="generate",outcome="ok"}} 4' in prom
+    assert f'imagen_images_total{{run_id="{metrics.run_id}"}} 3' in prom
+
+
+def test_sku_lines_sum_the_calls_made_for_the_sku(work):
+    metrics = imagen.CallMetrics(str(work / "metrics"))
+    with imagen.call_context(sku="SKU1"):
+        generate(metrics, response(b"x", prompt_tokens=1000, output_tokens=1290, cached_tokens=800))
+        generate(metrics, response(b"x", prompt_tokens=1000, output_tokens=1290, cached_tokens=800))
+    with imagen.call_context(sku="SKU2"):
+        generate(metrics, response(b"x", prompt_tokens=5000, output_tokens=1290))
+    metrics.record_sku("SKU1", "cache", 2.0, "ok", 2, 0)
+    metrics.record_sku("SKU2", "inline", 4.0, "ok", 1, 2048)
+    metrics.close()
+
+    sku1 = next(r for r in lines(metrics) if r["kind"] == "sku" and r["sku"] == "SKU1")
+    assert (sku1["prompt_tokens"], sku1["cached_tokens"]) == (2000, 1600)
+    assert sku1["est_cost_usd"] == pytest.approx(2 * imagen.CallMetrics.estimate_cost(1000, 1290, cached_tokens=800), abs=1e-6)
+    by_strategy = [line for line in metrics.summary_lines() if line.startswith("SKUs with")]
+    assert by_strategy[0].startswith("SKUs with cache references: 1;")
+    assert "input tokens per SKU 2000 (1600 cached)" in by_strategy[0]
+    assert "input tokens per SKU 5000 (0 cached)" in by_strategy[1]
+    # SKU lines are not calls: the generate count is unchanged
+    assert metrics.summary_lines()[0].startswith("generate: 3 call(s)")
@@ -0,0 +1,140 @@
+import email
+import http.server
+import socketserver
+import threading
+import time
+
+import pytest
+
+import imagen
+
+
+class SMTPStandIn(socketserver.ThreadingTCPServer):
+    """Just enough SMTP for smtplib: EHLO with AUTH PLAIN, MAIL/RCPT/DATA, QUIT. Keeps subjects."""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        self.subjects = []
+        self.connections = 0
+        super().__init__(("127.0.0.1", 0), SMTPHandler)
+
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write(line.encode() + b"\r\n")
+
+    def handle(self):
+        self.server.connections += 1
+        self.reply("220 stand-in ESMTP")
+        for raw in self.rfile:
+            verb = raw.decode().strip().split(" ")[0].upper()
+            if verb == "EHLO":
+                self.reply("250-stand-in")
+                self.reply("250 AUTH PLAIN")
+            elif verb == "AUTH":
+                self.reply("235 ok")
+            elif verb == "DATA":
+                self.reply("354 go ahead")
+                lines = []
+                for line in self.rfile:
+                    if line == b".\r\n":
+                        break
+                    lines.append(line)
+                self.server.subjects.append(email.message_from_bytes(b"".join(lines))["Subject"])
+                self.reply("250 queued")
+            elif verb == "QUIT":
+                self.reply("221 bye")
+                return
+            else:
+                self.reply("250 ok")
+
+
+class NtfyStandIn(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        self.titles = []
+        super().__init__(("127.0.0.1", 0), NtfyHandler)
+
+
+class NtfyHandler(http.server.BaseHTTPRequestHandler):
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.server.titles.append(self.headers["Title"])
+        self.send_response(200)
+        self.end_headers()
+        self.wfile.write(b"{}")
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(server):
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+@pytest.fixture
+def endpoints(work, monkeypatch):
+    smtp, ntfy = serve(SMTPStandIn()), serve(NtfyStandIn())
+    monkeypatch.setattr(imagen, "NOTIFY_ENABLED", True)
+    monkeypatch.setattr(imagen, "SMTP_HOST", "127.0.0.1")
+    monkeypatch.setattr(imagen, "SMTP_PORT", smtp.server_address[1])
+    monkeypatch.setattr(imagen, "SMTP_STARTTLS", False)
+    monkeypatch.setattr(imagen, "SMTP_USER", "bot@example.com")
+    monkeypatch.setattr(imagen, "SMTP_PASS", "secret")
+    monkeypatch.setattr(imagen, "NOTIFY_EMAIL", "ops@example.com")
+    monkeypatch.setattr(imagen, "NTFY_URL", f"http://127.0.0.1:{ntfy.server_address[1]}/imagen")
+    monkeypatch.setattr(imagen, "NTFY_USERNAME", None)
+    monkeypatch.setattr(imagen, "NTFY_PASSWORD", None)
+    yield smtp, ntfy
+    imagen.NOTIFIER.close()
+    smtp.shutdown()
+    ntfy.shutdown()
+    smtp.server_close()
+    ntfy.server_close()
+
+
+def warn(title, key="warning:upload"):
+    imagen.notify(level="warning", title=title, message="details", key=key)
+
+
+def test_repeats_within_the_window_are_sent_as_one_digest(endpoints, monkeypatch):
+    smtp, ntfy = endpoints
+    monkeypatch.setattr(imagen, "NOTIFIER", imagen.NotificationDispatcher(window_s=0.5))
+
+    for i in range(5):
+        warn(f"Upload failed {i}")
+    deadline = time.monotonic() + 10
+    while len(ntfy.titles) < 2 and time.monotonic() < deadline:
+        time.sleep(0.05)
+
+    assert ntfy.titles == ["Upload failed 0", "4 more warning(s) [warning:upload] in last 1 min"]
+    assert smtp.subjects == ntfy.titles
+    assert imagen.NOTIFIER.coalesced == 4
+
+
+def test_separate_keys_are_not_folded_together(endpoints, monkeypatch):
+    smtp, ntfy = endpoints
+    monkeypatch.setattr(imagen, "NOTIFIER", imagen.NotificationDispatcher(window_s=60))
+
+    warn("Upload failed", key="warning:upload")
+    warn("QC warning", key="warning:qc")
+    warn("Upload failed again", key="warning:upload")
+    imagen.NOTIFIER.close()
+
+    assert ntfy.titles[:2] == ["Upload failed", "QC warning"]
+    assert ntfy.titles[2:] == ["1 more warning(s) [warning:upload] in last 1 min"]
+
+
+def test_one_smtp_connection_serves_the_whole_run(endpoints, monkeypatch):
+    smtp, _ = endpoints
+    monkeypatch.setattr(imagen, "NOTIFIER", imagen.NotificationDispatcher(window_s=60))
+
+    for i in range(3):
+        warn(f"Problem {i}", key=f"warning:{i}")
+    imagen.NOTIFIER.close()
+
+    assert len(smtp.subjects) == 3
+    assert smtp.connections == 1
@@ -0,0 +1,117 @@
+import threading
+
+import pytest
+
+import imagen
+
+
+@pytest.fixture
+def gated(catalogue, monkeypatch):
+    """Prefetch uploads wait for `gate`; `started` lists the folders they were started for."""
+    monkeypatch.setattr(imagen, "REF_STRATEGY", "files")
+    gate, entered, started = threading.Event(), threading.Event(), []
+    real = imagen.upload_references
+
+    def upload_references(folder, *args, **kwargs):
+        if threading.current_thread().name.startswith("prefetch"):
+            started.append(folder)
+            entered.set()
+            if not gate.wait(5):
+                raise RuntimeError("gate never opened")
+        return real(folder, *args, **kwargs)
+    monkeypatch.setattr(imagen, "upload_references", upload_references)
+    yield gate, entered, started
+    gate.set()
+
+
+def prefetcher(monkeypatch, depth):
+    pf = imagen.ReferencePrefetcher(depth)
+    monkeypatch.setattr(imagen, "PREFETCH", pf)
+    return pf
+
+
+def folder_of(item):
+    return imagen.find_folder_for_code(item["product_code"])
+
+
+def test_next_sku_is_prepared_while_the_current_one_generates(catalogue, gated, monkeypatch):
+    gate, entered, started = gated
+    pf = prefetcher(monkeypatch, 1)
+    first, second = catalogue
+
+    pf.ahead([second])
+    assert entered.wait(2)
+    assert imagen.process_sku(first, False, True)   # generated while the prefetch is in flight
+    gate.set()
+    assert imagen.process_sku(second, False, True)
+
+    assert started == [folder_of(second)]
+    assert (pf.hits, pf.misses) == (1, 1)
+    assert imagen.KEYS.keys[0].backend.stats["uploads"] == 4   # each SKU's two references, once
+    pf.close()
+
+
+def test_look_ahead_is_bounded_by_depth(catalogue, gated, monkeypatch):
+    gate, entered, started = gated
+    pf = prefetcher(monkeypatch, 1)
+
+    pf.ahead(catalogue)
+    pf.ahead(catalogue)
+
+    assert list(pf._slots) == [catalogue[0]["product_code"]]
+    gate.set()
+    pf.close()
+
+
+def test_discard_cancels_a_queued_prefetch(catalogue, gated, monkeypatch):
+    gate, entered, started = gated
+    monkeypatch.setattr(imagen, "PREFETCH_WORKERS", 1)
+    pf = prefetcher(monkeypatch, 2)
+    first, second = catalogue
+
+    pf.ahead([first, second])
+    assert entered.wait(2)
+    queued = pf._slots[second["product_code"]][0]
+    pf.discard(second["product_code"])
+    gate.set()
+    pf.close()
+
+    assert queued.cancelled()
+    assert started == [folder_of(first)]
+
+
+def test_stop_interrupts_a_take_that_is_still_waiting(catalogue, gated, monkeypatch):
+    gate, entered, started = gated
+    pf = prefetcher(monkeypatch, 1)
+    first = catalogue[0]
+    pf.ahead([first])
+    assert entered.wait(2)
+
+    imagen.STOP_EVENT.set()
+    with pytest.raises(KeyboardInterrupt):
+        pf.take(first["product_code"], folder_of(first))
+    gate.set()
+    pf.close()
+
+
+def test_failed_or_stale_prefetch_falls_back_to_preparing_now(catalogue, monkeypatch):
+    first, second = catalogue
+    real = imagen.upload_references
+
+    def upload_references(folder, *args, **kwargs):
+        if folder == folder_of(first):
+            raise OSError("share offline")
+        return real(folder, *args, **kwargs)
+    monkeypatch.setattr(imagen, "upload_references", upload_references)
+    pf = prefetcher(monkeypatch, 2)
+    pf.ahead(catalogue)
+    for fut, _ in list(pf._slots.values()):
+        fut.exception(timeout=5)
+    monkeypatch.setattr(imagen, "PREFETCH_MAX_AGE_S", 0.0)   # the second set is too old by now
+
+    assert pf.take(first["product_code"], folder_of(first)) is None
+    assert pf.take(second["product_code"], folder_of(second)) is None
+
+    assert (pf.failed, pf.misses, pf.hits) == (1, 1, 0)
+    assert imagen.process_sku(second, False, True)   # prepares its own set
+    pf.close()
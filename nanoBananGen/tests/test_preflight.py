@@ -0,0 +1,59 @@
+import copy
+import json
+import os
+import subprocess
+import sys
+
+from PIL import Image
+
+import imagen
+
+
+def report():
+    with open(imagen.PREFLIGHT_REPORT, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def test_bad_skus_are_reported_journaled_and_dropped(catalogue):
+    good, tiny = catalogue
+    folder = imagen.find_folder_for_code(tiny["product_code"])
+    for name in os.listdir(folder):
+        Image.new("RGB", (64, 64)).save(os.path.join(folder, name))
+    no_prompts = {"product_code": "NOFOLDER1"}
+
+    passed = imagen.run_preflight([good, tiny, no_prompts], workers=2)
+
+    assert passed == [good]
+    r = report()
+    assert (r["checked"], r["passed"], r["failed"]) == (3, 1, 2)
+    assert r["by_check"]["reference_too_small"]["skus"] == [tiny["product_code"]]
+    assert r["by_check"]["prompt_missing"]["skus"] == ["NOFOLDER1"]
+    assert r["by_check"]["folder_missing"]["skus"] == ["NOFOLDER1"]
+    assert [e["product_code"] for e in r["skus"]] == sorted([tiny["product_code"], "NOFOLDER1"])
+    with open(imagen.ERROR_FILE, encoding="utf-8") as f:
+        codes = sorted(json.loads(line)["error_code"] for line in f)
+    assert codes == ["preflight_prompt_missing", "preflight_reference_too_small"]
+
+
+def test_duplicated_code_keeps_its_good_entry(catalogue):
+    good = catalogue[0]
+    broken = copy.deepcopy(good)
+    broken["lifestyle_prompt"] = ""
+
+    passed = imagen.run_preflight([broken, good], workers=2)
+
+    assert passed == [good]
+    assert (report()["passed"], report()["failed"]) == (1, 1)
+
+
+def test_run_exits_nonzero_when_no_sku_passes(tmp_path):
+    script = os.path.join(os.path.dirname(os.path.abspath(imagen.__file__)), "imagen.py")
+    with open(tmp_path / "prompts_new.json", "w", encoding="utf-8") as f:
+        json.dump([{"product_code": "NOFOLDER1"}], f)
+
+    out = subprocess.run([sys.executable, script, "--preflight", "--backend", "sim"], cwd=str(tmp_path),
+                         capture_output=True, text=True, timeout=120)
+
+    assert out.returncode == 1, out.stderr
+    with open(tmp_path / "preflight_report.json", encoding="utf-8") as f:
+        assert json.load(f)["failed"] == 1
@@ -0,0 +1,63 @@
+import pytest
+from PIL import Image
+
+import imagen
+
+
+def shot(work, name, size=(256, 256), background=(255, 255, 255), box=(64, 64, 192, 192)):
+    """A PNG (no compression noise at the thresholds) with a dark product in `box`."""
+    img = Image.new("RGB", size, background)
+    if box:
+        img.paste((60, 90, 150), box)
+    path = str(work / name)
+    img.save(path, "PNG")
+    return path
+
+
+def test_centred_product_on_white_passes(work):
+    result = imagen.qc_image(shot(work, "ok.png"), True)
+
+    assert result["ok"] and result["failures"] == []
+    assert result["border_white"] == 1.0
+    assert result["margin"] == pytest.approx(0.25)
+
+
+def test_non_square_output_fails(work):
+    result = imagen.qc_image(shot(work, "wide.png", size=(320, 256)), True)
+
+    assert result["failures"] == ["not_square"]
+
+
+def test_uniform_frame_is_blank_and_skips_background_checks(work):
+    result = imagen.qc_image(shot(work, "blank.png", box=None), True)
+
+    assert result["failures"] == ["blank_frame"]
+    assert "border_white" not in result
+
+
+def test_grey_background_fails_only_white_background_shots(work):
+    path = shot(work, "grey.png", background=(230, 230, 230))
+
+    assert "background_not_white" in imagen.qc_image(path, True)["failures"]
+    assert imagen.qc_image(path, False)["ok"]   # lifestyle shots keep their background
+
+
+@pytest.mark.parametrize("top, ok", [(3, False), (8, True)])
+def test_product_margin_threshold(work, top, ok):
+    # 256px frame: 3px is ~1.2% from the edge (below QC_MIN_MARGIN = 2%), 8px ~3.1%
+    result = imagen.qc_image(shot(work, f"m{top}.png", box=(64, top, 192, 192)), True)
+
+    assert result["ok"] is ok
+    assert ("product_margin" in result["failures"]) is not ok
+
+
+def test_border_white_threshold_follows_the_setting(work, monkeypatch):
+    # Product runs off the left edge, so part of the border band is not white
+    path = shot(work, "edge.png", box=(0, 96, 64, 160))
+    border_white = imagen.qc_image(path, True)["border_white"]
+    assert border_white < imagen.QC_MIN_BORDER_WHITE
+
+    monkeypatch.setattr(imagen, "QC_MIN_BORDER_WHITE", border_white - 0.01)
+    monkeypatch.setattr(imagen, "QC_MIN_MARGIN", 0.0)
+
+    assert imagen.qc_image(path, True)["ok"]
@@ -0,0 +1,46 @@
+import pytest
+
+import imagen
+
+
+def test_sku_prompts_share_one_cached_context(catalogue, monkeypatch):
+    monkeypatch.setattr(imagen, "REF_CONTEXT", "cache")
+    backend = imagen.KEYS.keys[0].backend
+    sent = []
+    real = backend.models.generate_content
+    monkeypatch.setattr(backend.models, "generate_content",
+                        lambda **kw: sent.append(kw["config"].get("cached_content")) or real(**kw))
+
+    assert imagen.process_sku(catalogue[0], False, True)
+
+    assert backend.stats["caches"] == 1
+    assert len(sent) == len(imagen.PROMPT_KEYS) and len(set(sent)) == 1 and sent[0]
+    assert backend._caches == {}   # deleted once the SKU is done
+
+
+def test_falls_back_to_plain_references_when_caching_is_unsupported(catalogue, monkeypatch):
+    monkeypatch.setattr(imagen, "REF_CONTEXT", "cache")
+    backend = imagen.KEYS.keys[0].backend
+
+    def unsupported(**kwargs):
+        raise imagen.SimulatedAPIError(400, "INVALID_ARGUMENT", "Model does not support explicit caching")
+    monkeypatch.setattr(backend.caches, "create", unsupported)
+    folder = imagen.find_folder_for_code(catalogue[0]["product_code"])
+    refs = imagen.upload_references(folder)
+
+    assert imagen.open_reference_context(refs, folder) is refs
+    assert imagen.process_sku(catalogue[0], False, True)
+    assert catalogue[0]["product_code"] in imagen.STORE.completed_skus()
+
+
+def test_sku_deadline_is_not_swallowed_by_the_fallback(catalogue, monkeypatch):
+    monkeypatch.setattr(imagen, "REF_CONTEXT", "cache")
+    backend = imagen.KEYS.keys[0].backend
+
+    def overran(**kwargs):
+        raise imagen.SkuDeadlineError("deadline")
+    monkeypatch.setattr(backend.caches, "create", overran)
+    folder = imagen.find_folder_for_code(catalogue[0]["product_code"])
+
+    with pytest.raises(imagen.SkuDeadlineError):
+        imagen.open_reference_context(imagen.upload_references(folder), folder)
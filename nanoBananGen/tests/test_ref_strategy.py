@@ -0,0 +1,55 @@
+import pytest
+
+import imagen
+
+
+def sizes(work, *nbytes):
+    paths = []
+    for i, n in enumerate(nbytes):
+        path = work / f"ref_{i}.jpg"
+        path.write_bytes(b"\0" * n)
+        paths.append(str(path))
+    return paths
+
+
+@pytest.mark.parametrize("limit, expected", [(3000, "inline"), (2999, "files")])
+def test_auto_inlines_a_set_up_to_the_byte_limit(work, monkeypatch, limit, expected):
+    monkeypatch.setattr(imagen, "REF_INLINE_MAX_BYTES", limit)
+
+    assert imagen.choose_ref_strategy(sizes(work, 1000, 2000), "auto") == expected
+
+
+def test_explicit_strategy_overrides_size(work, monkeypatch):
+    monkeypatch.setattr(imagen, "REF_INLINE_MAX_BYTES", 10)
+    paths = sizes(work, 1000)
+
+    assert imagen.choose_ref_strategy(paths, "inline") == "inline"
+    monkeypatch.setattr(imagen, "REF_STRATEGY", "files")
+    assert imagen.choose_ref_strategy(sizes(work, 1)) == "files"
+
+
+def test_small_set_is_sent_inline_without_uploading(catalogue, monkeypatch):
+    monkeypatch.setattr(imagen, "REF_STRATEGY", "auto")
+    backend = imagen.KEYS.keys[0].backend
+    item = catalogue[0]
+
+    refs = imagen.upload_references(imagen.find_folder_for_code(item["product_code"]))
+
+    assert imagen.ref_strategy_of(refs) == "inline"
+    assert len(refs) == 2 and all(r.inline_data.data for r in refs)
+    assert imagen.process_sku(item, False, True)
+    assert backend.stats["uploads"] == 0
+
+
+def test_large_set_goes_through_the_files_api(catalogue, monkeypatch):
+    monkeypatch.setattr(imagen, "REF_STRATEGY", "auto")
+    monkeypatch.setattr(imagen, "REF_INLINE_MAX_BYTES", 0)
+    backend = imagen.KEYS.keys[0].backend
+    item = catalogue[0]
+
+    refs = imagen.upload_references(imagen.find_folder_for_code(item["product_code"]))
+
+    assert imagen.ref_strategy_of(refs) == "files"
+    assert backend.stats["uploads"] == 2
+    assert imagen.process_sku(item, False, True)
+    assert backend.stats["uploads"] == 2   # the SKU reused the cached handles
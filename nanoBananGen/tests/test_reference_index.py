@@ -0,0 +1,54 @@
+import os
+
+import imagen
+
+
+def make_root(work, *names):
+    root = work / "refs"
+    for name in names:
+        (root / name).mkdir(parents=True)
+    return str(root)
+
+
+def test_code_matches_at_a_word_boundary_only(work):
+    root = make_root(work, "COOBA001 - Blue mug", "COOBA0012 - Red mug", "COOBA00 - Plate")
+    index = imagen.ReferenceIndex()
+
+    assert index.resolve("COOBA001", root) == (os.path.join(root, "COOBA001 - Blue mug"),
+                                               ["COOBA001 - Blue mug", "COOBA0012 - Red mug"])
+    assert index.resolve("COOBA0012", root)[0] == os.path.join(root, "COOBA0012 - Red mug")
+    assert index.resolve("COOBA00", root)[0] == os.path.join(root, "COOBA00 - Plate")
+
+
+def test_folder_that_only_extends_the_code_is_not_a_match(work):
+    root = make_root(work, "COOBA0012 - Red mug", "COOBA001_old")
+    index = imagen.ReferenceIndex()
+
+    assert index.resolve("COOBA001", root) == (None, ["COOBA0012 - Red mug", "COOBA001_old"])
+    assert index.resolve("COOBA9", root) == (None, [])
+
+
+def test_two_boundary_matches_are_ambiguous(work, monkeypatch):
+    root = make_root(work, "COOBA001 - Blue mug", "COOBA001 (reshoot)")
+    monkeypatch.setattr(imagen, "REFERENCE_ROOT", root)
+
+    assert imagen.REF_INDEX.resolve("COOBA001") == (None, ["COOBA001 (reshoot)", "COOBA001 - Blue mug"])
+    assert imagen.find_folder_for_code("COOBA001") is None
+
+
+def test_index_is_listed_once_and_rebuilt_when_the_root_changes(work, monkeypatch):
+    root = make_root(work, "COOBA001 - Blue mug")
+    index = imagen.ReferenceIndex()
+    scans = []
+    real_scandir = os.scandir
+    monkeypatch.setattr(imagen.os, "scandir", lambda path: scans.append(path) or real_scandir(path))
+
+    assert index.resolve("COOBA001", root)[0] is not None
+    assert index.resolve("COOBA002", root) == (None, [])
+    assert len(scans) == 1
+
+    os.mkdir(os.path.join(root, "COOBA002 - Green mug"))
+    os.utime(root, (0, 1))   # coarse-mtime filesystems: make sure the change is visible
+
+    assert index.resolve("COOBA002", root)[0] == os.path.join(root, "COOBA002 - Green mug")
+    assert len(scans) == 2
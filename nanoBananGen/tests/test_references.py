@@ -0,0 +1,92 @@
+import numpy as np
+from PIL import Image, ImageDraw, ImageFilter
+
+import imagen
+
+
+def write_jpg(path, size, orientation=None):
+    img = Image.new("RGB", size, (255, 255, 255))
+    img.paste((180, 40, 40), (size[0] // 4, size[1] // 4, size[0] * 3 // 4, size[1] // 2))
+    exif = Image.Exif()
+    if orientation:
+        exif[0x0112] = orientation
+    img.save(path, "JPEG", quality=90, exif=exif)
+    return str(path)
+
+
+def test_small_upright_reference_is_uploaded_unchanged(work, monkeypatch):
+    monkeypatch.setattr(imagen, "REF_MAX_EDGE_PX", 512)
+    src = write_jpg(work / "small.jpg", (400, 300))
+
+    assert imagen.prepare_reference(src) == src
+
+
+def test_large_reference_is_downscaled(work, monkeypatch):
+    monkeypatch.setattr(imagen, "REF_MAX_EDGE_PX", 512)
+    src = write_jpg(work / "large.jpg", (1600, 1200))
+
+    out = imagen.prepare_reference(src)
+
+    assert out != src
+    with Image.open(out) as img:
+        assert img.size == (512, 384)
+
+
+def test_rotated_reference_is_transposed_even_when_small(work, monkeypatch):
+    monkeypatch.setattr(imagen, "REF_MAX_EDGE_PX", 512)
+    src = write_jpg(work / "rotated.jpg", (400, 300), orientation=6)
+
+    out = imagen.prepare_reference(src)
+
+    assert out != src
+    with Image.open(out) as img:
+        assert img.size == (300, 400)
+
+
+def write_view(path, seed, size=(1600, 1200)):
+    """A camera-sized shot of flat shapes laid out per seed; a radius-8 blur is subtle at this size."""
+    rng = np.random.default_rng(seed)
+    img = Image.new("RGB", size, tuple(int(c) for c in rng.integers(150, 256, 3)))
+    draw = ImageDraw.Draw(img)
+    for _ in range(12):
+        x, y = int(rng.integers(0, size[0] - 200)), int(rng.integers(0, size[1] - 200))
+        w, h = (int(v) for v in rng.integers(50, 500, 2))
+        shape = draw.ellipse if rng.random() < 0.5 else draw.rectangle
+        shape((x, y, x + w, y + h), fill=tuple(int(c) for c in rng.integers(0, 256, 3)))
+    img.save(path, "JPEG", quality=92)
+    return img
+
+
+def test_blurred_copy_loses_to_its_sharp_original(work):
+    folder = work / "refs"
+    folder.mkdir()
+    for i in range(6):
+        write_view(folder / f"view{i}.jpg", seed=i)
+    sharp = write_view(folder / "b.jpg", seed=99)
+    sharp.filter(ImageFilter.GaussianBlur(8)).save(folder / "b_blur8.jpg", "JPEG", quality=92)
+    paths = imagen.reference_paths(str(folder))
+
+    chosen, dropped = imagen.select_references(paths, k=7)
+
+    assert str(folder / "b.jpg") in chosen
+    assert str(folder / "b_blur8.jpg") not in chosen
+    assert dropped[str(folder / "b_blur8.jpg")].startswith("blurry")
+
+
+def test_near_duplicate_is_dropped(work):
+    folder = work / "refs"
+    folder.mkdir()
+    for i in range(6):
+        write_view(folder / f"view{i}.jpg", seed=i)
+    with Image.open(folder / "view3.jpg") as img:
+        img.save(folder / "view3_copy.jpg", "JPEG", quality=60)
+    paths = imagen.reference_paths(str(folder))
+
+    chosen, dropped = imagen.select_references(paths, k=6)
+
+    # The sharper of the pair stays; the other is reported against it
+    original, copy = str(folder / "view3.jpg"), str(folder / "view3_copy.jpg")
+    assert len(chosen) == 6
+    assert (original in chosen) != (copy in chosen)
+    loser = copy if original in chosen else original
+    assert dropped[loser].startswith("near-duplicate of view3")
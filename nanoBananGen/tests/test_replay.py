@@ -0,0 +1,125 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+import imagen
+
+
+def replay_args(**overrides):
+    args = dict(sku=None, code=None, since=None, until=None, workers=2, dry_run=False, backend="sim",
+                pause_on_error=False, no_cache=False, ref_max_edge=imagen.REF_MAX_EDGE_PX,
+                ref_strategy="auto", ref_context="request", hedge=0.0)
+    args.update(overrides)
+    return argparse.Namespace(**args)
+
+
+def journal():
+    if not os.path.exists(imagen.ERROR_FILE):
+        return []
+    with open(imagen.ERROR_FILE, encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+
+def lose_output(code, key):
+    os.remove(imagen.STORE.prompt_rows(code)[key]["output_path"])
+
+
+def test_replay_regenerates_only_failed_prompts(catalogue, capsys):
+    item = catalogue[0]
+    code = item["product_code"]
+    assert imagen.process_sku(item, False, True)
+    lose_output(code, "top")
+    lose_output(code, "side")
+    imagen.append_error({"timestamp": imagen.now_str(), "product_code": code, "prompt": "top",
+                         "error_code": "no_image_bytes", "error": "No image bytes returned from API"})
+
+    imagen.cmd_replay(replay_args(no_cache=True))
+
+    rows = imagen.STORE.prompt_rows(code)
+    assert imagen.verified_output(rows["top"])
+    assert not os.path.exists(rows["side"]["output_path"])   # not in the journal, left alone
+    assert f"FIXED   {code}/top" in capsys.readouterr().out
+
+
+def test_replay_served_from_cache_does_not_open_an_empty_pool(catalogue, capsys):
+    # Every replayed prompt is answered by the result cache while another prompt of the SKU is
+    # still missing: the SKU must end cleanly instead of uploading and starting zero workers
+    item = catalogue[0]
+    code = item["product_code"]
+    assert imagen.process_sku(item, False, True)
+    lose_output(code, "top")
+    imagen.STORE.mark_qc_failed(code, "side", "not_square")   # reopens the SKU; not replayed
+    imagen.append_error({"timestamp": imagen.now_str(), "product_code": code, "prompt": "top",
+                         "error_code": "no_image_bytes", "error": "No image bytes returned from API"})
+    uploads = imagen.KEYS.keys[0].backend.stats["uploads"]
+
+    imagen.cmd_replay(replay_args())
+
+    out = capsys.readouterr().out
+    assert f"FIXED   {code}/top" in out
+    assert "1 of 1 prompt(s) fixed" in out
+    assert code not in imagen.STORE.completed_skus()
+    assert [e["error_code"] for e in journal()] == ["no_image_bytes"]
+    assert imagen.KEYS.keys[0].backend.stats["uploads"] == uploads
+
+
+def test_replay_dry_run_lists_targets(catalogue, capsys):
+    code = catalogue[1]["product_code"]
+    imagen.append_error({"timestamp": imagen.now_str(), "product_code": code, "prompt": "upload",
+                         "error_code": "upload_failed", "error": "boom"})
+
+    imagen.cmd_replay(replay_args(dry_run=True))
+
+    out = capsys.readouterr().out
+    assert f"Replaying {len(imagen.PROMPT_KEYS)} prompt(s) across 1 SKU(s)" in out
+    assert imagen.STORE.prompt_rows(code) == {}
+
+
+def fail(code, prompt, error_code):
+    imagen.append_error({"timestamp": imagen.now_str(), "product_code": code, "prompt": prompt,
+                         "error_code": error_code, "error": "boom"})
+
+
+def test_input_failures_are_listed_for_manual_action_not_replayed(catalogue, capsys):
+    first, second = (item["product_code"] for item in catalogue)
+    fail(first, "upload", "upload_failed")
+    fail(first, "n/a", "reference_folder_missing")
+    fail(second, "n/a", "preflight_prompt_text")
+    fail(second, "upload", "upload_failed")   # a later run got past the input: replayable again
+
+    targets, manual = imagen.replay_targets()
+
+    assert manual == {first: "reference_folder_missing"}
+    assert list(targets) == [second]
+
+    imagen.cmd_replay(replay_args(dry_run=True))
+
+    out = capsys.readouterr().out
+    assert f"Needs manual action, not replayed (1 SKU(s)):\n  {first}: reference_folder_missing" in out
+    assert "across 1 SKU(s)" in out
+
+
+def test_fixed_input_drops_out_of_the_manual_list(catalogue):
+    item = catalogue[0]
+    fail(item["product_code"], "n/a", "prompts_missing")
+    assert imagen.process_sku(item, False, True)
+
+    assert imagen.replay_targets() == ({}, {})
+
+
+def test_replay_dry_run_writes_no_files(tmp_path):
+    script = os.path.join(os.path.dirname(os.path.abspath(imagen.__file__)), "imagen.py")
+    with open(tmp_path / "error_log.jsonl", "w", encoding="utf-8") as f:
+        f.write(json.dumps({"timestamp": imagen.now_str(), "product_code": "SKU1", "prompt": "upload",
+                            "error_code": "upload_failed", "error": "boom"}) + "\n")
+    with open(tmp_path / "prompts_new.json", "w", encoding="utf-8") as f:
+        json.dump([{"product_code": "SKU1"}], f)
+
+    out = subprocess.run([sys.executable, script, "replay", "--dry-run"], cwd=str(tmp_path),
+                         capture_output=True, text=True, timeout=120)
+
+    assert out.returncode == 0, out.stderr
+    assert "across 1 SKU(s)" in out.stdout
+    assert sorted(os.listdir(tmp_path)) == ["error_log.jsonl", "prompts_new.json"]
@@ -0,0 +1,47 @@
+import imagen
+
+
+def cache_keys(item):
+    folder = imagen.find_folder_for_code(item["product_code"])
+    return {k: imagen.result_cache_key(p, folder) for k, p in imagen.sku_prompts(item).items()}
+
+
+def reject_in_qc(monkeypatch, key, failure):
+    """Makes QC fail every saved image of prompt `key`."""
+    real_qc = imagen.qc_image
+
+    def qc(path, white_bg):
+        res = real_qc(path, white_bg)
+        if f"_{key}_raw" in path:
+            res.update(ok=False, failures=[failure])
+        return res
+
+    monkeypatch.setattr(imagen, "qc_image", qc)
+
+
+def test_only_qc_accepted_images_are_cached(catalogue, monkeypatch):
+    item = catalogue[0]
+    reject_in_qc(monkeypatch, "top", "not_square")
+
+    imagen.process_sku(item, False, True)
+
+    keys = cache_keys(item)
+    assert not imagen.RESULT_CACHE.has(keys["top"])
+    assert all(imagen.RESULT_CACHE.has(keys[k]) for k in ("side", "front_45", "lifestyle"))
+
+
+def test_rejected_cached_image_is_not_served_again(catalogue, monkeypatch):
+    item = catalogue[0]
+    assert imagen.process_sku(item, False, True)
+    top = cache_keys(item)["top"]
+    assert imagen.RESULT_CACHE.has(top)
+
+    # State reset: everything is served from the cache, and QC now rejects the cached 'top'
+    imagen.STORE.close()
+    monkeypatch.setattr(imagen, "STORE", imagen.RunStore(imagen.RUN_DB_FILE + ".reset"))
+    reject_in_qc(monkeypatch, "top", "blank_frame")
+    calls = imagen.KEYS.keys[0].backend.stats["ok"]
+
+    assert not imagen.process_sku(item, False, True)
+    assert not imagen.RESULT_CACHE.has(top)
+    assert imagen.KEYS.keys[0].backend.stats["ok"] == calls
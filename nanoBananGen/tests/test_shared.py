@@ -0,0 +1,144 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+import imagen
+
+WORKER = """
+import json, sys, time
+sys.path.insert(0, {src!r})
+import imagen
+leases = imagen.WorkLeases({root!r})
+while time.time() < {start_at!r}:
+    time.sleep(0.001)
+got = [code for code in {codes!r} if leases.claim(code)]
+print(json.dumps({{"worker": leases.worker_id, "claimed": got}}), flush=True)
+if {crash!r}:
+    import os; os._exit(0)   # dies holding its leases
+for code in got:
+    leases.finish(code, True)
+"""
+
+
+def shared_leases(work, monkeypatch):
+    leases = imagen.WorkLeases(str(work / "shared"))
+    monkeypatch.setattr(imagen, "LEASES", leases)
+    return leases
+
+
+def run_pass(items):
+    return imagen.run_sequential(items, False)
+
+
+def test_missing_reference_folder_is_tried_once_and_settled(catalogue, work, monkeypatch):
+    leases = shared_leases(work, monkeypatch)
+    missing, fine = (item["product_code"] for item in catalogue)
+    shutil.rmtree(imagen.find_folder_for_code(missing))
+    monkeypatch.setattr(imagen, "REF_INDEX", imagen.ReferenceIndex())
+    calls = []
+    real = imagen._process_sku
+    monkeypatch.setattr(imagen, "_process_sku", lambda item, *a: calls.append(item["product_code"]) or real(item, *a))
+
+    assert imagen.run_shared(catalogue, run_pass) == 1
+
+    assert calls.count(missing) == 1
+    assert leases.failure(missing)["reason"] == "missing_input"
+    assert leases.settled([missing, fine]) == {missing, fine}
+
+
+def test_failed_sku_is_not_reclaimed_until_its_retry_delay(catalogue, work, monkeypatch):
+    leases = shared_leases(work, monkeypatch)
+    monkeypatch.setattr(imagen, "SHARED_RETRY_DELAY_S", 60.0)
+    code = catalogue[0]["product_code"]
+    attempts = []
+
+    def failing_upload(folder, refs=None):
+        attempts.append(folder)
+        raise RuntimeError("upload refused")
+    monkeypatch.setattr(imagen, "sku_references", failing_upload)
+
+    imagen.run_shared(catalogue[:1], run_pass)
+
+    assert len(attempts) == 1
+    assert leases.attempts(code) == 1
+    assert leases.backing_off([code]) == {code}
+    assert not leases.claim(code)
+
+
+def test_failed_sku_is_claimable_once_its_delay_has_passed(catalogue, work, monkeypatch):
+    leases = shared_leases(work, monkeypatch)
+    monkeypatch.setattr(imagen, "SHARED_RETRY_DELAY_S", 0.0)
+    code = catalogue[0]["product_code"]
+
+    leases.claim(code)
+    leases.finish(code, False)
+
+    assert leases.backing_off([code]) == set()
+    assert leases.claim(code)
+    leases.release(code)
+
+
+def test_reference_folder_that_turns_up_revives_the_sku(catalogue, work, monkeypatch):
+    leases = shared_leases(work, monkeypatch)
+    code = catalogue[0]["product_code"]
+    leases.claim(code)
+    leases.finish(code, False, missing_input=True)
+    assert leases.settled([code]) == {code}
+
+    assert imagen.run_shared(catalogue[:1], run_pass) == 1
+
+    assert leases.settled([code]) == {code}
+    assert leases.attempts(code) == 0
+
+
+def compete(work, codes, workers=2, crash=False, ttl=300.0):
+    """Starts `workers` processes that claim `codes` from one shared dir at the same instant."""
+    src = os.path.dirname(os.path.abspath(imagen.__file__))
+    script = WORKER.format(src=src, root=str(work / "shared"), start_at=time.time() + 1.5, codes=codes, crash=crash)
+    env = dict(os.environ, LEASE_TTL_S=str(ttl))
+    procs = [subprocess.Popen([sys.executable, "-c", script], cwd=str(work), env=env,
+                              stdout=subprocess.PIPE, text=True) for _ in range(workers)]
+    results = [json.loads(p.communicate(timeout=60)[0].strip().splitlines()[-1]) for p in procs]
+    assert all(p.returncode == 0 for p in procs)
+    return [r["claimed"] for r in results]
+
+
+def test_two_processes_claim_each_sku_exactly_once(work):
+    codes = [f"SKU{i:03d}" for i in range(60)]
+
+    claimed = compete(work, codes)
+
+    assert sorted(claimed[0] + claimed[1]) == codes
+    assert not set(claimed[0]) & set(claimed[1])
+    assert imagen.WorkLeases(str(work / "shared")).settled(codes) == set(codes)
+
+
+def test_crashed_workers_leases_are_reclaimed_once_expired(work, monkeypatch):
+    codes = [f"SKU{i:03d}" for i in range(10)]
+    (crashed,) = compete(work, codes, workers=1, crash=True)
+    assert crashed == codes
+    monkeypatch.setattr(imagen, "LEASE_TTL_S", 0.5)
+    leases = imagen.WorkLeases(str(work / "shared"))
+    assert not leases.claim(codes[0])   # still fresh
+
+    time.sleep(0.8)
+
+    assert all(leases.claim(code) for code in codes)
+    assert leases.reclaimed == len(codes)
+    leases.close()
+
+
+def test_two_processes_reclaiming_one_expired_lease_leave_one_owner(work):
+    codes = [f"SKU{i:03d}" for i in range(20)]
+    compete(work, codes, workers=1, crash=True)
+    stale = time.time() - 60
+    for code in codes:
+        os.utime(os.path.join(work, "shared", "leases", f"{code}.lease"), (stale, stale))
+
+    claimed = compete(work, codes, ttl=30.0)
+
+    assert sorted(claimed[0] + claimed[1]) == codes
+    assert not set(claimed[0]) & set(claimed[1])
@@ -0,0 +1,33 @@
+import argparse
+import os
+
+import imagen
+
+
+def files(root):
+    return sorted(os.path.relpath(os.path.join(d, f), root) for d, _, names in os.walk(root) for f in names)
+
+
+def test_status_of_a_finished_run_creates_no_files(catalogue, capsys):
+    assert imagen.process_sku(catalogue[0], False, True)
+    imagen.STORE.close()   # the run is over; sqlite removes its -wal/-shm
+    before = files(os.getcwd())
+    assert "run_state.sqlite3-wal" not in before
+
+    imagen.cmd_status(argparse.Namespace(watch=None))
+    imagen.STORE.close()
+
+    assert "2 total: 1 completed" in capsys.readouterr().out
+    assert files(os.getcwd()) == before
+
+
+def test_status_sees_a_live_run_through_its_wal(catalogue, capsys):
+    writer = imagen.STORE
+    assert imagen.process_sku(catalogue[0], False, True)
+    assert os.path.exists("run_state.sqlite3-wal")   # the run's store is still open
+
+    imagen.cmd_status(argparse.Namespace(watch=None))
+    imagen.STORE.close()
+    writer.close()
+
+    assert "2 total: 1 completed" in capsys.readouterr().out
@@ -0,0 +1,85 @@
+import json
+import os
+import time
+from types import SimpleNamespace
+
+import imagen
+
+
+def handle(n):
+    return SimpleNamespace(name=f"files/{n}", uri=f"https://sim/files/{n}", mime_type="image/jpeg")
+
+
+def write_lines(path, entries):
+    with open(path, "w", encoding="utf-8") as f:
+        for e in entries:
+            f.write(json.dumps(e) + "\n")
+
+
+def entry(n, expires_at):
+    return {"sha256": f"sha{n}", "key_id": "key-a", "name": f"files/{n}", "uri": f"https://sim/files/{n}",
+            "mime_type": "image/jpeg", "expires_at": expires_at}
+
+
+def lines(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+
+def test_load_compacts_expired_and_invalidated_lines(work):
+    path = str(work / "cache.jsonl")
+    later = time.time() + 3600
+    write_lines(path, [entry(1, time.time() - 1), entry(2, later), entry(3, later),
+                       {"sha256": "sha3", "key_id": "key-a", "invalid": True}])
+
+    cache = imagen.UploadCache(path)
+    cache._load()
+
+    assert [e["sha256"] for e in lines(path)] == ["sha2"]
+    assert not os.path.exists(cache.lock_path)
+
+
+def test_line_appended_by_another_process_during_compaction_survives(work, monkeypatch):
+    path = str(work / "cache.jsonl")
+    write_lines(path, [entry(1, time.time() - 1), entry(2, time.time() + 3600)])
+    cache = imagen.UploadCache(path)
+    other = imagen.UploadCache(path)   # another process sharing the file
+    real_read = cache._read
+
+    def read_then_other_appends():
+        result = real_read()
+        if not os.path.exists(cache.lock_path):   # the unlocked first pass
+            other._loaded = True
+            other.put("sha9", "key-a", handle(9), "other.jpg")
+        return result
+    monkeypatch.setattr(cache, "_read", read_then_other_appends)
+
+    cache._load()
+
+    assert sorted(e["sha256"] for e in lines(path)) == ["sha2", "sha9"]
+    assert "key-a:sha9" in cache._entries
+
+
+def test_compaction_is_skipped_while_another_process_holds_the_lock(work):
+    path = str(work / "cache.jsonl")
+    write_lines(path, [entry(1, time.time() - 1), entry(2, time.time() + 3600)])
+    open(path + ".lock", "w").close()
+
+    cache = imagen.UploadCache(path)
+    cache._load()
+
+    assert len(lines(path)) == 2          # left for a later load
+    assert list(cache._entries) == ["key-a:sha2"]
+
+
+def test_stale_lock_of_a_crashed_process_is_broken(work):
+    path = str(work / "cache.jsonl")
+    cache = imagen.UploadCache(path)
+    open(cache.lock_path, "w").close()
+    old = time.time() - cache.LOCK_STALE_S - 1
+    os.utime(cache.lock_path, (old, old))
+
+    cache.put("sha1", "key-a", handle(1), "a.jpg")
+
+    assert [e["sha256"] for e in lines(path)] == ["sha1"]
+    assert not os.path.exists(cache.lock_path)